@@ -0,0 +1,92 @@
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+SIGNED_TOKEN_PREFIX = "v1."
+
+
+def encode_segment(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_segment(segment):
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def get_signature(body, secret):
+    return encode_segment(hmac.new(secret.encode('utf-8'), body.encode('ascii'), hashlib.sha256).digest())
+
+
+def is_signed_token(token):
+    return isinstance(token, str) and token.startswith(SIGNED_TOKEN_PREFIX)
+
+
+def sign_access_token(user_id, is_admin, expires_at, secret):
+    body = encode_segment(json.dumps({'u': str(user_id), 'a': bool(is_admin), 'e': int(expires_at)},
+                                     separators=(',', ':')).encode('utf-8'))
+    return "{}{}.{}".format(SIGNED_TOKEN_PREFIX, body, get_signature(body, secret))
+
+
+def verify_access_token(token, secret, now=None):
+    # Returns the token payload, or None if the token is malformed, tampered with or expired.
+    if not is_signed_token(token):
+        return None
+    try:
+        body, signature = token[len(SIGNED_TOKEN_PREFIX):].split('.')
+        # Signing and compare_digest only take ASCII text.
+        body.encode('ascii')
+        signature.encode('ascii')
+    except ValueError:
+        return None
+    if not hmac.compare_digest(signature, get_signature(body, secret)):
+        return None
+    try:
+        payload = json.loads(decode_segment(body).decode('utf-8'))
+    except ValueError:
+        return None
+    now = time.time() if now is None else now
+    if payload['e'] <= now:
+        return None
+    return {'user_id': payload['u'], 'is_admin': payload['a'], 'expires_at': payload['e']}
+
+
+def get_token_hash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class RevocationFilter(object):
+    # A Bloom filter answers "definitely not revoked" for almost every token without touching the exact
+    # set; only tokens that hit all bits are confirmed against it.
+    def __init__(self, size=2 ** 16, hash_count=4):
+        self.size = size
+        self.hash_count = hash_count
+        self.bits = bytearray(size // 8)
+        self.token_hashes = set()
+        self.lock = threading.Lock()
+
+    def get_positions(self, token_hash):
+        digest = hashlib.sha256(token_hash.encode('ascii')).digest()
+        return [int.from_bytes(digest[4 * i:4 * i + 4], 'big') % self.size for i in range(self.hash_count)]
+
+    def add(self, token_hash):
+        with self.lock:
+            for position in self.get_positions(token_hash):
+                self.bits[position // 8] |= 1 << (position % 8)
+            self.token_hashes.add(token_hash)
+
+    def might_contain(self, token_hash):
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self.get_positions(token_hash))
+
+    def contains(self, token_hash):
+        return self.might_contain(token_hash) and token_hash in self.token_hashes
+
+    def replace(self, token_hashes):
+        revocation_filter = RevocationFilter(self.size, self.hash_count)
+        for token_hash in token_hashes:
+            revocation_filter.add(token_hash)
+        with self.lock:
+            self.bits = revocation_filter.bits
+            self.token_hashes = revocation_filter.token_hashes
@@ -0,0 +1,59 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+
+class ActionDispatcher(object):
+    # Trigger actions are queued per actor and action. An action queued again before it ran replaces the
+    # queued value, so an actor only ever receives the last value of a burst, at most one command at a time,
+    # after the action has waited for the coalescing window.
+    def __init__(self, max_workers=4, window=1.0):
+        self.window = window
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = collections.OrderedDict()
+        self.busy_actor_ids = set()
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def submit(self, actor_id, action, run, now=None):
+        # run is called without arguments on a worker thread.
+        now = time.time() if now is None else now
+        with self.lock:
+            key = (actor_id, action)
+            if key in self.pending:
+                self.coalesced += 1
+                self.pending[key]['run'] = run
+            else:
+                self.pending[key] = {'run': run, 'queued_at': now}
+
+    def dispatch(self, now=None):
+        # Starts every queued action whose window has passed and whose actor is not busy; returns the futures.
+        now = time.time() if now is None else now
+        futures = []
+        with self.lock:
+            for key, entry in list(self.pending.items()):
+                actor_id = key[0]
+                if entry['queued_at'] + self.window > now or actor_id in self.busy_actor_ids:
+                    continue
+                del self.pending[key]
+                self.busy_actor_ids.add(actor_id)
+                futures.append(self.executor.submit(self.run, actor_id, key[1], entry['run']))
+        return futures
+
+    def run(self, actor_id, action, run):
+        try:
+            run()
+        except Exception as ex:
+            logging.error("Action {} on device {} failed: {}".format(action, actor_id, ex))
+        finally:
+            with self.lock:
+                self.busy_actor_ids.discard(actor_id)
+
+    def get_queue_length(self):
+        with self.lock:
+            return len(self.pending)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
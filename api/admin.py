@@ -14,6 +14,22 @@ def clear_db():
     api.room_repository.clear_db()
     api.device_repository.clear_db()
     api.trigger_repository.clear_db()
+    api.repository_collection.reading_repository.clear_db()
+    api.repository_collection.rollup_repository.clear_db()
+    api.repository_collection.daily_aggregate_repository.clear_db()
+    api.repository_collection.energy_repository.clear_db()
+    click.echo("Done.")
+
+
+@api.cli.command()
+def check_indexes():
+    click.echo("Checking indexes")
+    for repository in api.repository_collection.get_all_repositories():
+        name = repository.collection.name
+        for index_name in repository.get_missing_indexes():
+            click.echo("Missing index on {}: {}".format(name, index_name))
+        for index_name in repository.get_unused_indexes():
+            click.echo("Unused index on {}: {}".format(name, index_name))
     click.echo("Done.")
 
 
@@ -0,0 +1,105 @@
+import numpy
+
+from trigger_engine import RULE_EVENT, duration_events, get_duration, get_threshold, threshold_events, \
+    trigger_events
+
+# Replays a trigger over the stored readings of its sensor the way the trigger engine would have evaluated them
+# one by one, starting from an unknown state. Reading values are converted in one pass; crossings, transitions
+# and timer runs are then found with array operations over the whole series.
+
+
+class BacktestError(ValueError):
+    pass
+
+
+def get_series(readings, field, convert):
+    # readings: (timestamp, values) pairs in time order. Readings without a usable value of the field are left out.
+    timestamps = []
+    values = []
+    for timestamp, reading_values in readings:
+        value = reading_values.get(field) if isinstance(reading_values, dict) else None
+        if value is None:
+            continue
+        try:
+            values.append(float(convert(value)))
+        except (TypeError, ValueError):
+            continue
+        timestamps.append(timestamp)
+    return numpy.array(timestamps, dtype=float), numpy.array(values, dtype=float)
+
+
+def get_threshold_fires(timestamps, values, upwards, activate, deactivate):
+    previous, current = values[:-1], values[1:]
+    if upwards:
+        activating = (previous <= activate) & (activate < current)
+        deactivating = (current < deactivate) & (deactivate <= previous)
+    else:
+        activating = (current < activate) & (activate <= previous)
+        deactivating = (previous <= deactivate) & (deactivate < current)
+    # The state after every reading is the last crossing so far: 1 active, -1 inactive, 0 unknown.
+    crossings = numpy.where(activating, 1, numpy.where(deactivating, -1, 0))
+    positions = numpy.where(crossings != 0, numpy.arange(len(crossings)), -1)
+    last_crossing = numpy.maximum.accumulate(positions) if len(positions) > 0 else positions
+    states = numpy.where(last_crossing >= 0, crossings[numpy.maximum(last_crossing, 0)], 0)
+    previous_states = numpy.concatenate(([0], states[:-1]))
+    return timestamps[1:][activating & (previous_states != 1)]
+
+
+def get_level_fires(timestamps, levels):
+    # Level triggers only fire on a transition from a known inactive state.
+    levels = levels.astype(bool)
+    return timestamps[1:][levels[1:] & ~levels[:-1]]
+
+
+def get_duration_fires(timestamps, levels, duration, end):
+    # A timer is armed on every run of readings for which the condition holds, and fires unless the run ends
+    # before it is due.
+    levels = levels.astype(bool)
+    previous_levels = numpy.concatenate(([False], levels[:-1]))
+    starts = numpy.flatnonzero(levels & ~previous_levels)
+    stops = numpy.flatnonzero(~levels & previous_levels)
+    next_stops = numpy.searchsorted(stops, starts)
+    stop_times = numpy.append(timestamps[stops], end)[next_stops]
+    due = timestamps[starts] + duration
+    return due[due <= stop_times]
+
+
+def apply_debounce(fire_times, debounce):
+    if not debounce:
+        return list(fire_times)
+    kept = []
+    for fire_time in fire_times:
+        if len(kept) == 0 or fire_time - kept[-1] >= debounce:
+            kept.append(fire_time)
+    return kept
+
+
+def backtest_trigger(trigger, readings, end, default_hysteresis=0.0, default_debounce=0):
+    # Returns the times at which the trigger would have fired. Raises BacktestError for triggers that cannot
+    # be replayed from the readings of their own sensor.
+    event = trigger.event
+    if event in threshold_events:
+        field, upwards = threshold_events[event]
+        threshold = get_threshold(trigger)
+        if threshold is None:
+            raise BacktestError("Trigger has no numeric threshold")
+        hysteresis = trigger.hysteresis if trigger.hysteresis is not None else default_hysteresis
+        timestamps, values = get_series(readings, field, float)
+        fire_times = get_threshold_fires(timestamps, values, upwards, threshold,
+                                         threshold - hysteresis if upwards else threshold + hysteresis)
+    elif event in trigger_events or event in duration_events:
+        field, level = trigger_events.get(event) or duration_events[event]
+        timestamps, levels = get_series(readings, field, lambda value: level(trigger.event_params, value))
+        if event in trigger_events:
+            fire_times = get_level_fires(timestamps, levels)
+        else:
+            duration = get_duration(trigger)
+            if duration is None:
+                raise BacktestError("Trigger has no numeric duration")
+            fire_times = get_duration_fires(timestamps, levels, duration, end)
+    elif event == RULE_EVENT:
+        raise BacktestError("Rules over several sensors cannot be backtested")
+    else:
+        raise BacktestError("Unknown event {}".format(event))
+    debounce = trigger.debounce if trigger.debounce is not None else default_debounce
+    return [float(fire_time) for fire_time in apply_debounce(fire_times, debounce)]
@@ -0,0 +1,74 @@
+import random
+import sys
+import time
+
+from bson import ObjectId
+
+from model import Trigger
+from trigger_engine import TriggerEngine
+
+# Compares the threshold index of the trigger engine with testing every temperature rule of a sensor:
+#   python benchmark_triggers.py [rule counts...]
+DEFAULT_RULE_COUNTS = (10000, 100000, 1000000)
+READINGS = 1000
+
+
+def make_triggers(sensor_id, count):
+    events = ("temperature_gets_higher_than", "temperature_gets_lower_than")
+    return [Trigger({'_id': ObjectId(), 'sensor_id': sensor_id, 'event': events[i % 2],
+                     'event_params': round(random.uniform(5, 35), 1), 'actor_id': None, 'action': None,
+                     'action_params': None, 'user_id': None, 'reading': None}) for i in range(count)]
+
+
+def linear_scan(triggers, active, previous, current):
+    # Same semantics as the engine without hysteresis: a rule fires when it crosses its threshold and was not
+    # already active, and becomes inactive when the reading crosses back.
+    fired = []
+    for trigger in triggers:
+        threshold = float(trigger.event_params)
+        if trigger.event == "temperature_gets_higher_than":
+            crossed, crossed_back = previous <= threshold < current, previous >= threshold > current
+        else:
+            crossed, crossed_back = previous >= threshold > current, previous <= threshold < current
+        if crossed and not active.get(trigger.trigger_id):
+            active[trigger.trigger_id] = True
+            fired.append(trigger)
+        elif crossed_back:
+            active[trigger.trigger_id] = False
+    return fired
+
+
+def reading(temperature):
+    return {"data": {"temperature": temperature}, "timestamp": "0"}
+
+
+def benchmark(count):
+    sensor_id = ObjectId()
+    triggers = make_triggers(sensor_id, count)
+    engine = TriggerEngine()
+    start = time.perf_counter()
+    engine.load(triggers)
+    load_time = time.perf_counter() - start
+    # Consecutive thermostat readings move by a fraction of a degree.
+    temperatures = [20.0]
+    for _ in range(READINGS):
+        temperatures.append(round(min(35, max(5, temperatures[-1] + random.uniform(-0.5, 0.5))), 2))
+    pairs = list(zip(temperatures, temperatures[1:]))
+
+    start = time.perf_counter()
+    indexed = [len(engine.evaluate(sensor_id, reading(previous), reading(current))) for previous, current in pairs]
+    index_time = (time.perf_counter() - start) / len(pairs)
+    # The linear scan is slow enough at a million rules to only time a sample of the readings.
+    sample = pairs[:max(10, len(pairs) * 10000 // count)]
+    start = time.perf_counter()
+    active = {}
+    scanned = [len(linear_scan(triggers, active, previous, current)) for previous, current in sample]
+    scan_time = (time.perf_counter() - start) / len(sample)
+    assert indexed[:len(sample)] == scanned, "Index and linear scan disagree"
+    print("{:>9} rules: load {:8.3f} s, index {:10.1f} us/reading, linear scan {:10.1f} us/reading ({:.0f}x)".format(
+        count, load_time, index_time * 1e6, scan_time * 1e6, scan_time / index_time))
+
+
+if __name__ == "__main__":
+    for rule_count in [int(arg) for arg in sys.argv[1:]] or DEFAULT_RULE_COUNTS:
+        benchmark(rule_count)
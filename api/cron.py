@@ -3,19 +3,107 @@ from apscheduler.triggers.interval import IntervalTrigger
 
 import logging
 scheduler = BackgroundScheduler(daemon=True)
-scheduler.start()
 
 
-def update_all_readings():
+def poll_due_devices():
     from main import api
-    logging.debug("Updating all readings")
-    api.device_repository.update_all_device_readings()
+    api.device_repository.update_due_device_readings()
+
+
+def dispatch_trigger_actions():
+    from main import api
+    api.repository_collection.action_dispatcher.dispatch()
+
+
+def expire_trigger_timers():
+    from main import api
+    api.repository_collection.trigger_repository.process_timers()
+
+
+def reconcile_device_shadows():
+    from main import api
+    api.device_repository.reconcile_devices()
+
+
+def sync_poll_schedule():
+    from main import api
+    logging.debug("Synchronising poll schedule")
+    api.device_repository.sync_poll_schedule()
+
+
+def sync_revoked_tokens():
+    from main import api
+    api.repository_collection.revoked_token_repository.sync_revocations()
+
+
+def compact_readings():
+    from main import api
+    logging.debug("Compacting readings history")
+    api.repository_collection.rollup_repository.compact()
+
+
+def sync_energy_samples():
+    from main import api
+    logging.debug("Synchronising energy samples")
+    api.repository_collection.energy_repository.sync()
 
 
 def setup_cron():
+    from main import api
+    # Started here rather than on import, so that no scheduler thread exists while the trigger workers are forked.
+    scheduler.start()
+    api.device_repository.sync_poll_schedule()
+    scheduler.add_job(
+        func=poll_due_devices,
+        trigger=IntervalTrigger(seconds=api.config.get('POLL_TICK_SECONDS', 1)),
+        id='poll_due_devices',
+        name='Get readings of devices that are due',
+        coalesce=True,
+        replace_existing=True)
+    scheduler.add_job(
+        func=dispatch_trigger_actions,
+        trigger=IntervalTrigger(seconds=api.config.get('TRIGGER_ACTION_WINDOW_SECONDS', 1)),
+        id='dispatch_trigger_actions',
+        name='Run coalesced trigger actions',
+        coalesce=True,
+        replace_existing=True)
+    scheduler.add_job(
+        func=expire_trigger_timers,
+        trigger=IntervalTrigger(seconds=api.config.get('TRIGGER_TIMER_TICK_SECONDS', 1)),
+        id='expire_trigger_timers',
+        name='Fire duration triggers whose timers are due',
+        coalesce=True,
+        replace_existing=True)
+    scheduler.add_job(
+        func=reconcile_device_shadows,
+        trigger=IntervalTrigger(seconds=api.config.get('SHADOW_RECONCILE_SECONDS', 5)),
+        id='reconcile_device_shadows',
+        name='Push the desired state to devices that have not reported it',
+        coalesce=True,
+        replace_existing=True)
+    scheduler.add_job(
+        func=sync_poll_schedule,
+        trigger=IntervalTrigger(seconds=300),
+        id='sync_poll_schedule',
+        name='Synchronise poll schedule with the device list',
+        replace_existing=True)
+    scheduler.add_job(
+        func=sync_revoked_tokens,
+        trigger=IntervalTrigger(seconds=api.config.get('TOKEN_REVOCATION_SYNC_SECONDS', 30)),
+        id='sync_revoked_tokens',
+        name='Synchronise revoked access tokens',
+        replace_existing=True)
+    scheduler.add_job(
+        func=compact_readings,
+        trigger=IntervalTrigger(seconds=api.config.get('ROLLUP_INTERVAL_SECONDS', 300)),
+        id='compact_readings',
+        name='Roll up and trim the readings history',
+        coalesce=True,
+        replace_existing=True)
     scheduler.add_job(
-        func=update_all_readings,
-        trigger=IntervalTrigger(seconds=100),
-        id='update_all_readings',
-        name='Get all device readings',
+        func=sync_energy_samples,
+        trigger=IntervalTrigger(seconds=api.config.get('ENERGY_SYNC_SECONDS', 3600)),
+        id='sync_energy_samples',
+        name='Fetch new energy samples from the vendors',
+        coalesce=True,
         replace_existing=True)
@@ -1,17 +1,28 @@
 import datetime
 import json
 import logging
+import sys
 
 from bson.objectid import ObjectId
 from flask import Flask, jsonify, request
 from pymongo import MongoClient
 
+from backtest import BacktestError
 from cron import setup_cron
+from repositories import create_trigger_worker_pool
+from rules import RuleSyntaxError, get_rule_sensor_ids
+from trigger_engine import RULE_EVENT
+
+if __name__ == "__main__":
+    # The cron jobs import api from main, which must be this module rather than a second copy of it.
+    sys.modules['main'] = sys.modules[__name__]
 
 # TODO: better error handling
 api = Flask("SPE-IoT-API")
 api.config.from_pyfile('config.cfg')
 logging.basicConfig(level=logging.DEBUG)
+# Trigger workers are forked before the Mongo client starts its threads.
+trigger_worker_pool = create_trigger_worker_pool(api.config)
 # Connector to running database
 mongo = MongoClient(api.config['MONGO_HOST'], api.config['MONGO_PORT'])
 db = mongo.database
@@ -22,6 +33,8 @@ class JSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, ObjectId):
             return str(o)
+        if isinstance(o, (datetime.datetime, datetime.date)):
+            return o.isoformat()
         return json.JSONEncoder.default(self, o)
 
 
@@ -29,7 +42,11 @@ api.json_encoder = JSONEncoder
 
 import repositories
 
-api.repository_collection = repositories.RepositoryCollection(db)
+api.repository_collection = repositories.RepositoryCollection(db, api.config, trigger_worker_pool)
+api.repository_collection.ensure_indexes()
+api.repository_collection.backfill_owner_user_ids()
+api.repository_collection.rebuild_fault_counters()
+api.repository_collection.revoked_token_repository.sync_revocations()
 
 api.user_repository = api.repository_collection.user_repository
 api.house_repository = api.repository_collection.house_repository
@@ -41,9 +58,28 @@ api.token_repository = api.repository_collection.token_repository
 
 
 def get_request_token():
+    # "Authorization: Bearer <token>" for GET requests, which should not have a body, or the token in the JSON body.
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        return authorization[len('Bearer '):]
     return request.get_json()['token']
 
 
+def check_request_access(entities):
+    return api.repository_collection.check_access(get_request_token(), entities)
+
+
+def get_theme_device_ids(settings):
+    return [ObjectId(setting['device_id']) for setting in settings]
+
+
+def get_rule_device_ids(data):
+    # Devices the rule of a rule trigger refers to; raises RuleSyntaxError if the rule is invalid.
+    if data['event'] != RULE_EVENT:
+        return []
+    return list(get_rule_sensor_ids(data['event_params'], ObjectId(data['sensor_id'])))
+
+
 @api.route('/user/<string:user_id>', methods=['POST'])
 def get_user_info(user_id):
     access = api.token_repository.authenticate_user(ObjectId(user_id), get_request_token())
@@ -81,7 +117,13 @@ def update_user_data(user_id):
     return jsonify({"success": True, "error": None})
 
 
-@api.route('/graph/<user_id>', methods=['POST'])
+def parse_request_date(data, key, default):
+    if data.get(key) is None:
+        return default
+    return datetime.datetime.strptime(data[key], "%Y-%m-%d").date()
+
+
+@api.route('/graph/<user_id>', methods=['GET', 'POST'])
 def get_user_graph_data(user_id):
     access = api.token_repository.authenticate_user(ObjectId(user_id), get_request_token())
     if not access:
@@ -89,21 +131,27 @@ def get_user_graph_data(user_id):
     user = api.user_repository.get_user_by_id(ObjectId(user_id))
     if user is None:
         return jsonify({"data": None, "error": {"code": 404, "message": "No such user found"}})
-
-    base = datetime.datetime.today()
-    numdays = 30
-
-    dateList = []
-    for x in range(0, numdays):
-        dateList.append(base - datetime.timedelta(days=x))
-
-    readingList = []
-    for y in range(0, numdays):
-        readingList.append(round(7.845, 2))  # remain constant for now, 7.845 is a random value.
-
-    data = {date.strftime("%d-%B-%Y"): data for date, data in zip(dateList, readingList)}
-
-    return jsonify({"data": data, "error": None})
+    data = request.args if request.method == 'GET' else request.get_json()
+    resolution = data.get('resolution', 'day')
+    try:
+        end = parse_request_date(data, 'end', datetime.datetime.utcnow().date())
+        start = parse_request_date(data, 'start', end - datetime.timedelta(days=29))
+    except ValueError:
+        return jsonify({"data": None, "error": {"code": 400, "message": "Dates must be given as YYYY-MM-DD"}})
+    if resolution not in api.repository_collection.daily_aggregate_repository.resolutions:
+        return jsonify({"data": None, "error": {"code": 400, "message": "Unknown resolution {}".format(resolution)}})
+    graph = api.repository_collection.daily_aggregate_repository.get_user_graph(
+        ObjectId(user_id), start, end + datetime.timedelta(days=1), resolution)
+    response = jsonify({"data": graph, "start": start.isoformat(), "end": end.isoformat(),
+                        "resolution": resolution, "error": None})
+    # Repeat views of an unchanged graph only cost the aggregate lookup and a 304. Only GET requests with
+    # If-None-Match get one; the website sends the ETag of the graph it fetched last, and its token in the
+    # Authorization header, which the response varies on.
+    response.cache_control.private = True
+    response.vary.add('Authorization')
+    response.cache_control.max_age = api.config.get('GRAPH_CACHE_SECONDS', 60)
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @api.route('/users', methods=['POST'])
@@ -247,14 +295,13 @@ def link_device_to_room(room_id, device_id):
     room = api.room_repository.get_room_by_id(ObjectId(room_id))
     if room is None:
         return jsonify({"device": None, "error": {"code": 404, "message": "No such room found"}})
+    access = check_request_access({api.room_repository: [ObjectId(room_id)],
+                                   api.device_repository: [ObjectId(device_id)]})
+    if not access:
+        return jsonify({"device": None, "error": {"code": 401, "message": "Authentication failed"}})
     result = api.device_repository.link_device_to_room(ObjectId(room_id), ObjectId(device_id))
     if result is None:
         return jsonify({"device": None, "error": {"code": 404, "message": "No such device found."}})
-    access1 = api.room_repository.validate_token(ObjectId(room_id), get_request_token())
-    access2 = api.device_repository.validate_token(ObjectId(device_id), get_request_token())
-    if not access1 or not access2:
-        return jsonify({"device": None, "error": {"code": 401, "message": "Authentication failed"}})
-    room = api.room_repository.get_room_by_id(ObjectId(room_id))
     return jsonify({"device": result.get_device_attributes(), "error": None})
 
 
@@ -333,6 +380,31 @@ def get_actions_for_device(device_id):
     return jsonify({"triggers": [trigger.get_trigger_attributes() for trigger in triggers], "error": None})
 
 
+@api.route('/device/<string:device_id>/reachable', methods=['POST'])
+def get_reachable_actors(device_id):
+    # Devices the device acts on through chains of triggers, and those a new trigger of the device must not act
+    # on because they already act on the device.
+    access = api.device_repository.validate_token(ObjectId(device_id), get_request_token())
+    if not access:
+        return jsonify({"reachable": None, "error": {"code": 401, "message": "Authentication failed"}})
+    graph = api.trigger_repository.get_device_graph(ObjectId(device_id))
+    if graph is None:
+        return jsonify({"reachable": None, "error": {"code": 404, "message": "No such device found"}})
+    reachable_actors = graph.get_reachable(ObjectId(device_id))
+    loop_actors = graph.get_reachable(ObjectId(device_id), upstream=True) | {ObjectId(device_id)}
+    return jsonify({"reachable": {"reachable_actors": list(reachable_actors), "loop_actors": list(loop_actors),
+                                  "in_loop": ObjectId(device_id) in reachable_actors},
+                    "error": None})
+
+
+def get_loop_error(sensor_ids, actor_id):
+    loop = api.trigger_repository.find_trigger_loop(sensor_ids, actor_id)
+    if loop is None:
+        return None
+    return {"code": 409, "message": "Trigger would close a loop between devices {}".format(
+        " -> ".join(str(device_id) for device_id in loop + [actor_id]))}
+
+
 @api.route('/trigger/create', methods=['POST'])
 def add_new_trigger():
     data = request.get_json()
@@ -342,33 +414,65 @@ def add_new_trigger():
         return jsonify({"trigger": None, "error": {"code": 404, "message": "No such sensor found"}})
     if actor is None:
         return jsonify({"trigger": None, "error": {"code": 404, "message": "No such actor found"}})
-    access0 = api.user_repository.validate_token(ObjectId(data['user_id']), get_request_token())
-    access1 = api.device_repository.validate_token(ObjectId(data['sensor_id']), get_request_token())
-    access2 = api.device_repository.validate_token(ObjectId(data['actor_id']), get_request_token())
-    if not access0 or not access1 or not access2:
+    try:
+        rule_device_ids = get_rule_device_ids(data)
+    except RuleSyntaxError as ex:
+        return jsonify({"trigger": None, "error": {"code": 400, "message": "Invalid rule: {}".format(ex)}})
+    access = check_request_access({api.user_repository: [ObjectId(data['user_id'])],
+                                   api.device_repository: [ObjectId(data['sensor_id']), ObjectId(data['actor_id'])] +
+                                   rule_device_ids})
+    if not access:
         return jsonify({"trigger": None, "error": {"code": 401, "message": "Authentication failed"}})
+    loop_error = get_loop_error([ObjectId(data['sensor_id'])] + rule_device_ids, ObjectId(data['actor_id']))
+    if loop_error is not None:
+        return jsonify({"trigger": None, "error": loop_error})
     trigger_id = api.trigger_repository.add_trigger(ObjectId(data['sensor_id']), data['event'], data['event_params'],
                                                     ObjectId(data['actor_id']), data['action'], data['action_params'],
-                                                    ObjectId(data['user_id']))
+                                                    ObjectId(data['user_id']), data.get('hysteresis'),
+                                                    data.get('debounce'))
     trigger = api.trigger_repository.get_trigger_by_id(trigger_id)
     if trigger is None:
         return jsonify({"trigger": None, "error": {"code": 400, "message": "Trigger could not be added"}})
     return jsonify({"trigger": trigger.get_trigger_attributes(), "error": None})
 
 
+@api.route('/trigger/backtest', methods=['POST'])
+def backtest_trigger():
+    data = request.get_json()
+    access = check_request_access({api.device_repository: [ObjectId(data['sensor_id']), ObjectId(data['actor_id'])]})
+    if not access:
+        return jsonify({"backtest": None, "error": {"code": 401, "message": "Authentication failed"}})
+    try:
+        result = api.trigger_repository.backtest_trigger(
+            ObjectId(data['sensor_id']), data['event'], data['event_params'], ObjectId(data['actor_id']),
+            data['action'], data['action_params'], data.get('hysteresis'), data.get('debounce'),
+            float(data.get('days', api.config.get('TRIGGER_BACKTEST_DAYS', 7))))
+    except BacktestError as ex:
+        return jsonify({"backtest": None, "error": {"code": 400, "message": str(ex)}})
+    return jsonify({"backtest": result, "error": None})
+
+
 @api.route('/trigger/<string:trigger_id>/edit', methods=['POST'])
 def edit_trigger(trigger_id):
     data = request.get_json()
-    access1 = api.trigger_repository.validate_token(ObjectId(trigger_id), get_request_token())
-    access2 = api.device_repository.validate_token(ObjectId(data['sensor_id']), get_request_token())
-    access3 = api.device_repository.validate_token(ObjectId(data['actor_id']), get_request_token())
-    if not access1 or not access2 or not access3:
+    try:
+        rule_device_ids = get_rule_device_ids(data)
+    except RuleSyntaxError as ex:
+        return jsonify({"trigger": None, "error": {"code": 400, "message": "Invalid rule: {}".format(ex)}})
+    access = check_request_access({api.trigger_repository: [ObjectId(trigger_id)],
+                                   api.device_repository: [ObjectId(data['sensor_id']), ObjectId(data['actor_id'])] +
+                                   rule_device_ids})
+    if not access:
         return jsonify({"trigger": None, "error": {"code": 401, "message": "Authentication failed"}})
     trigger = api.trigger_repository.get_trigger_by_id(ObjectId(trigger_id))
     if trigger is None:
         return jsonify({"trigger": None, "error": {"code": 404, "message": "No such trigger found"}})
+    loop_error = get_loop_error([trigger.sensor_id] + rule_device_ids, trigger.actor_id)
+    if loop_error is not None:
+        return jsonify({"trigger": None, "error": loop_error})
     trigger = api.trigger_repository.edit_trigger(ObjectId(trigger_id), data['event'], data['event_params'],
-                                                  data['action'], data['action_params'])
+                                                  data['action'], data['action_params'], data.get('hysteresis'),
+                                                  data.get('debounce'))
     return jsonify({"trigger": trigger.get_trigger_attributes(), "error": None})
 
 
@@ -419,10 +523,10 @@ def get_theme_info(theme_id):
 @api.route('/theme/create', methods=['POST'])
 def add_new_theme():
     data = request.get_json()
-    for dev_id in data['settings']:
-        access = api.device_repository.validate_token(ObjectId(dev_id), get_request_token())
-        if not access:
-            return jsonify({"theme": None, "error": {"code": 401, "message": "Authentication failed"}})
+    access = check_request_access({api.user_repository: [ObjectId(data['user_id'])],
+                                   api.device_repository: get_theme_device_ids(data['settings'])})
+    if not access:
+        return jsonify({"theme": None, "error": {"code": 401, "message": "Authentication failed"}})
     theme_id = api.theme_repository.add_theme(ObjectId(data['user_id']), data['name'], data['settings'],
                                               ObjectId(data['active']))
     theme = api.theme_repository.get_theme_by_id(theme_id)
@@ -434,10 +538,10 @@ def add_new_theme():
 @api.route('/theme/<string:theme_id>/edit', methods=['POST'])
 def edit_theme(theme_id):
     data = request.get_json()
-    for dev_id in data['settings']:
-        access = api.device_repository.validate_token(ObjectId(dev_id), get_request_token())
-        if not access:
-            return jsonify({"theme": None, "error": {"code": 401, "message": "Authentication failed"}})
+    access = check_request_access({api.theme_repository: [ObjectId(theme_id)],
+                                   api.device_repository: get_theme_device_ids(data['settings'])})
+    if not access:
+        return jsonify({"theme": None, "error": {"code": 401, "message": "Authentication failed"}})
     theme = api.theme_repository.get_theme_by_id(theme_id)
     if theme is None:
         return jsonify({"theme": None, "error": {"code": 404, "message": "No such theme found"}})
@@ -480,52 +584,61 @@ def remove_theme(theme_id):
 
 @api.route('/theme/<string:theme_id>/activate', methods=['POST'])
 def activate_theme(theme_id):
-    access = api.theme_repository.validate_token(ObjectId(theme_id), get_request_token())
+    theme = api.theme_repository.get_theme_by_id(ObjectId(theme_id))
+    if theme is None:
+        return jsonify({"theme": None, "error": {"code": 404, "message": "No such theme found"}})
+    access = check_request_access({api.theme_repository: [ObjectId(theme_id)],
+                                   api.device_repository: get_theme_device_ids(theme.settings)})
     if not access:
         return jsonify({"theme": None, "error": {"code": 401, "message": "Authentication failed"}})
-    theme = api.theme_repository.get_theme_by_id(theme_id)
-    for dev_id in theme.settings:
-        access = api.device_repository.validate_token(ObjectId(dev_id), get_request_token())
-        if not access:
-            return jsonify({"theme": None, "error": {"code": 401, "message": "Authentication failed"}})
     result = api.theme_repository.change_theme_state(theme_id, True)
     return jsonify({"theme": result, "error": None})
 
 
 @api.route('/theme/<string:theme_id>/deactivate', methods=['POST'])
 def deactivate_theme(theme_id):
-    access = api.theme_repository.validate_token(ObjectId(theme_id), get_request_token())
+    theme = api.theme_repository.get_theme_by_id(ObjectId(theme_id))
+    if theme is None:
+        return jsonify({"theme": None, "error": {"code": 404, "message": "No such theme found"}})
+    access = check_request_access({api.theme_repository: [ObjectId(theme_id)],
+                                   api.device_repository: get_theme_device_ids(theme.settings)})
     if not access:
         return jsonify({"theme": None, "error": {"code": 401, "message": "Authentication failed"}})
-    theme = api.theme_repository.get_theme_by_id(theme_id)
-    for dev_id in theme.settings:
-        access = api.device_repository.validate_token(ObjectId(dev_id), get_request_token())
-        if not access:
-            return jsonify({"theme": None, "error": {"code": 401, "message": "Authentication failed"}})
     result = api.theme_repository.change_theme_state(theme_id, False)
     return jsonify({"theme": result, "error": None})
 
 
+def get_fault_attributes(device):
+    last_read = device.status.get('last_read')
+    return {'user_id': device.owner_user_id, 'house_id': device.house_id, 'device_id': device.device_id,
+            'device_type': device.device_type, 'vendor': device.vendor, 'fault_since': device.fault_since,
+            'fault': last_read.get('error') if isinstance(last_read, dict) else None}
+
+
+def get_request_page():
+    # Raises ValueError for a page or page size that is not a number or a negative page. The page size is clamped
+    # to FAULTS_MAX_PAGE_SIZE.
+    data = request.get_json() or {}
+    page = int(data.get('page', 0))
+    page_size = int(data.get('page_size', api.config.get('FAULTS_PAGE_SIZE', 50)))
+    if page < 0:
+        raise ValueError("Page must not be negative")
+    return page, max(1, min(page_size, api.config.get('FAULTS_MAX_PAGE_SIZE', 200)))
+
+
 @api.route('/user/<string:user_id>/faults', methods=['POST'])
 def faulty_user_devices(user_id):
     access = api.token_repository.authenticate_admin(get_request_token())
     if not access:
         return jsonify({"devices": None, "error": {"code": 401, "message": "Authentication failed"}})
-    faulty_devices = api.user_repository.get_faulty_devices_for_user(user_id)
-    devices = []
-    if faulty_devices is None:
-        return jsonify({"devices": None, "error": None})
-    else:
-        for device in faulty_devices:
-            attributes = device.get_device_attributes()
-            faulty_device = dict()
-            faulty_device['user_id'] = attributes['user_id']
-            faulty_device['device_id'] = attributes['device_id']
-            faulty_device['device_type'] = attributes['device_type']
-            faulty_device['vendor'] = attributes['vendor']
-            faulty_device['fault'] = attributes['fault']
-            devices.append(faulty_device)
-        return jsonify({"devices": devices, "error": None})
+    try:
+        page, page_size = get_request_page()
+    except (TypeError, ValueError):
+        return jsonify({"devices": None, "error": {"code": 400, "message": "Invalid page or page size"}})
+    faulty_devices = api.user_repository.get_faulty_devices_for_user(ObjectId(user_id), page, page_size)
+    total = api.device_repository.count_faulty_devices({'owner_user_id': ObjectId(user_id)})
+    return jsonify({"devices": [get_fault_attributes(device) for device in faulty_devices],
+                    "page": page, "page_size": page_size, "total": total, "error": None})
 
 
 @api.route('/admin/faults', methods=['POST'])
@@ -533,21 +646,14 @@ def all_faulty_devices():
     access = api.token_repository.authenticate_admin(get_request_token())
     if not access:
         return jsonify({"devices": None, "error": {"code": 401, "message": "Authentication failed"}})
-    devices = []
-    faulty_devices = api.device_repository.get_faulty_devices()
-    if faulty_devices is None:
-        return jsonify({"devices": None, "error": None})
-    else:
-        for device in faulty_devices:
-            attributes = device.get_device_attributes()
-            faulty_device = dict()
-            faulty_device['user_id'] = attributes['user_id']
-            faulty_device['device_id'] = attributes['device_id']
-            faulty_device['device_type'] = attributes['device_type']
-            faulty_device['vendor'] = attributes['vendor']
-            faulty_device['fault'] = attributes['fault']
-            devices.append(faulty_device)
-        return jsonify({"devices": devices, "error": None})
+    try:
+        page, page_size = get_request_page()
+    except (TypeError, ValueError):
+        return jsonify({"devices": None, "error": {"code": 400, "message": "Invalid page or page size"}})
+    faulty_devices = api.device_repository.get_faulty_devices(page, page_size)
+    total = api.device_repository.count_faulty_devices()
+    return jsonify({"devices": [get_fault_attributes(device) for device in faulty_devices],
+                    "page": page, "page_size": page_size, "total": total, "error": None})
 
 
 @api.route('/admin/graph')
@@ -562,6 +668,14 @@ def get_overall_consumption():
     return jsonify({"consumption": overall_consumption, "error": None})
 
 
+@api.route('/admin/triggers/queue', methods=['POST'])
+def get_trigger_queue_depths():
+    access = api.token_repository.authenticate_admin(get_request_token())
+    if not access:
+        return jsonify({"queue": None, "error": {"code": 401, "message": "Authentication failed"}})
+    return jsonify({"queue": api.trigger_repository.get_queue_depths(), "error": None})
+
+
 @api.route('/login', methods=['POST'])
 def login():
     login_data = request.get_json()
@@ -1,8 +1,6 @@
-import datetime
 import time
-from datetime import timedelta
 
-import requests
+from vendors import get_vendor_adapter
 
 
 def get_optional_attribute(attributes, key, default_value=None):
@@ -66,129 +64,101 @@ class Room(object):
     def __init__(self, attributes):
         self.room_id = None
         self.house_id = None
+        self.owner_user_id = None
         self.name = None
         self.set_attributes(attributes)
 
     def set_attributes(self, attributes):
         self.room_id = attributes['_id']
         self.house_id = attributes['house_id']
+        self.owner_user_id = get_optional_attribute(attributes, 'owner_user_id', None)
         self.name = attributes['name']
 
     def get_room_attributes(self):
-        return {'room_id': self.room_id, 'house_id': self.house_id, 'name': self.name}
+        return {'room_id': self.room_id, 'house_id': self.house_id, 'owner_user_id': self.owner_user_id,
+                'name': self.name}
 
     def get_room_id(self):
         return self.room_id
 
 
 class Device(object):
+    # Fields of the desired state in 'target' that are pushed to the device and, once it took them, reported in
+    # 'status', with the vendor operation pushing them.
+    shadow_operations = {}
+
     def __init__(self, attributes):
         self.device_id = None
         self.house_id = None
         self.room_id = None
+        self.owner_user_id = None
         self.name = None
         self.device_type = None
         self.vendor = None
         self.configuration = None
         self.locking_theme_id = None
         self.faulty = None
+        self.fault_since = None
         self.target = {}
         self.status = {}
+        self.shadow = {}
         self.set_attributes(attributes)
 
     def set_attributes(self, attributes):
         self.device_id = attributes['_id']
         self.house_id = attributes['house_id']
         self.room_id = attributes['room_id']
+        self.owner_user_id = get_optional_attribute(attributes, 'owner_user_id', None)
         self.name = attributes['name']
         self.device_type = attributes['device_type']
         self.locking_theme_id = get_optional_attribute(attributes, 'locking_theme_id', None)
         self.faulty = get_optional_attribute(attributes, 'faulty', False)
+        self.fault_since = get_optional_attribute(attributes, 'fault_since', None)
         self.target = get_optional_attribute(attributes, 'target', {})
         self.status = get_optional_attribute(attributes, 'status', {})
+        self.shadow = get_optional_attribute(attributes, 'shadow', {})
         self.vendor = get_optional_attribute(attributes, 'vendor', None)
         self.configuration = get_optional_attribute(attributes, 'configuration', None)
 
     def get_device_attributes(self):
         return {'device_id': self.device_id, 'house_id': self.house_id,
-                'room_id': self.room_id, 'name': self.name, 'device_type': self.device_type,
-                'locking_theme_id': self.locking_theme_id, 'faulty': self.faulty, 'target': self.target,
-                'status': self.status, 'vendor': self.vendor, 'configuration': self.configuration}
+                'room_id': self.room_id, 'owner_user_id': self.owner_user_id, 'name': self.name,
+                'device_type': self.device_type,
+                'locking_theme_id': self.locking_theme_id, 'faulty': self.faulty,
+                'fault_since': self.fault_since, 'target': self.target, 'status': self.status,
+                'shadow': self.shadow, 'vendor': self.vendor, 'configuration': self.configuration}
 
     def get_device_id(self):
         return self.device_id
 
-    def read_current_state(self, include_usage_data=0):
-        error = None
-        data = None
+    def can_push(self, field):
+        return field in self.shadow_operations and \
+            get_vendor_adapter(self.vendor, self.shadow_operations[field]) is not None
+
+    def get_unreported_state(self):
+        return {field: self.target[field] for field in self.shadow_operations
+                if field in self.target and self.status.get(field) != self.target[field]}
+
+    def push_desired_state(self, field, value, timeout=None):
+        # Returns the error, or None once the device took the value.
+        return "Device type does not support desired state"
+
+    def read_current_state(self, include_usage_data=0, timeout=None):
         timestamp = str(time.time())
-        if self.vendor == "OWN":
-            if "url" in self.configuration:
-                url = self.configuration['url']
-                try:
-                    r = requests.get(url)
-                    r_data = r.json()
-                    if "error" in r_data and r_data["error"] is not None:
-                        error = r_data["error"]
-                    else:
-                        data = r_data['data']
-                except Exception as ex:
-                    error = "Cannot read data from configuration URL: {}".format(ex)
-            else:
-                error = "Can't read current state as no url is set in configuration"
-        elif self.vendor == "energenie":
-            if "username" in self.configuration and "password" in self.configuration and "device_id" in self.configuration:
-                try:
-                    username = self.configuration['username']
-                    password = self.configuration['password']
-                    dev_id = int(self.configuration['device_id'])
-                    r = requests.get("https://mihome4u.co.uk/api/v1/subdevices/show", auth=(username, password),
-                                     json={"id": dev_id, "include_usage_data": include_usage_data})
-                    r_data = r.json()
-                    if r_data["status"] != "success":
-                        error = "External error: {}".format(r_data['status'])
-                    else:
-                        data = {'power_state': r_data['data']['power_state'], 'voltage': r_data['data']['voltage']}
-                except Exception as ex:
-                    error = "Cannot read device data from URL: {}".format(ex)
-            else:
-                error = "Not all required information is set in the configuration"
-        else:
-            error = "read_current_state not implemented for vendor {}".format(self.vendor)
+        adapter = get_vendor_adapter(self.vendor, 'read')
+        if adapter is None:
+            return {"error": "read_current_state not implemented for vendor {}".format(self.vendor),
+                    "timestamp": timestamp}
+        data, error = adapter.read_state(self, include_usage_data=include_usage_data, timeout=timeout)
         if error is not None:
             return {"error": error, "timestamp": timestamp}
         return {"data": data, "timestamp": timestamp}
 
-    def get_energy_readings(self):
-        error = None
-        data = None
-        if self.vendor == "energenie":
-            if "username" in self.configuration and "password" in self.configuration and "device_id" in self.configuration:
-                try:
-                    username = self.configuration['username']
-                    password = self.configuration['password']
-                    dev_id = int(self.configuration['device_id'])
-                    date_format = "%Y-%m-%dT%H:%M:%S.%f%Z"
-                    json_data = {"id": dev_id,
-                                 "data_type": "watts",
-                                 "resolution": "daily",
-                                 "start_time": ((datetime.datetime.now() - timedelta(days=7)).strftime(date_format)),
-                                 "end_time": (datetime.datetime.now().strftime(date_format)),
-                                 "limit": 7}
-                    r = requests.get(
-                        "https://mihome4u.co.uk/api/v1/subdevices/get_data",
-                        auth=(username, password),
-                        json=json_data
-                    )
-                    data = r.json()
-                    if data['status'] != "success":
-                        error = "External error: {}".format(data['status'])
-                except Exception as ex:
-                    error = "Cannot get energy reading: {}".format(ex)
-            else:
-                error = "Not all required information is set in the configuration"
-        else:
-            error = "get_energy_reading not implemented for vendor {}".format(self.vendor)
+    def get_energy_readings(self, timeout=None, start=None, end=None):
+        adapter = get_vendor_adapter(self.vendor, 'energy')
+        if adapter is None:
+            return {"error": "get_energy_reading not implemented for vendor {}".format(self.vendor)}
+        data, error = adapter.get_energy_readings(self, timeout=timeout, start=start, end=end)
         if error is not None:
             return {"error": error}
         return {"data": data}
@@ -200,6 +170,8 @@ class Device(object):
 
 
 class Thermostat(Device):
+    shadow_operations = {'target_temperature': 'target_temperature'}
+
     def __init__(self, attributes):
         Device.__init__(self, attributes)
 
@@ -215,45 +187,18 @@ class Thermostat(Device):
         })
         return attributes
 
-    def configure_target_temperature(self, temperature):
-        error = None
-        data = None
+    def configure_target_temperature(self, temperature, timeout=None):
         timestamp = str(time.time())
-        if self.vendor == "OWN":
-            if "url" in self.configuration:
-                url = self.configuration['url'] + "/write"
-                try:
-                    r = requests.post(url, json={"target_temperature": temperature})
-                    r_data = r.json()
-                    if "error" in r_data and r_data["error"] is not None:
-                        error = r_data["error"]
-                except Exception as ex:
-                    error = "Cannot configure target temperature from configuration URL: {}".format(ex)
-            else:
-                error = "Can't configure target temperature as no url is set in configuration"
-        elif self.vendor == "energenie":
-            if "username" in self.configuration and "password" in self.configuration and "device_id" in self.configuration:
-                try:
-                    username = self.configuration['username']
-                    password = self.configuration['password']
-                    dev_id = int(self.configuration['device_id'])
-                    r = requests.get("https://mihome4u.co.uk/api/v1/subdevices/set_target_temperature",
-                                     auth=(username, password),
-                                     json={"id": dev_id, "temperature": temperature})
-                    r_data = r.json()
-                    if r_data["status"] != "success":
-                        error = "External error: {}".format(r_data['status'])
-                    else:
-                        data = {'target_temperature': r_data['data']['target_temperature'],
-                                'voltage': r_data['data']['voltage']}
-                except Exception as ex:
-                    error = "Cannot read device data from URL: {}".format(ex)
-            else:
-                error = "Not all required information is set in the configuration"
-        else:
-            error = "configure_target_temperature not implemented for vendor {}".format(self.vendor)
+        adapter = get_vendor_adapter(self.vendor, 'target_temperature')
+        if adapter is None:
+            return {"error": "configure_target_temperature not implemented for vendor {}".format(self.vendor),
+                    "data": None, "timestamp": timestamp}
+        data, error = adapter.set_target_temperature(self, temperature, timeout=timeout)
         return {"error": error, "data": data, "timestamp": timestamp}
 
+    def push_desired_state(self, field, value, timeout=None):
+        return self.configure_target_temperature(value, timeout=timeout)['error']
+
 
 class MotionSensor(Device):
     def __init__(self, attributes):
@@ -271,6 +216,8 @@ class MotionSensor(Device):
 
 
 class LightSwitch(Device):
+    shadow_operations = {'power_state': 'power_state'}
+
     def __init__(self, attributes):
         Device.__init__(self, attributes)
 
@@ -281,29 +228,16 @@ class LightSwitch(Device):
         attributes = Device.get_device_attributes(self)
         return attributes
 
-    def configure_power_state(self, power_state):
-        error = None
-        if self.vendor == "energenie":
-            if "username" in self.configuration and "password" in self.configuration and "device_id" in self.configuration:
-                try:
-                    username = self.configuration['username']
-                    password = self.configuration['password']
-                    dev_id = int(self.configuration['device_id'])
-                    r = requests.get(
-                        "https://mihome4u.co.uk/api/v1/subdevices/power_{}".format("on" if power_state == 1 else "off"),
-                        auth=(username, password),
-                        json={"id": dev_id})
-                    r_data = r.json()
-                    if r_data["status"] != "success":
-                        error = "External error: {}".format(r_data['status'])
-                except Exception as ex:
-                    error = "Cannot configure power state: {}".format(ex)
-            else:
-                error = "Not all required information is set in the configuration"
-        else:
-            error = "configure_power_state not implemented for vendor {}".format(self.vendor)
+    def configure_power_state(self, power_state, timeout=None):
+        adapter = get_vendor_adapter(self.vendor, 'power_state')
+        if adapter is None:
+            return "configure_power_state not implemented for vendor {}".format(self.vendor)
+        data, error = adapter.set_power_state(self, power_state, timeout=timeout)
         return error
 
+    def push_desired_state(self, field, value, timeout=None):
+        return self.configure_power_state(value, timeout=timeout)
+
 
 class OpenSensor(Device):
     def __init__(self, attributes):
@@ -331,6 +265,9 @@ class Trigger:
         self.action_params = None
         self.user_id = None
         self.reading = None
+        self.hysteresis = None
+        self.debounce = None
+        self.state = None
         self.set_attributes(attributes)
 
     def set_attributes(self, attributes):
@@ -343,12 +280,16 @@ class Trigger:
         self.action_params = attributes['action_params']
         self.user_id = attributes['user_id']
         self.reading = attributes['reading']
+        self.hysteresis = get_optional_attribute(attributes, 'hysteresis', None)
+        self.debounce = get_optional_attribute(attributes, 'debounce', None)
+        self.state = get_optional_attribute(attributes, 'state', None) or {'active': None, 'last_fired': None, 'due_at': None}
 
     def get_trigger_attributes(self):
         return {'trigger_id': self.trigger_id, 'sensor_id': self.sensor_id,
                 'event': self.event, 'event_params': self.event_params, 'actor_id': self.actor_id,
                 'action': self.action, 'action_params': self.action_params, 'user_id': self.user_id,
-                'reading': self.reading}
+                'reading': self.reading, 'hysteresis': self.hysteresis, 'debounce': self.debounce,
+                'state': self.state}
 
 
 class Theme:
@@ -386,3 +327,72 @@ class Token:
 
     def get_token_attributes(self):
         return {'_id': self.token_id, 'user_id': self.user_id, 'key': self.token}
+
+
+class ReadingBucket:
+    def __init__(self, attributes):
+        self.bucket_id = None
+        self.device_id = None
+        self.house_id = None
+        self.room_id = None
+        self.owner_user_id = None
+        self.device_type = None
+        self.bucket_start = None
+        self.timestamps = []
+        self.values = []
+        self.set_attributes(attributes)
+
+    def set_attributes(self, attributes):
+        self.bucket_id = attributes['_id']
+        self.device_id = attributes['device_id']
+        self.house_id = attributes['house_id']
+        self.room_id = get_optional_attribute(attributes, 'room_id', None)
+        self.owner_user_id = get_optional_attribute(attributes, 'owner_user_id', None)
+        self.device_type = get_optional_attribute(attributes, 'device_type', None)
+        self.bucket_start = attributes['bucket_start']
+        self.timestamps = get_optional_attribute(attributes, 'timestamps', [])
+        self.values = get_optional_attribute(attributes, 'values', [])
+
+    def get_reading_bucket_attributes(self):
+        return {'bucket_id': self.bucket_id, 'device_id': self.device_id, 'house_id': self.house_id,
+                'room_id': self.room_id, 'owner_user_id': self.owner_user_id,
+                'device_type': self.device_type, 'bucket_start': self.bucket_start,
+                'timestamps': self.timestamps, 'values': self.values}
+
+    def get_readings(self, start=None, end=None):
+        # (timestamp, value) pairs of this bucket, optionally limited to [start, end) in epoch seconds.
+        return [(timestamp, value) for timestamp, value in zip(self.timestamps, self.values)
+                if (start is None or timestamp >= start) and (end is None or timestamp < end)]
+
+
+class ReadingRollup:
+    def __init__(self, attributes):
+        self.rollup_id = None
+        self.device_id = None
+        self.house_id = None
+        self.room_id = None
+        self.owner_user_id = None
+        self.device_type = None
+        self.tier = None
+        self.period_start = None
+        self.count = 0
+        self.fields = {}
+        self.set_attributes(attributes)
+
+    def set_attributes(self, attributes):
+        self.rollup_id = attributes['_id']
+        self.device_id = attributes['device_id']
+        self.house_id = attributes['house_id']
+        self.room_id = get_optional_attribute(attributes, 'room_id', None)
+        self.owner_user_id = get_optional_attribute(attributes, 'owner_user_id', None)
+        self.device_type = get_optional_attribute(attributes, 'device_type', None)
+        self.tier = attributes['tier']
+        self.period_start = attributes['period_start']
+        self.count = get_optional_attribute(attributes, 'count', 0)
+        self.fields = get_optional_attribute(attributes, 'fields', {})
+
+    def get_reading_rollup_attributes(self):
+        return {'rollup_id': self.rollup_id, 'device_id': self.device_id, 'house_id': self.house_id,
+                'room_id': self.room_id, 'owner_user_id': self.owner_user_id,
+                'device_type': self.device_type, 'tier': self.tier,
+                'period_start': self.period_start, 'count': self.count, 'fields': self.fields}
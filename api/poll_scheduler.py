@@ -0,0 +1,135 @@
+import heapq
+import itertools
+import threading
+import time
+
+# Shortest and longest polling interval in seconds per device type. A device starts at the shortest
+# interval, backs off towards the longest one while its readings stay the same and drops back to the
+# shortest one as soon as a reading changes or a user sends it a command.
+DEFAULT_POLL_INTERVALS = {
+    'motion_sensor': (5, 60),
+    'open_sensor': (5, 60),
+    'light_switch': (30, 300),
+    'thermostat': (120, 900),
+}
+DEFAULT_POLL_INTERVAL = (60, 600)
+
+
+def get_reading_values(reading):
+    if not isinstance(reading, dict):
+        return None
+    if reading.get('error') is not None:
+        return {'error': reading['error']}
+    data = reading.get('data')
+    if isinstance(data, dict):
+        # Sensors report their own timestamp with every reading, which should not count as a change.
+        return {key: value for key, value in data.items() if key != 'timestamp'}
+    return data
+
+
+def has_reading_changed(previous_reading, reading):
+    return get_reading_values(previous_reading) != get_reading_values(reading)
+
+
+class PollScheduler(object):
+    def __init__(self, intervals=None, backoff_factor=1.5):
+        self.intervals = dict(DEFAULT_POLL_INTERVALS)
+        if intervals is not None:
+            self.intervals.update(intervals)
+        self.backoff_factor = backoff_factor
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def get_interval_bounds(self, device_type):
+        return self.intervals.get(device_type, DEFAULT_POLL_INTERVAL)
+
+    def push(self, device_id, due):
+        # Entries are never removed from the heap directly: rescheduling pushes a new entry with a fresh
+        # sequence number and stale ones are skipped when they reach the top.
+        entry = self.entries[device_id]
+        entry['due'] = due
+        entry['sequence'] = next(self.counter)
+        heapq.heappush(self.heap, (due, entry['sequence'], device_id))
+
+    def schedule(self, device_id, device_type, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.add_entry(device_id, device_type, now)
+
+    def add_entry(self, device_id, device_type, now):
+        if device_id in self.entries:
+            self.entries[device_id]['device_type'] = device_type
+            return
+        self.entries[device_id] = {'device_type': device_type,
+                                   'interval': self.get_interval_bounds(device_type)[0],
+                                   'due': None, 'sequence': None}
+        self.push(device_id, now)
+
+    def remove(self, device_id):
+        with self.lock:
+            self.entries.pop(device_id, None)
+
+    def sync(self, devices, now=None):
+        # devices: iterable of (device_id, device_type)
+        now = time.time() if now is None else now
+        device_types = dict(devices)
+        with self.lock:
+            for device_id in [device_id for device_id in self.entries if device_id not in device_types]:
+                del self.entries[device_id]
+            for device_id, device_type in device_types.items():
+                self.add_entry(device_id, device_type, now)
+
+    def pop_due(self, now=None, limit=None):
+        now = time.time() if now is None else now
+        due_devices = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now and (limit is None or len(due_devices) < limit):
+                due, sequence, device_id = heapq.heappop(self.heap)
+                entry = self.entries.get(device_id)
+                if entry is None or entry['sequence'] != sequence:
+                    continue
+                # Not due again until its reading has been recorded.
+                entry['sequence'] = None
+                due_devices.append(device_id)
+        return due_devices
+
+    def record_reading(self, device_id, changed, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.get(device_id)
+            if entry is None:
+                return None
+            shortest, longest = self.get_interval_bounds(entry['device_type'])
+            if changed:
+                entry['interval'] = shortest
+            else:
+                entry['interval'] = min(longest, entry['interval'] * self.backoff_factor)
+            self.push(device_id, now + entry['interval'])
+            return entry['interval']
+
+    def record_command(self, device_id, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.get(device_id)
+            if entry is None:
+                return
+            shortest = self.get_interval_bounds(entry['device_type'])[0]
+            entry['interval'] = shortest
+            if entry['sequence'] is not None and entry['due'] > now + shortest:
+                self.push(device_id, now + shortest)
+
+    def get_next_due(self):
+        with self.lock:
+            while self.heap:
+                due, sequence, device_id = self.heap[0]
+                entry = self.entries.get(device_id)
+                if entry is not None and entry['sequence'] == sequence:
+                    return due
+                heapq.heappop(self.heap)
+        return None
+
+    def get_interval(self, device_id):
+        entry = self.entries.get(device_id)
+        return entry['interval'] if entry is not None else None
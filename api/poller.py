@@ -0,0 +1,86 @@
+import concurrent.futures
+import logging
+import time
+
+from vendors import get_vendor_adapter
+
+
+class DevicePoller(object):
+    def __init__(self, max_workers=16, call_timeout=10, cycle_budget=90):
+        self.max_workers = max_workers
+        self.call_timeout = call_timeout
+        self.cycle_budget = cycle_budget
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def read_device(self, device):
+        try:
+            return device.read_current_state(timeout=self.call_timeout)
+        except Exception as ex:
+            return {"error": "Cannot read current state: {}".format(ex), "timestamp": str(time.time())}
+
+    def read_devices(self, devices):
+        if len(devices) == 1:
+            return {devices[0].get_device_id(): self.read_device(devices[0])}
+        try:
+            return get_vendor_adapter(devices[0].vendor, 'read').read_states(devices, timeout=self.call_timeout)
+        except Exception as ex:
+            timestamp = str(time.time())
+            return {device.get_device_id(): {"error": "Cannot read current state: {}".format(ex),
+                                             "timestamp": timestamp} for device in devices}
+
+    @staticmethod
+    def group_devices(devices):
+        # Devices whose vendor adapter can read them together (e.g. Energenie devices sharing an account)
+        # are read with a single call, everything else on its own.
+        groups = []
+        batches = {}
+        for device in devices:
+            adapter = get_vendor_adapter(device.vendor, 'read')
+            batch_key = adapter.get_batch_key(device) if adapter is not None else None
+            if batch_key is None:
+                groups.append([device])
+            elif batch_key in batches:
+                batches[batch_key].append(device)
+            else:
+                batches[batch_key] = [device]
+                groups.append(batches[batch_key])
+        return groups
+
+    def poll(self, devices):
+        # Groups are read concurrently on at most max_workers threads, so a cycle takes about as long as the
+        # slowest group times the number of groups per thread instead of the sum of all of them. Groups still
+        # queued or running when the cycle budget runs out are cancelled and their devices get an error reading
+        # for this cycle, which reschedules them like any other reading.
+        start = time.time()
+        futures = {self.executor.submit(self.read_devices, group): group for group in self.group_devices(devices)}
+        done, not_done = concurrent.futures.wait(futures, timeout=self.cycle_budget)
+        readings = {}
+        for future in done:
+            readings.update(future.result())
+        for future in not_done:
+            future.cancel()
+            for device in futures[future]:
+                logging.warning("Device {} did not answer within the poll cycle budget".format(device.get_device_id()))
+                readings[device.get_device_id()] = {
+                    "error": "No reading within the poll cycle budget of {} seconds".format(self.cycle_budget),
+                    "timestamp": str(time.time())}
+        logging.debug("Polled {} devices in {} calls in {:.2f} seconds ({} calls timed out)".format(
+            len(readings), len(futures), time.time() - start, len(not_done)))
+        return readings
+
+    def get_energy_readings(self, devices, start_times=None):
+        # Same budget as a poll cycle: devices that have not answered in time are left out with an error.
+        # start_times optionally maps a device id to the (local) datetime its readings should start at.
+        start_times = start_times or {}
+        futures = {self.executor.submit(device.get_energy_readings, self.call_timeout,
+                                        start_times.get(device.get_device_id())): device for device in devices}
+        done, not_done = concurrent.futures.wait(futures, timeout=self.cycle_budget)
+        readings = {futures[future].get_device_id(): future.result() for future in done}
+        for future in not_done:
+            future.cancel()
+            readings[futures[future].get_device_id()] = {
+                "error": "No energy reading within the poll cycle budget of {} seconds".format(self.cycle_budget)}
+        return readings
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
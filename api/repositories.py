@@ -1,11 +1,49 @@
+import collections
 import datetime
 import logging
+import multiprocessing
 import random
 import string
+import threading
+import time
 
 import bcrypt
-
-from model import House, Room, User, Device, Thermostat, MotionSensor, LightSwitch, OpenSensor, Trigger, Theme, Token
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.write_concern import WriteConcern
+
+from access_tokens import RevocationFilter, get_token_hash, is_signed_token, sign_access_token, \
+    verify_access_token
+from action_dispatcher import ActionDispatcher
+import backtest
+from model import House, Room, User, Device, Thermostat, MotionSensor, LightSwitch, OpenSensor, Trigger, Theme, Token, \
+    ReadingBucket, ReadingRollup, get_optional_attribute
+from poll_scheduler import PollScheduler, get_reading_values, has_reading_changed
+from poller import DevicePoller
+import rollups
+from trigger_engine import TriggerEngine, get_trigger_sensor_ids, trigger_actions
+from trigger_graph import TriggerGraph
+from trigger_workers import TriggerWorkerPool
+import vendor_http
+from vendors import get_vendor_adapter, get_vendor_names, configure_vendor_adapters
+
+
+def get_trigger_engine_options(config):
+    return {'default_hysteresis': get_optional_attribute(config, 'TRIGGER_HYSTERESIS', 0.0),
+            'default_debounce': get_optional_attribute(config, 'TRIGGER_DEBOUNCE_SECONDS', 0),
+            'timer_tick': get_optional_attribute(config, 'TRIGGER_TIMER_TICK_SECONDS', 1.0)}
+
+
+def create_trigger_worker_pool(config):
+    # The pool for TRIGGER_WORKER_PROCESSES, one worker per CPU by default, or None to evaluate triggers in
+    # process if it is 0. Its workers are forked, so this has to be called before the process starts any threads
+    # (the Mongo client starts some).
+    worker_count = get_optional_attribute(config, 'TRIGGER_WORKER_PROCESSES', multiprocessing.cpu_count())
+    if worker_count <= 0:
+        return None
+    return TriggerWorkerPool(worker_count, timeout=get_optional_attribute(config, 'TRIGGER_WORKER_TIMEOUT_SECONDS', 30),
+                             **get_trigger_engine_options(config))
 
 
 class RepositoryException(Exception):
@@ -15,6 +53,9 @@ class RepositoryException(Exception):
 
 
 class Repository(object):
+    indexes = []
+    owner_field = None
+
     def __init__(self, mongo_collection, repository_collection):
         self.collection = mongo_collection
         self.repositories = repository_collection
@@ -22,10 +63,55 @@ class Repository(object):
     def clear_db(self):
         self.collection.delete_many({})
 
+    def ensure_indexes(self):
+        # create_indexes is a no-op for indexes that already exist with the same definition.
+        for index in self.indexes:
+            try:
+                self.collection.create_indexes([index])
+            except OperationFailure as ex:
+                logging.error("Cannot create index {} on {}: {}".format(index.document['name'],
+                                                                       self.collection.name, ex))
+
+    def all_exist(self, entity_ids, query=None):
+        entity_ids = list(set(entity_ids))
+        if len(entity_ids) == 0:
+            return True
+        query = dict(query or {}, _id={'$in': entity_ids})
+        return len(list(self.collection.find(query, {'_id': 1}))) == len(entity_ids)
+
+    def are_owned_by(self, entity_ids, user_id):
+        return self.all_exist(entity_ids, {self.owner_field: user_id})
+
+    def validate_token(self, entity_id, token):
+        return self.repositories.check_access(token, {self: [entity_id]})
+
+    def get_missing_indexes(self):
+        existing_indexes = self.collection.index_information()
+        return [index.document['name'] for index in self.indexes if index.document['name'] not in existing_indexes]
+
+    def get_unused_indexes(self):
+        index_stats = self.collection.aggregate([{'$indexStats': {}}])
+        return [stats['name'] for stats in index_stats if stats['name'] != '_id_' and stats['accesses']['ops'] == 0]
+
 
 class RepositoryCollection(object):
-    def __init__(self, db):
+    def __init__(self, db, config=None, trigger_worker_pool=None):
         self.db = db
+        self.config = config if config is not None else {}
+        self.trigger_worker_pool = trigger_worker_pool
+        vendor_http.configure(pool_size=get_optional_attribute(self.config, 'VENDOR_HTTP_POOL_SIZE', 16),
+                              timeout=get_optional_attribute(self.config, 'VENDOR_HTTP_TIMEOUT', 10),
+                              keep_alive=get_optional_attribute(self.config, 'VENDOR_HTTP_KEEP_ALIVE', True))
+        configure_vendor_adapters(self.config)
+        self.device_poller = DevicePoller(max_workers=get_optional_attribute(self.config, 'POLL_MAX_WORKERS', 16),
+                                          call_timeout=get_optional_attribute(self.config, 'POLL_CALL_TIMEOUT', 10),
+                                          cycle_budget=get_optional_attribute(self.config, 'POLL_CYCLE_BUDGET', 90))
+        self.action_dispatcher = ActionDispatcher(
+            max_workers=get_optional_attribute(self.config, 'TRIGGER_ACTION_WORKERS', 4),
+            window=get_optional_attribute(self.config, 'TRIGGER_ACTION_WINDOW_SECONDS', 1))
+        self.poll_scheduler = PollScheduler(intervals=get_optional_attribute(self.config, 'POLL_INTERVALS', None),
+                                            backoff_factor=get_optional_attribute(self.config, 'POLL_BACKOFF_FACTOR',
+                                                                                  1.5))
         self.user_repository = UserRepository(db.users, self)
         self.house_repository = HouseRepository(db.houses, self)
         self.room_repository = RoomRepository(db.rooms, self)
@@ -33,9 +119,63 @@ class RepositoryCollection(object):
         self.trigger_repository = TriggerRepository(db.triggers, self)
         self.theme_repository = ThemeRepository(db.themes, self)
         self.token_repository = TokenRepository(db.token, self)
+        self.revoked_token_repository = RevokedTokenRepository(db.revoked_tokens, self)
+        self.reading_repository = ReadingRepository(db.readings, self)
+        self.rollup_repository = RollupRepository(db.reading_rollups, self)
+        self.daily_aggregate_repository = DailyAggregateRepository(db.daily_aggregates, self)
+        self.energy_repository = EnergyRepository(db.energy_samples, self)
+
+    def get_all_repositories(self):
+        return [self.user_repository, self.house_repository, self.room_repository, self.device_repository,
+                self.trigger_repository, self.theme_repository, self.token_repository,
+                self.revoked_token_repository, self.reading_repository, self.rollup_repository,
+                self.daily_aggregate_repository, self.energy_repository]
+
+    def ensure_indexes(self):
+        for repository in self.get_all_repositories():
+            repository.ensure_indexes()
+
+    def check_access(self, token, entities):
+        # entities maps a repository to the ids of the entities the token needs access to. Every entity
+        # carries the id of the user owning it, so each repository is checked with a single query.
+        owner = self.token_repository.get_token_owner(token)
+        if owner is None:
+            return False
+        if owner['is_admin']:
+            # Admins may access everything, but only entities that exist.
+            return all(repository.all_exist(entity_ids) for repository, entity_ids in entities.items())
+        for repository, entity_ids in entities.items():
+            if not repository.are_owned_by(entity_ids, owner['user_id']):
+                return False
+        return True
+
+    def rebuild_fault_counters(self):
+        # The counters are only ever changed incrementally; recount them from the devices' faulty flags
+        # on startup so that a missed or doubled update cannot stick around.
+        for repository, device_field in ((self.house_repository, 'house_id'),
+                                         (self.user_repository, 'owner_user_id')):
+            counts = self.device_repository.collection.aggregate([
+                {'$match': {'faulty': True}},
+                {'$group': {'_id': '$' + device_field, 'count': {'$sum': 1}}}])
+            counts = {count['_id']: count['count'] for count in counts}
+            repository.collection.update_many({'_id': {'$nin': list(counts)}}, {"$set": {'faulty_device_count': 0}})
+            for entity_id, count in counts.items():
+                repository.collection.update_one({'_id': entity_id}, {"$set": {'faulty_device_count': count}})
+        self.user_repository.sync_faulty_flags()
+
+    def backfill_owner_user_ids(self):
+        # Rooms and devices created before owner_user_id was stored get it from their house.
+        for repository in (self.room_repository, self.device_repository):
+            for house_id in repository.collection.distinct('house_id', {'owner_user_id': {'$exists': False}}):
+                repository.collection.update_many(
+                    {'house_id': house_id, 'owner_user_id': {'$exists': False}},
+                    {"$set": {'owner_user_id': self.house_repository.get_house_owner(house_id)}})
 
 
 class UserRepository(Repository):
+    indexes = [IndexModel([('email_address', ASCENDING)], unique=True),
+               IndexModel([('faulty_device_count', ASCENDING)])]
+
     def __init__(self, mongo_collection, repository_collection):
         Repository.__init__(self, mongo_collection, repository_collection)
 
@@ -106,17 +246,18 @@ class UserRepository(Repository):
             target_users.append(User(user))
         return target_users
 
-    def get_faulty_devices_for_user(self, user_id):
-        faulty_devices = self.repositories.device_repository.get_faulty_devices()
-        house_id = self.collection.get_houses_for_user(user_id)[0].house_id
-        target_devices = []
-        fault_check = False
-        for device in faulty_devices:
-            if device.house_id == house_id:
-                fault_check = True
-                target_devices.append(Device(device))
-        self.collection.update_one({'_id': user_id}, {"$set": {'faulty': fault_check}}, upsert=False)
-        return target_devices
+    def get_faulty_devices_for_user(self, user_id, page=0, page_size=50):
+        return self.repositories.device_repository.get_faulty_devices(page, page_size, {'owner_user_id': user_id})
+
+    def sync_faulty_flags(self):
+        # faulty_device_count is maintained by the device reading writes; the faulty flag follows it.
+        self.collection.update_many({'faulty_device_count': {'$gt': 0}, 'faulty': {'$ne': True}},
+                                    {"$set": {'faulty': True}})
+        self.collection.update_many({'faulty_device_count': {'$not': {'$gt': 0}}, 'faulty': True},
+                                    {"$set": {'faulty': False}})
+
+    def are_owned_by(self, entity_ids, user_id):
+        return all(entity_id == user_id for entity_id in entity_ids)
 
     def validate_token(self, user_id, token):
         user = self.get_user_by_id(user_id)
@@ -127,6 +268,10 @@ class UserRepository(Repository):
 
 
 class HouseRepository(Repository):
+    indexes = [IndexModel([('user_id', ASCENDING)]),
+               IndexModel([('faulty_device_count', ASCENDING)])]
+    owner_field = 'user_id'
+
     def __init__(self, mongo_collection, repository_collection):
         Repository.__init__(self, mongo_collection, repository_collection)
 
@@ -145,7 +290,7 @@ class HouseRepository(Repository):
             return False
         if name is None:
             return False
-        if location is None
+        if location is None:
             return False
         self.collection.update_one({'_id': house_id}, {"$set": {'name': name, 'location': location}})
         return True
@@ -160,6 +305,17 @@ class HouseRepository(Repository):
         target_house = House(house)
         return target_house
 
+    def get_house_owner(self, house_id):
+        house = self.collection.find_one({'_id': house_id}, {'user_id': 1})
+        if house is None:
+            return None
+        return house['user_id']
+
+    def change_house_owner(self, house_id, user_id):
+        self.collection.update_one({'_id': house_id}, {"$set": {'user_id': user_id}})
+        for repository in (self.repositories.room_repository, self.repositories.device_repository):
+            repository.collection.update_many({'house_id': house_id}, {"$set": {'owner_user_id': user_id}})
+
     def get_house_by_location(self, location):
         house = self.collection.find_one({'location': location})
         return house
@@ -178,26 +334,21 @@ class HouseRepository(Repository):
             target_houses.append(House(house))
         return target_houses
 
-    def validate_token(self, house_id, token):
-        house = self.get_house_by_id(house_id)
-        if house is None:
-            return False
-        else:
-            user_id = house.user_id
-            return self.repositories.token_repository.authenticate_user(user_id, token)
-
 
 class RoomRepository(Repository):
+    indexes = [IndexModel([('house_id', ASCENDING), ('name', ASCENDING)], unique=True)]
+    owner_field = 'owner_user_id'
+
     def __init__(self, mongo_collection, repository_collection):
         Repository.__init__(self, mongo_collection, repository_collection)
 
     def add_room(self, house_id, name):
-        house_rooms = self.get_rooms_for_house(house_id)
-        for room in house_rooms:
-            other_name = room.name
-            if name == other_name:
-                raise Exception("There is already a room with this name.")
-        room = self.collection.insert_one({'house_id': house_id, 'name': name})
+        try:
+            room = self.collection.insert_one({'house_id': house_id, 'name': name,
+                                               'owner_user_id': self.repositories.house_repository.get_house_owner(
+                                                   house_id)})
+        except DuplicateKeyError:
+            raise Exception("There is already a room with this name.")
         return room.inserted_id
 
     def remove_room(self, room_id):
@@ -227,62 +378,145 @@ class RoomRepository(Repository):
             target_rooms.append(Room(room))
         return target_rooms
 
-    def validate_token(self, room_id, token):
-        room = self.get_room_by_id(room_id)
-        if room is None:
-            return False
-        else:
-            house_id = room.house_id
-            return self.repositories.house_repository.validate_token(house_id, token)
-
 
 class DeviceRepository(Repository):
+    indexes = [IndexModel([('house_id', ASCENDING), ('name', ASCENDING)], unique=True),
+               IndexModel([('room_id', ASCENDING)]),
+               IndexModel([('faulty', ASCENDING), ('fault_since', ASCENDING)]),
+               IndexModel([('owner_user_id', ASCENDING), ('faulty', ASCENDING), ('fault_since', ASCENDING)]),
+               IndexModel([('shadow.pending', ASCENDING), ('shadow.next_attempt', ASCENDING)])]
+    owner_field = 'owner_user_id'
+
     def __init__(self, mongo_collection, repository_collection):
         Repository.__init__(self, mongo_collection, repository_collection)
+        self.overall_consumption_cache = None
 
-    def get_faulty_devices(self):
-        all_device_ids = [x['_id'] for x in self.collection.find({}, {})]
-        devices = []
-        for device_id in all_device_ids:
-            device = self.get_device_by_id(device_id)
-            if device.is_faulty():
-                devices.append(device)
-        return devices
+    def get_faulty_devices(self, page=0, page_size=50, query=None):
+        query = dict(query or {}, faulty=True)
+        devices = self.collection.find(query).sort('fault_since', ASCENDING).skip(page * page_size).limit(page_size)
+        return [self.build_device(device) for device in devices]
+
+    def count_faulty_devices(self, query=None):
+        return self.collection.count(dict(query or {}, faulty=True))
 
     def update_device_reading(self, device):
-        reading = device.read_current_state()
-        self.collection.update_one({'_id': device.get_device_id()},
-                                   {"$set": {'status.last_read': reading}})
+        reading = self.repositories.device_poller.read_device(device)
+        self.write_device_readings([device], {device.get_device_id(): reading})
+
+    @staticmethod
+    def is_faulty_reading(reading):
+        return isinstance(reading, dict) and reading.get('error') is not None
+
+    def get_reading_updates(self, device, reading):
+        # Returns (repository, request) pairs. The faulty flag is left to set_faulty.
+        faulty = self.is_faulty_reading(reading)
+        fields = {'status.last_read': reading}
+        values = get_reading_values(reading)
+        if not faulty and isinstance(values, dict):
+            # What the device reports of its desired state, e.g. a switch turned by hand.
+            fields.update({'status.' + field: values[field] for field in device.shadow_operations if field in values})
+        updates = [(self, UpdateOne({'_id': device.device_id}, {"$set": fields}))]
+        for repository in (self.repositories.reading_repository, self.repositories.daily_aggregate_repository):
+            history_update = repository.get_append_update(device, reading)
+            if history_update is not None:
+                updates.append((repository, history_update))
+        return updates
+
+    def write_device_readings(self, devices, readings):
+        batch_size = get_optional_attribute(self.repositories.config, 'POLL_WRITE_BATCH_SIZE', 500)
+        write_concern = get_optional_attribute(self.repositories.config, 'POLL_WRITE_CONCERN', {'w': 1})
+        requests = {}
+        for device in devices:
+            if device.device_id in readings:
+                for repository, request in self.get_reading_updates(device, readings[device.device_id]):
+                    requests.setdefault(repository, []).append(request)
+        for repository, repository_requests in requests.items():
+            collection = repository.collection.with_options(write_concern=WriteConcern(**write_concern))
+            for start in range(0, len(repository_requests), batch_size):
+                try:
+                    collection.bulk_write(repository_requests[start:start + batch_size], ordered=False)
+                except BulkWriteError as ex:
+                    logging.error("Writing device readings to {} failed: {}".format(collection.name,
+                                                                                    ex.details['writeErrors']))
+        owners_changed = False
+        for device in devices:
+            if device.device_id in readings:
+                faulty = self.is_faulty_reading(readings[device.device_id])
+                if faulty != bool(device.faulty) and self.set_faulty(device, faulty):
+                    owners_changed = owners_changed or device.owner_user_id is not None
+        if owners_changed:
+            self.repositories.user_repository.sync_faulty_flags()
+        self.repositories.trigger_repository.process_readings(devices, readings)
+
+    def set_faulty(self, device, faulty):
+        # A device only changes the fault counters of its house and owner when it turns faulty or recovers, so the
+        # faulty views never need to scan the devices. The flag is flipped conditionally and the counters only
+        # follow if it was, so concurrent writers with the same stale view of the device count it once.
+        result = self.collection.update_one(
+            {'_id': device.device_id, 'faulty': {'$ne': faulty}},
+            {"$set": {'faulty': faulty, 'fault_since': datetime.datetime.utcnow() if faulty else None}})
+        if result.matched_count == 0:
+            return False
+        change = {"$inc": {'faulty_device_count': 1 if faulty else -1}}
+        self.repositories.house_repository.collection.update_one({'_id': device.house_id}, change)
+        if device.owner_user_id is not None:
+            self.repositories.user_repository.collection.update_one({'_id': device.owner_user_id}, change)
+        return True
 
     def update_all_device_readings(self):
-        all_device_ids = [x['_id'] for x in self.collection.find({}, {})]
-        for device_id in all_device_ids:
-            device = self.get_device_by_id(device_id)
-            self.update_device_reading(device)
+        devices = [self.build_device(device) for device in self.collection.find()]
+        readings = self.repositories.device_poller.poll(devices)
+        self.write_device_readings(devices, readings)
+
+    def sync_poll_schedule(self):
+        devices = self.collection.find({}, {'device_type': 1})
+        self.repositories.poll_scheduler.sync((device['_id'], device.get('device_type')) for device in devices)
+
+    def update_due_device_readings(self):
+        scheduler = self.repositories.poll_scheduler
+        due_device_ids = scheduler.pop_due()
+        if len(due_device_ids) == 0:
+            return
+        handled_device_ids = set()
+        try:
+            devices = [self.build_device(device) for device in self.collection.find({'_id': {'$in': due_device_ids}})]
+            found_device_ids = {device.device_id for device in devices}
+            for device_id in due_device_ids:
+                if device_id not in found_device_ids:
+                    scheduler.remove(device_id)
+                    handled_device_ids.add(device_id)
+            readings = self.repositories.device_poller.poll(devices)
+            self.write_device_readings(devices, readings)
+            for device in devices:
+                scheduler.record_reading(device.device_id, has_reading_changed(
+                    get_optional_attribute(device.status, 'last_read'), readings[device.device_id]))
+                handled_device_ids.add(device.device_id)
+        finally:
+            # Popped devices are only due again once a reading is recorded, so a failed cycle must not drop them.
+            for device_id in due_device_ids:
+                if device_id not in handled_device_ids:
+                    scheduler.record_reading(device_id, False)
 
     def add_device(self, house_id, room_id, name, device_type, target, status, configuration, vendor):
-        house_devices = self.get_devices_for_house(house_id)
-        for device in house_devices:
-            other_name = device.name
-            if name == other_name:
-                raise Exception("There is already a device with this name.")
-        if vendor == "OWN" and "url" not in configuration:
-            raise Exception("Not all required info is in the configuration.")
-        elif vendor == "energenie" and \
-                ("username" not in configuration
-                 or "password" not in configuration
-                 or "device_id" not in configuration):
+        adapter = get_vendor_adapter(vendor)
+        if adapter is not None and not adapter.has_required_configuration(configuration):
             raise Exception("Not all required info is in the configuration.")
-        device = self.collection.insert_one({'house_id': house_id, 'room_id': room_id,
-                                             'name': name, 'device_type': device_type, 'locking_theme_id': None,
-                                             'target': target, 'status': status,
-                                             'configuration': configuration,
-                                             'vendor': vendor})
+        try:
+            device = self.collection.insert_one({'house_id': house_id, 'room_id': room_id,
+                                                 'owner_user_id': self.repositories.house_repository.get_house_owner(
+                                                     house_id),
+                                                 'name': name, 'device_type': device_type, 'locking_theme_id': None,
+                                                 'target': target, 'status': status,
+                                                 'configuration': configuration,
+                                                 'vendor': vendor})
+        except DuplicateKeyError:
+            raise Exception("There is already a device with this name.")
         device_id = device.inserted_id
         self.collection.update_one({'_id': device_id}, {"$set": {'status.last_read': 0}})
         self.set_device_type(device_id)
         device = self.get_device_by_id(device_id=device_id)
         self.update_device_reading(device)
+        self.repositories.poll_scheduler.schedule(device_id, device_type)
         return device_id
 
     def set_device_type(self, device_id):
@@ -302,7 +536,17 @@ class DeviceRepository(Repository):
 
     def remove_device(self, device_id):
         device = self.get_device_by_id(device_id)
-        self.collection.delete_one({'_id': device_id})
+        result = self.collection.delete_one({'_id': device_id})
+        self.repositories.poll_scheduler.remove(device_id)
+        self.repositories.trigger_repository.drop_graphs()
+        self.repositories.reading_repository.remove_device_readings(device_id)
+        self.repositories.energy_repository.remove_device_samples(device_id)
+        if device is not None and device.faulty and result.deleted_count == 1:
+            self.repositories.house_repository.collection.update_one({'_id': device.house_id},
+                                                                     {"$inc": {'faulty_device_count': -1}})
+            self.repositories.user_repository.collection.update_one({'_id': device.owner_user_id},
+                                                                    {"$inc": {'faulty_device_count': -1}})
+            self.repositories.user_repository.sync_faulty_flags()
         return device
 
     def unlink_device_from_room(self, device_id):
@@ -312,6 +556,10 @@ class DeviceRepository(Repository):
         device = self.collection.find_one({'_id': device_id})
         if device is None:
             return None
+        return self.build_device(device)
+
+    @staticmethod
+    def build_device(device):
         device_type = device['device_type'] if 'device_type' in device else None
         if device_type == "thermostat":
             return Thermostat(device)
@@ -324,7 +572,10 @@ class DeviceRepository(Repository):
         return Device(device)
 
     def add_device_to_house(self, house_id, device_id):
-        self.collection.update_one({'_id': device_id}, {"$set": {'house_id': house_id}}, upsert=False)
+        owner_user_id = self.repositories.house_repository.get_house_owner(house_id)
+        self.collection.update_one({'_id': device_id}, {"$set": {'house_id': house_id, 'owner_user_id': owner_user_id}},
+                                   upsert=False)
+        self.repositories.trigger_repository.drop_graphs()
 
     def get_devices_for_house(self, house_id):
         devices = self.collection.find({'house_id': house_id})
@@ -358,9 +609,7 @@ class DeviceRepository(Repository):
         if power_state not in [0, 1]:
             raise Exception("Power_state is not of the correct format")
         if device.locking_theme_id is None:
-            device.configure_power_state(power_state)
-            self.update_device_reading(device)
-            self.collection.update_one({'_id': device_id}, {"$set": {'status.power_state': power_state}}, upsert=False)
+            self.set_desired_state(device, 'power_state', power_state)
 
     def set_target_temperature(self, device_id, temp):
         device = self.collection.find_one({'_id': device_id})
@@ -370,12 +619,77 @@ class DeviceRepository(Repository):
         assert ('locked_max_temperature' not in device['target'] or device['target'][
             'locked_max_temperature'] >= temp), "Chosen temperature is too high."
         if device['locking_theme_id'] is None:
-            self.collection.update_one({'_id': device_id}, {"$set": {'target.target_temperature': temp}}, upsert=False)
+            self.set_desired_state(self.get_device_by_id(device_id), 'target_temperature', temp)
             device = self.get_device_by_id(device_id)
-            device.configure_target_temperature(temp)
-            self.update_device_reading(device)
         return device
 
+    def set_desired_state(self, device, field, value, now=None):
+        # Records the desired state and returns without talking to the device; reconcile_devices pushes it.
+        # Devices that cannot be commanded through their vendor report the desired state right away.
+        now = time.time() if now is None else now
+        fields = {'target.' + field: value}
+        if not device.can_push(field):
+            fields['status.' + field] = value
+            self.collection.update_one({'_id': device.device_id}, {"$set": fields})
+            return
+        fields.update({'shadow.pending': True, 'shadow.attempts': 0, 'shadow.next_attempt': now,
+                       'shadow.last_error': None})
+        self.collection.update_one({'_id': device.device_id}, {"$set": fields})
+        # Pushed by the action dispatcher, so that writes in quick succession reach the device once.
+        dispatcher = self.repositories.action_dispatcher
+        dispatcher.submit(device.device_id, 'reconcile', lambda: self.reconcile_devices([device.device_id]))
+        dispatcher.dispatch()
+
+    def push_desired_state(self, device):
+        # Returns the fields the device took and the error that stopped the rest, if any.
+        pushed = {}
+        for field, value in device.get_unreported_state().items():
+            try:
+                error = device.push_desired_state(field, value, timeout=self.repositories.device_poller.call_timeout)
+            except Exception as ex:
+                error = "Cannot push {}: {}".format(field, ex)
+            if error is not None:
+                return pushed, error
+            pushed[field] = value
+        return pushed, None
+
+    def reconcile_devices(self, device_ids=None, now=None):
+        # Pushes the desired state of the devices whose reported state differs from it and that are due, oldest
+        # first and at most SHADOW_BATCH_SIZE at a time. Failed pushes are retried with exponential backoff
+        # while the desired state stays queued; a newer desired state replaces the queued one.
+        now = time.time() if now is None else now
+        query = {'shadow.pending': True, 'shadow.next_attempt': {'$lte': now}}
+        if device_ids is not None:
+            query['_id'] = {'$in': list(device_ids)}
+        batch_size = get_optional_attribute(self.repositories.config, 'SHADOW_BATCH_SIZE', 100)
+        devices = [self.build_device(device) for device in
+                   self.collection.find(query).sort('shadow.next_attempt', ASCENDING).limit(batch_size)]
+        if len(devices) == 0:
+            return 0
+        base_delay = get_optional_attribute(self.repositories.config, 'SHADOW_RETRY_BASE_SECONDS', 30)
+        max_delay = get_optional_attribute(self.repositories.config, 'SHADOW_RETRY_MAX_SECONDS', 3600)
+        requests = []
+        for device, (pushed, error) in zip(devices, self.repositories.device_poller.executor.map(
+                self.push_desired_state, devices)):
+            if len(pushed) > 0:
+                requests.append(UpdateOne({'_id': device.device_id},
+                                          {"$set": {'status.' + field: value for field, value in pushed.items()}}))
+                self.repositories.poll_scheduler.record_command(device.device_id)
+            # Only settles the shadow if no newer desired state was written in the meantime.
+            unchanged = {'_id': device.device_id, 'shadow.next_attempt': device.shadow.get('next_attempt')}
+            if error is None:
+                requests.append(UpdateOne(unchanged, {"$set": {'shadow.pending': False, 'shadow.attempts': 0,
+                                                                'shadow.last_error': None}}))
+            else:
+                attempts = device.shadow.get('attempts', 0) + 1
+                logging.warning("Pushing the desired state of device {} failed ({} attempts): {}".format(
+                    device.device_id, attempts, error))
+                requests.append(UpdateOne(unchanged, {"$set": {
+                    'shadow.attempts': attempts, 'shadow.last_error': error,
+                    'shadow.next_attempt': now + min(max_delay, base_delay * 2 ** min(attempts - 1, 16))}}))
+        self.collection.bulk_write(requests, ordered=False)
+        return len(devices)
+
     def set_locking_theme_id(self, device_id, locking_theme_id):
         device = self.get_device_by_id(device_id)
         device.locking_theme_id = locking_theme_id
@@ -407,59 +721,169 @@ class DeviceRepository(Repository):
         self.collection.update_one({'_id': device_id}, {"$set": {'status.last_temperature': new_last_temperature}},
                                    upsert=False)
 
-    def get_energy_consumption(self, device_id):
-        device = self.get_device_by_id(device_id)
-        consumption = device.get_energy_readings()
-        logging.debug("Got energy consumption: {}".format(consumption))
-        consumption_array = consumption["data"]["data"]
-        consumption_array = list(reversed(consumption_array))
-        for i in range(0, len(consumption_array)):
-            consumption_array[i][0] = datetime.datetime.fromtimestamp(consumption_array[i][0]).date()
-        return consumption_array
-
-    def get_overall_consumption(self):
-        devices = self.get_all_devices()
-        overall_consumption = []
-        for device in devices:
-            device_consumption = self.get_energy_consumption(device.device_id)
-            if device_consumption is not None:
-                if len(overall_consumption) == 0:
-                    overall_consumption = device_consumption
-                else:
-                    for i in range(len(overall_consumption)):
-                        j = 0
-                        while overall_consumption[i][0] != device_consumption[j][0]:
-                            if j < len(device_consumption):
-                                j += 1
-                            else:
-                                break
-                        if j < len(device_consumption):
-                            overall_consumption[i][1] = overall_consumption[i][1] + device_consumption[j][1]
+    def get_energy_devices(self):
+        return [self.build_device(device)
+                for device in self.collection.find({'vendor': {'$in': get_vendor_names('energy')}})]
+
+    def get_energy_consumption(self, device_id, now=None):
+        now = time.time() if now is None else now
+        days = get_optional_attribute(self.repositories.config, 'ENERGY_CONSUMPTION_DAYS', 7)
+        return self.repositories.energy_repository.get_device_consumption(device_id, now - days * 86400, now)
+
+    def get_overall_consumption(self, now=None):
+        # Summed from the locally synchronised energy samples; cached until midnight or the next sync.
+        now = time.time() if now is None else now
+        cache = self.overall_consumption_cache
+        if cache is not None and cache['expires_at'] > now:
+            return cache['consumption']
+        days = get_optional_attribute(self.repositories.config, 'ENERGY_CONSUMPTION_DAYS', 7)
+        overall_consumption = self.repositories.energy_repository.get_overall_consumption(now - days * 86400, now)
+        tomorrow = datetime.datetime.fromtimestamp(now).date() + datetime.timedelta(days=1)
+        self.overall_consumption_cache = {'consumption': overall_consumption,
+                                          'expires_at': time.mktime(tomorrow.timetuple())}
         return overall_consumption
 
-    def validate_token(self, device_id, token):
-        device = self.get_device_by_id(device_id)
-        if device is None:
-            return False
-        else:
-            house_id = device.house_id
-            return self.repositories.house_repository.validate_token(house_id, token)
-
 
 class TriggerRepository(Repository):
+    indexes = [IndexModel([('sensor_id', ASCENDING)]),
+               IndexModel([('actor_id', ASCENDING)]),
+               IndexModel([('user_id', ASCENDING)])]
+    owner_field = 'user_id'
+
     def __init__(self, mongo_collection, repository_collection):
         Repository.__init__(self, mongo_collection, repository_collection)
+        self.engine = None
+        self.engine_lock = threading.Lock()
+        self.dispatch_state = threading.local()
+        self.graphs = {}
+        self.graph_lock = threading.Lock()
 
-    def add_trigger(self, sensor_id, event, event_params, actor_id, action, action_params, user_id):
+    def clear_db(self):
+        self.collection.delete_many({})
+        # A worker pool is reloaded on next use.
+        self.engine = None
+        self.graphs = {}
+
+    def get_sensor_house_ids(self, sensor_ids):
+        devices = self.repositories.device_repository.collection.find({'_id': {'$in': list(sensor_ids)}},
+                                                                      {'house_id': 1})
+        return {device['_id']: device.get('house_id') for device in devices}
+
+    def get_queue_depths(self):
+        # Reading batches waiting for every trigger worker, and trigger actions waiting to run.
+        engine = self.engine
+        return {'workers': engine.get_queue_depths() if isinstance(engine, TriggerWorkerPool) else [],
+                'actions': self.repositories.action_dispatcher.get_queue_length()}
+
+    def get_graph(self, house_id):
+        # A trigger's edges are kept in the graph of its actor's house. The graph of a house is built from the
+        # database on first use, kept up to date by add_trigger, edit_trigger and remove_trigger afterwards, and
+        # dropped with all others when a device moves house or is removed.
+        with self.graph_lock:
+            if house_id not in self.graphs:
+                graph = TriggerGraph()
+                device_ids = [device['_id'] for device in self.repositories.device_repository.collection.find(
+                    {'house_id': house_id}, {'_id': 1})]
+                for trigger in self.collection.find({'actor_id': {'$in': device_ids}}):
+                    trigger = Trigger(trigger)
+                    graph.add(trigger.trigger_id, get_trigger_sensor_ids(trigger), trigger.actor_id)
+                for loop in graph.get_loops():
+                    logging.warning("Triggers in house {} form a loop between devices {}".format(
+                        house_id, ", ".join(str(device_id) for device_id in loop)))
+                self.graphs[house_id] = graph
+            return self.graphs[house_id]
+
+    def drop_graphs(self):
+        with self.graph_lock:
+            self.graphs = {}
+
+    def get_device_graph(self, device_id):
+        # The graph of the house of a device, or None if there is no such device.
+        device = self.repositories.device_repository.get_device_by_id(device_id)
+        if device is None:
+            return None
+        return self.get_graph(device.house_id)
+
+    def find_trigger_loop(self, sensor_ids, actor_id):
+        # The devices (from the actor back to a sensor) of a loop a new trigger edge would close, or None. The
+        # search walks upstream from the sensors: the triggers acting on a device are all in the graph of its
+        # house, so loops through devices of several houses are found as well.
+        graph = self.get_device_graph(actor_id)
+        if graph is None:
+            return None
+        # Edges that already exist cannot close a new loop.
+        new_sensor_ids = [sensor_id for sensor_id in set(sensor_ids) if not graph.has_edge(sensor_id, actor_id)]
+        if actor_id in new_sensor_ids:
+            return [actor_id]
+        # device -> the device it acts on, on the way back to a sensor
+        children = {sensor_id: None for sensor_id in new_sensor_ids}
+        frontier = new_sensor_ids
+        while len(frontier) > 0:
+            house_ids = self.get_sensor_house_ids(frontier)
+            next_frontier = []
+            for device_id in frontier:
+                if device_id not in house_ids:
+                    continue
+                for source_id in self.get_graph(house_ids[device_id]).get_sources(device_id):
+                    if source_id in children:
+                        continue
+                    children[source_id] = device_id
+                    if source_id == actor_id:
+                        path = [actor_id]
+                        while children[path[-1]] is not None:
+                            path.append(children[path[-1]])
+                        return path
+                    next_frontier.append(source_id)
+            frontier = next_frontier
+        return None
+
+    def update_graph(self, trigger):
+        graph = self.get_device_graph(trigger.actor_id)
+        if graph is not None:
+            graph.add(trigger.trigger_id, get_trigger_sensor_ids(trigger), trigger.actor_id)
+
+    def get_engine(self):
+        # The sensor index is built from the database on first use and kept up to date by add_trigger,
+        # edit_trigger and remove_trigger afterwards. With a trigger worker pool (see create_trigger_worker_pool)
+        # the triggers are evaluated in its worker processes, sharded by house, instead of in this process.
+        with self.engine_lock:
+            if self.engine is None:
+                engine = self.repositories.trigger_worker_pool
+                if engine is not None:
+                    engine.get_house_ids = self.get_sensor_house_ids
+                else:
+                    engine = TriggerEngine(**get_trigger_engine_options(self.repositories.config))
+                engine.load(self.get_all_triggers())
+                sensor_ids = engine.get_rule_sensor_ids()
+                if len(sensor_ids) > 0:
+                    devices = self.repositories.device_repository.collection.find(
+                        {'_id': {'$in': list(sensor_ids)}}, {'status.last_read': 1})
+                    engine.set_latest_readings({device['_id']: device.get('status', {}).get('last_read')
+                                                for device in devices})
+                self.engine = engine
+            return self.engine
+
+    def add_trigger(self, sensor_id, event, event_params, actor_id, action, action_params, user_id, hysteresis=None,
+                    debounce=None):
         new_trigger = self.collection.insert_one({'sensor_id': sensor_id, 'event': event, 'event_params': event_params,
                                                   'actor_id': actor_id, 'action': action,
                                                   'action_params': action_params,
-                                                  'user_id': user_id, 'reading': None})
+                                                  'user_id': user_id, 'reading': None,
+                                                  'hysteresis': hysteresis, 'debounce': debounce,
+                                                  'state': {'active': None, 'last_fired': None, 'due_at': None}})
+        trigger = self.get_trigger_by_id(new_trigger.inserted_id)
+        self.get_engine().add(trigger)
+        self.update_graph(trigger)
         return new_trigger.inserted_id
 
     def remove_trigger(self, trigger_id):
         trigger = self.get_trigger_by_id(trigger_id)
         self.collection.delete_one({'_id': trigger_id})
+        self.get_engine().remove(trigger_id)
+        if trigger is not None:
+            graph = self.get_device_graph(trigger.actor_id)
+            if graph is not None:
+                graph.remove(trigger_id)
         return trigger
 
     def get_trigger_by_id(self, trigger_id):
@@ -483,11 +907,18 @@ class TriggerRepository(Repository):
             target_triggers.append(Trigger(trigger))
         return target_triggers
 
-    def edit_trigger(self, trigger_id, event, event_params, action, action_params):
+    def edit_trigger(self, trigger_id, event, event_params, action, action_params, hysteresis=None, debounce=None):
+        # The condition may have changed, so what was known about it is reset.
         self.collection.update_one({'_id': trigger_id},
                                    {"$set": {"event": event, "event_params": event_params,
-                                             "action": action, "action_params": action_params}})
-        return self.get_trigger_by_id(trigger_id)
+                                             "action": action, "action_params": action_params,
+                                             "hysteresis": hysteresis, "debounce": debounce,
+                                             "state": {'active': None, 'last_fired': None, 'due_at': None}}})
+        trigger = self.get_trigger_by_id(trigger_id)
+        if trigger is not None:
+            self.get_engine().add(trigger)
+            self.update_graph(trigger)
+        return trigger
 
     def get_triggers_for_user(self, user_id):
         triggers = self.collection.find({'user_id': user_id})
@@ -503,33 +934,94 @@ class TriggerRepository(Repository):
             target_triggers.append(Trigger(trigger))
         return target_triggers
 
-    def check_all_triggers(self):
-        triggers = self.get_all_triggers()
+    def backtest_trigger(self, sensor_id, event, event_params, actor_id, action, action_params, hysteresis=None,
+                         debounce=None, days=30, now=None):
+        # Replays an unsaved trigger over the stored readings of its sensor in the last days, at most as far back as
+        # the raw readings are kept; the result reports the window that was actually replayed.
+        trigger = Trigger({'_id': None, 'sensor_id': sensor_id, 'event': event, 'event_params': event_params,
+                           'actor_id': actor_id, 'action': action, 'action_params': action_params, 'user_id': None,
+                           'reading': None, 'hysteresis': hysteresis, 'debounce': debounce})
+        now = time.time() if now is None else now
+        start = now - days * 86400
+        raw_retention = self.repositories.rollup_repository.get_retention().get('raw')
+        if raw_retention is not None:
+            start = max(start, now - raw_retention)
+        readings = self.repositories.reading_repository.get_device_readings(trigger.sensor_id, start, now)
+        fire_times = backtest.backtest_trigger(
+            trigger, readings, now,
+            default_hysteresis=get_optional_attribute(self.repositories.config, 'TRIGGER_HYSTERESIS', 0.0),
+            default_debounce=get_optional_attribute(self.repositories.config, 'TRIGGER_DEBOUNCE_SECONDS', 0))
+        return {'start': start, 'end': now, 'days': (now - start) / 86400, 'reading_count': len(readings),
+                'actions': [{'timestamp': fire_time, 'actor_id': trigger.actor_id, 'action': trigger.action,
+                             'action_params': trigger.action_params} for fire_time in fire_times]}
+
+    def process_readings(self, devices, readings):
+        # Called whenever readings are written. Only the triggers of the devices that were read are looked
+        # at. Their actions go through the action dispatcher; actions can write readings of their own, which
+        # are evaluated in turn up to TRIGGER_MAX_CHAIN_DEPTH.
+        depth = getattr(self.dispatch_state, 'depth', 0)
+        if depth >= get_optional_attribute(self.repositories.config, 'TRIGGER_MAX_CHAIN_DEPTH', 5):
+            logging.warning("Not evaluating triggers beyond a chain of {} actions".format(depth))
+            return
+        engine = self.get_engine()
+        fired = engine.evaluate_batch([(device.device_id, get_optional_attribute(device.status, 'last_read'),
+                                        readings[device.device_id]) for device in devices
+                                       if device.device_id in readings])
+        updates = {trigger_id: {'state': state} for trigger_id, state in engine.pop_changed_states().items()}
+        for trigger in fired:
+            # A rule can fire on the reading of another sensor than its own.
+            if trigger.sensor_id in readings:
+                updates.setdefault(trigger.trigger_id, {})['reading'] = readings[trigger.sensor_id]
+        self.update_trigger_readings(updates)
+        self.submit_actions(fired, depth + 1)
+
+    def process_timers(self, now=None):
+        # Called on every timer tick: duration triggers whose condition held long enough fire, as do rules on
+        # the time of day that became true, and the changed states are persisted.
+        engine = self.get_engine()
+        fired = engine.expire(now) + engine.evaluate_time_rules(now)
+        self.update_trigger_readings({trigger_id: {'state': state}
+                                      for trigger_id, state in engine.pop_changed_states().items()})
+        self.submit_actions(fired, 1)
+
+    def submit_actions(self, triggers, depth):
+        dispatcher = self.repositories.action_dispatcher
         for trigger in triggers:
-            triggered = False
-            if trigger.event == "motion_detected_start" or trigger.event == "motion_detected_stop":
-                pass
-            elif trigger.event == "temperature_gets_higher_than" or trigger.event == "temperature_gets_lower_than":
-                pass
-            if triggered:
-                if trigger.action == "set_target_temperature":
-                    pass
-                elif trigger.action == "set_light_switch":
-                    pass
+            dispatcher.submit(trigger.actor_id, trigger.action,
+                              lambda trigger=trigger: self.execute_action(trigger, depth))
+        dispatcher.dispatch()
+
+    def execute_action(self, trigger, depth=1):
+        action = trigger_actions.get(trigger.action)
+        if action is None:
+            logging.warning("Unknown action {} of trigger {}".format(trigger.action, trigger.trigger_id))
+            return
+        self.dispatch_state.depth = depth
+        try:
+            action(self.repositories.device_repository, trigger.actor_id, trigger.action_params)
+        except Exception as ex:
+            logging.error("Action {} of trigger {} failed: {}".format(trigger.action, trigger.trigger_id, ex))
+        finally:
+            self.dispatch_state.depth = 0
 
     def update_trigger_reading(self, trigger_id, reading):
-        self.collection.update_one({'_id': trigger_id}, {"$set": {'reading': reading}})
+        self.update_trigger_readings({trigger_id: {'reading': reading}})
 
-    def validate_token(self, trigger_id, token):
-        trigger = self.get_trigger_by_id(trigger_id)
-        if trigger is None:
-            return False
-        else:
-            user_id = trigger.user_id
-            return self.repositories.token_repository.authenticate_user(user_id, token)
+    def update_trigger_readings(self, updates):
+        # updates maps a trigger id to the fields ('reading', 'state') to set on it.
+        requests = [UpdateOne({'_id': trigger_id}, {"$set": fields}) for trigger_id, fields in updates.items()]
+        batch_size = get_optional_attribute(self.repositories.config, 'POLL_WRITE_BATCH_SIZE', 500)
+        for start in range(0, len(requests), batch_size):
+            try:
+                self.collection.bulk_write(requests[start:start + batch_size], ordered=False)
+            except BulkWriteError as ex:
+                logging.error("Writing trigger states failed: {}".format(ex.details['writeErrors']))
 
 
 class ThemeRepository(Repository):
+    indexes = [IndexModel([('user_id', ASCENDING)])]
+    owner_field = 'user_id'
+
     def __init__(self, mongo_collection, repository_collection):
         Repository.__init__(self, mongo_collection, repository_collection)
 
@@ -620,23 +1112,29 @@ class ThemeRepository(Repository):
         updated_theme = self.get_theme_by_id(theme_id)
         return updated_theme
 
-    def validate_token(self, theme_id, token):
-        theme = self.get_theme_by_id(theme_id)
-        if theme is None:
-            return False
-        else:
-            user_id = theme.user_id
-            return self.repositories.token_repository.authenticate_user(user_id, token)
-
 
 class TokenRepository(Repository):
+    indexes = [IndexModel([('token', ASCENDING)], unique=True)]
+
     def __init__(self, mongo_collection, repository_collection):
         Repository.__init__(self, mongo_collection, repository_collection)
+        config = repository_collection.config
+        self.signed_tokens_enabled = get_optional_attribute(config, 'SIGNED_TOKENS_ENABLED', False)
+        self.token_secret = get_optional_attribute(config, 'TOKEN_SECRET', None)
+        self.token_lifetime = get_optional_attribute(config, 'TOKEN_LIFETIME', 7 * 24 * 3600)
+        if self.signed_tokens_enabled and not self.token_secret:
+            raise Exception("TOKEN_SECRET must be set when SIGNED_TOKENS_ENABLED is on")
 
     def find_by_token(self, token):
         return self.collection.find_one({'token': token})
 
+    def generate_signed_token(self, user_id):
+        user = self.repositories.user_repository.get_user_by_id(user_id)
+        return sign_access_token(user_id, user.is_admin, time.time() + self.token_lifetime, self.token_secret)
+
     def generate_token(self, user_id):
+        if self.signed_tokens_enabled:
+            return self.generate_signed_token(user_id)
         unique = False
         token = ""
         while not unique:
@@ -650,6 +1148,11 @@ class TokenRepository(Repository):
         return new_token.inserted_id
 
     def invalidate_token(self, token):
+        if is_signed_token(token):
+            payload = verify_access_token(token, self.token_secret) if self.token_secret else None
+            if payload is not None:
+                self.repositories.revoked_token_repository.revoke(token, payload['expires_at'])
+            return
         self.collection.delete_one({'token': token})
 
     def get_token_info(self, token):
@@ -667,31 +1170,38 @@ class TokenRepository(Repository):
             return True
 
     def check_token_validity(self, token):
+        if is_signed_token(token):
+            return self.get_token_owner(token) is not None
         token = self.find_by_token(token)
         if token is not None:
             return True
         else:
             return False
 
+    def get_token_owner(self, token):
+        if is_signed_token(token):
+            # Signed tokens carry their owner, so checking them needs no database reads at all.
+            payload = verify_access_token(token, self.token_secret) if self.token_secret else None
+            if payload is None or self.repositories.revoked_token_repository.is_revoked(token):
+                return None
+            return {'user_id': ObjectId(payload['user_id']), 'is_admin': payload['is_admin']}
+        token = self.find_by_token(token)
+        if token is None:
+            return None
+        user = self.repositories.user_repository.collection.find_one({'_id': token['user_id']}, {'is_admin': 1})
+        if user is None:
+            return None
+        return {'user_id': token['user_id'], 'is_admin': user['is_admin']}
+
     def authenticate_user(self, owner_id, token):
-        valid = self.check_token_validity(token)
-        if valid:
-            token_user_id = self.find_by_token(token)['user_id']
-            user_is_admin = self.repositories.user_repository.get_user_by_id(token_user_id).is_admin
-            if token_user_id == owner_id:
-                return True
-            elif user_is_admin:
-                return True
-            else:
-                return False
+        owner = self.get_token_owner(token)
+        if owner is None:
+            return False
+        return owner['user_id'] == owner_id or owner['is_admin']
 
     def authenticate_admin(self, token):
-        valid = self.check_token_validity(token)
-        if valid:
-            token_user_id = self.find_by_token(token)['user_id']
-            user_is_admin = self.repositories.user_repository.get_user_by_id(token_user_id).is_admin
-            return user_is_admin
-        return False
+        owner = self.get_token_owner(token)
+        return owner is not None and owner['is_admin']
 
     def get_all_tokens(self):
         tokens = self.collection.find()
@@ -699,3 +1209,357 @@ class TokenRepository(Repository):
         for token in tokens:
             target_tokens.append(Token(token))
         return target_tokens
+
+
+class RevokedTokenRepository(Repository):
+    indexes = [IndexModel([('token_hash', ASCENDING)], unique=True),
+               IndexModel([('expires_at', ASCENDING)], expireAfterSeconds=0)]
+
+    def __init__(self, mongo_collection, repository_collection):
+        Repository.__init__(self, mongo_collection, repository_collection)
+        self.revocation_filter = RevocationFilter()
+
+    def revoke(self, token, expires_at):
+        token_hash = get_token_hash(token)
+        self.revocation_filter.add(token_hash)
+        self.collection.update_one({'token_hash': token_hash},
+                                   {"$set": {'expires_at': datetime.datetime.utcfromtimestamp(expires_at)}},
+                                   upsert=True)
+
+    def is_revoked(self, token):
+        return self.revocation_filter.contains(get_token_hash(token))
+
+    def sync_revocations(self):
+        # Picks up logouts handled by other API processes. Expired tokens fail verification anyway, so
+        # they are left out of the filter (and removed from the collection by the TTL index).
+        revoked_tokens = self.collection.find({'expires_at': {'$gt': datetime.datetime.utcnow()}},
+                                              {'token_hash': 1})
+        self.revocation_filter.replace(revoked_token['token_hash'] for revoked_token in revoked_tokens)
+
+
+class ReadingRepository(Repository):
+    # Poll results are kept in one document per device per hour holding parallel arrays of timestamps and
+    # values, so an hour of readings costs a single document and a single index entry per index.
+    indexes = [IndexModel([('device_id', ASCENDING), ('bucket_start', ASCENDING)], unique=True),
+               IndexModel([('room_id', ASCENDING), ('bucket_start', ASCENDING)]),
+               IndexModel([('house_id', ASCENDING), ('bucket_start', ASCENDING)]),
+               IndexModel([('bucket_start', ASCENDING)])]
+    owner_field = 'owner_user_id'
+    bucket_seconds = 3600
+
+    def __init__(self, mongo_collection, repository_collection):
+        Repository.__init__(self, mongo_collection, repository_collection)
+
+    def get_bucket_start(self, timestamp):
+        return datetime.datetime.utcfromtimestamp(timestamp - timestamp % self.bucket_seconds)
+
+    def get_append_update(self, device, reading):
+        if not isinstance(reading, dict) or reading.get('error') is not None or 'timestamp' not in reading:
+            return None
+        timestamp = float(reading['timestamp'])
+        return UpdateOne({'device_id': device.device_id, 'bucket_start': self.get_bucket_start(timestamp)},
+                         {"$set": {'house_id': device.house_id, 'room_id': device.room_id,
+                                   'owner_user_id': device.owner_user_id, 'device_type': device.device_type},
+                          "$push": {'timestamps': timestamp, 'values': get_reading_values(reading)},
+                          "$inc": {'count': 1}},
+                         upsert=True)
+
+    def get_buckets(self, query, start, end):
+        # start and end are epoch seconds; buckets overlapping [start, end) are returned oldest first.
+        query = dict(query, bucket_start={'$gte': self.get_bucket_start(start),
+                                          '$lt': datetime.datetime.utcfromtimestamp(end)})
+        return [ReadingBucket(bucket) for bucket in self.collection.find(query).sort('bucket_start', ASCENDING)]
+
+    def get_readings(self, query, start, end):
+        readings = []
+        for bucket in self.get_buckets(query, start, end):
+            readings.extend((bucket.device_id, timestamp, value)
+                            for timestamp, value in bucket.get_readings(start, end))
+        return readings
+
+    def get_device_readings(self, device_id, start, end):
+        return [(timestamp, value) for _, timestamp, value in self.get_readings({'device_id': device_id}, start, end)]
+
+    def get_room_readings(self, room_id, start, end):
+        return self.get_readings({'room_id': room_id}, start, end)
+
+    def get_house_readings(self, house_id, start, end):
+        return self.get_readings({'house_id': house_id}, start, end)
+
+    def get_oldest_timestamp(self):
+        for bucket in self.collection.find({}, {'bucket_start': 1}).sort('bucket_start', ASCENDING).limit(1):
+            return rollups.to_timestamp(bucket['bucket_start'])
+        return None
+
+    def remove_device_readings(self, device_id):
+        self.collection.delete_many({'device_id': device_id})
+
+    def remove_readings_before(self, timestamp):
+        # Only whole buckets are removed, i.e. those ending at or before the timestamp.
+        self.collection.delete_many({'bucket_start': {'$lte': self.get_bucket_start(timestamp - self.bucket_seconds)}})
+
+
+class RollupRepository(Repository):
+    # 5-minute, hourly and daily summaries of the readings history. Every tier is compacted incrementally from
+    # its own high-water mark, stored in the rollup_state collection, so a run only reads what arrived since
+    # the previous one.
+    indexes = [IndexModel([('tier', ASCENDING), ('device_id', ASCENDING), ('period_start', ASCENDING)],
+                          unique=True),
+               IndexModel([('tier', ASCENDING), ('room_id', ASCENDING), ('period_start', ASCENDING)]),
+               IndexModel([('tier', ASCENDING), ('house_id', ASCENDING), ('period_start', ASCENDING)]),
+               IndexModel([('tier', ASCENDING), ('owner_user_id', ASCENDING), ('period_start', ASCENDING)]),
+               IndexModel([('tier', ASCENDING), ('period_start', ASCENDING)])]
+    owner_field = 'owner_user_id'
+
+    def __init__(self, mongo_collection, repository_collection):
+        Repository.__init__(self, mongo_collection, repository_collection)
+        self.state = repository_collection.db.rollup_state
+
+    def clear_db(self):
+        self.collection.delete_many({})
+        self.state.delete_many({})
+
+    def get_retention(self):
+        retention = dict(rollups.DEFAULT_ROLLUP_RETENTION)
+        retention.update(get_optional_attribute(self.repositories.config, 'ROLLUP_RETENTION', {}))
+        return retention
+
+    def get_high_water_mark(self, tier):
+        state = self.state.find_one({'_id': tier})
+        return state['high_water_mark'] if state is not None else None
+
+    def set_high_water_mark(self, tier, timestamp):
+        self.state.update_one({'_id': tier}, {"$set": {'high_water_mark': timestamp}}, upsert=True)
+
+    def get_oldest_timestamp(self, tier):
+        oldest = self.collection.find({'tier': tier}, {'period_start': 1}).sort('period_start', ASCENDING).limit(1)
+        for rollup in oldest:
+            return rollups.to_timestamp(rollup['period_start'])
+        return None
+
+    def compact(self, now=None):
+        now = time.time() if now is None else now
+        # Readings are timestamped when the poll starts and written when it finishes, so the newest periods
+        # are left open for a while.
+        source_end = now - get_optional_attribute(self.repositories.config, 'ROLLUP_DELAY_SECONDS', 300)
+        source_tier = None
+        written = 0
+        for tier, step in rollups.ROLLUP_TIERS:
+            written += self.compact_tier(tier, step, source_tier, source_end)
+            source_end = self.get_high_water_mark(tier)
+            if source_end is None:
+                break
+            source_tier = tier
+        self.apply_retention(now)
+        return written
+
+    def compact_tier(self, tier, step, source_tier, source_end):
+        end = rollups.get_period_start(source_end, step)
+        start = self.get_high_water_mark(tier)
+        if start is None:
+            start = (self.repositories.reading_repository.get_oldest_timestamp() if source_tier is None
+                     else self.get_oldest_timestamp(source_tier))
+            if start is None:
+                return 0
+            start = rollups.get_period_start(start, step)
+        if start >= end:
+            return 0
+        periods = {}
+
+        def get_period(source, timestamp):
+            period_start = rollups.get_period_start(timestamp, step)
+            key = (source.device_id, period_start)
+            if key not in periods:
+                periods[key] = {'device_id': source.device_id, 'house_id': source.house_id, 'room_id': source.room_id,
+                                'owner_user_id': source.owner_user_id, 'device_type': source.device_type,
+                                'tier': tier, 'period_start': rollups.to_datetime(period_start), 'count': 0,
+                                'fields': {}}
+            return periods[key]
+
+        if source_tier is None:
+            for bucket in self.repositories.reading_repository.get_buckets({}, start, end):
+                for timestamp, value in bucket.get_readings(start, end):
+                    period = get_period(bucket, timestamp)
+                    period['count'] += 1
+                    rollups.add_reading(period['fields'], timestamp, value)
+        else:
+            for rollup in self.get_rollups({}, start, end, tier=source_tier):
+                period = get_period(rollup, rollups.to_timestamp(rollup.period_start))
+                period['count'] += rollup.count
+                rollups.merge_fields(period['fields'], rollup.fields)
+        requests = [UpdateOne({'tier': tier, 'device_id': period['device_id'], 'period_start': period['period_start']},
+                              {"$set": period}, upsert=True) for period in periods.values()]
+        batch_size = get_optional_attribute(self.repositories.config, 'POLL_WRITE_BATCH_SIZE', 500)
+        for batch_start in range(0, len(requests), batch_size):
+            self.collection.bulk_write(requests[batch_start:batch_start + batch_size], ordered=False)
+        self.set_high_water_mark(tier, end)
+        return len(requests)
+
+    def apply_retention(self, now=None):
+        # A tier is only trimmed up to where the next tier has been compacted, so nothing is dropped before it
+        # has been summarised.
+        now = time.time() if now is None else now
+        retention = self.get_retention()
+        tiers = [('raw', None)] + list(rollups.ROLLUP_TIERS)
+        for index, (tier, step) in enumerate(tiers):
+            if retention.get(tier) is None:
+                continue
+            cutoff = now - retention[tier]
+            if index + 1 < len(tiers):
+                compacted_until = self.get_high_water_mark(tiers[index + 1][0])
+                if compacted_until is None:
+                    continue
+                cutoff = min(cutoff, compacted_until)
+            if step is None:
+                self.repositories.reading_repository.remove_readings_before(cutoff)
+            else:
+                self.collection.delete_many({'tier': tier,
+                                             'period_start': {'$lte': rollups.to_datetime(cutoff - step)}})
+
+    def get_rollups(self, query, start, end, tier=None, max_points=None, now=None):
+        # start and end are epoch seconds. Without an explicit tier the finest one that answers the range in
+        # at most max_points periods is used.
+        if tier is None:
+            max_points = max_points or get_optional_attribute(self.repositories.config, 'ROLLUP_MAX_POINTS', 500)
+            tier = rollups.choose_tier(start, end, max_points, self.get_retention(),
+                                       time.time() if now is None else now)
+        start = rollups.get_period_start(start, dict(rollups.ROLLUP_TIERS)[tier])
+        query = dict(query, tier=tier, period_start={'$gte': rollups.to_datetime(start),
+                                                     '$lt': rollups.to_datetime(end)})
+        return [ReadingRollup(rollup) for rollup in self.collection.find(query).sort('period_start', ASCENDING)]
+
+
+class DailyAggregateRepository(Repository):
+    # One document per user per day with min/max/sum/count of every numeric reading field per device type,
+    # updated in place by the poll flush so that graphs never have to touch the readings themselves.
+    indexes = [IndexModel([('owner_user_id', ASCENDING), ('day', ASCENDING)], unique=True)]
+    owner_field = 'owner_user_id'
+    resolutions = {'day': lambda day: day,
+                   'week': lambda day: day - datetime.timedelta(days=day.weekday()),
+                   'month': lambda day: day.replace(day=1)}
+
+    def __init__(self, mongo_collection, repository_collection):
+        Repository.__init__(self, mongo_collection, repository_collection)
+
+    def get_append_update(self, device, reading):
+        if device.owner_user_id is None or not isinstance(reading, dict) or reading.get('error') is not None \
+                or 'timestamp' not in reading:
+            return None
+        timestamp = float(reading['timestamp'])
+        update = {"$inc": {}, "$min": {}, "$max": {}}
+        for name, value in rollups.get_reading_fields(get_reading_values(reading)).items():
+            if not rollups.is_number(value) or '.' in name or name.startswith('$'):
+                continue
+            path = 'series.{}.{}'.format(device.device_type, name)
+            update["$inc"][path + '.sum'] = value
+            update["$inc"][path + '.count'] = 1
+            update["$min"][path + '.min'] = value
+            update["$max"][path + '.max'] = value
+        if len(update["$inc"]) == 0:
+            return None
+        day = rollups.to_datetime(rollups.get_period_start(timestamp, 86400))
+        return UpdateOne({'owner_user_id': device.owner_user_id, 'day': day}, update, upsert=True)
+
+    def get_user_graph(self, user_id, start, end, resolution='day'):
+        # start and end are dates, end exclusive. Returns {period: {device_type.field: {min, max, mean, count}}}
+        # with one period per day, week (starting on Monday) or month.
+        get_period = self.resolutions[resolution]
+        periods = {}
+        for aggregate in self.collection.find({'owner_user_id': user_id,
+                                               'day': {'$gte': datetime.datetime.combine(start, datetime.time()),
+                                                       '$lt': datetime.datetime.combine(end, datetime.time())}}):
+            period = periods.setdefault(get_period(aggregate['day'].date()).isoformat(), {})
+            for device_type, fields in aggregate.get('series', {}).items():
+                for name, summary in fields.items():
+                    series = '{}.{}'.format(device_type, name)
+                    if series not in period:
+                        period[series] = dict(summary)
+                        continue
+                    period[series]['sum'] += summary['sum']
+                    period[series]['count'] += summary['count']
+                    period[series]['min'] = min(period[series]['min'], summary['min'])
+                    period[series]['max'] = max(period[series]['max'], summary['max'])
+        return {label: {series: {'min': summary['min'], 'max': summary['max'], 'count': summary['count'],
+                                 'mean': rollups.get_mean(summary)}
+                        for series, summary in period.items()}
+                for label, period in periods.items()}
+
+
+class EnergyRepository(Repository):
+    # Daily energy samples of every device that reports them, synchronised from the vendor so that
+    # consumption queries never have to wait for it.
+    indexes = [IndexModel([('device_id', ASCENDING), ('timestamp', ASCENDING)], unique=True),
+               IndexModel([('owner_user_id', ASCENDING), ('timestamp', ASCENDING)]),
+               IndexModel([('timestamp', ASCENDING)])]
+    owner_field = 'owner_user_id'
+
+    def __init__(self, mongo_collection, repository_collection):
+        Repository.__init__(self, mongo_collection, repository_collection)
+
+    @staticmethod
+    def get_energy_samples(consumption):
+        # (epoch seconds, watts) pairs from a vendor energy reading, or None if it has no data.
+        if consumption.get('error') is not None or not isinstance(consumption.get('data'), dict) \
+                or not isinstance(consumption['data'].get('data'), list):
+            return None
+        return [(timestamp, watts) for timestamp, watts in consumption['data']['data']]
+
+    def get_last_sample_time(self, device_id):
+        samples = self.collection.find({'device_id': device_id}, {'timestamp': 1}).sort('timestamp', -1).limit(1)
+        for sample in samples:
+            return rollups.to_timestamp(sample['timestamp'])
+        return None
+
+    def get_sync_start(self, device_id, now):
+        # The newest stored day is asked for again as the vendor keeps adding to it until the day is over;
+        # everything before it is never requested twice, however long ago the last sync was.
+        last_sample_time = self.get_last_sample_time(device_id)
+        if last_sample_time is None:
+            return now - get_optional_attribute(self.repositories.config, 'ENERGY_BACKFILL_DAYS', 30) * 86400
+        return last_sample_time
+
+    def sync(self, now=None):
+        now = time.time() if now is None else now
+        devices = self.repositories.device_repository.get_energy_devices()
+        start_times = {device.get_device_id(): datetime.datetime.fromtimestamp(
+            self.get_sync_start(device.get_device_id(), now)) for device in devices}
+        readings = self.repositories.device_poller.get_energy_readings(devices, start_times)
+        requests = []
+        for device in devices:
+            samples = self.get_energy_samples(readings.get(device.get_device_id(), {}))
+            if samples is None:
+                logging.warning("Cannot sync energy samples of device {}: {}".format(
+                    device.get_device_id(), readings.get(device.get_device_id(), {}).get('error')))
+                continue
+            for timestamp, watts in samples:
+                requests.append(UpdateOne({'device_id': device.device_id, 'timestamp': rollups.to_datetime(timestamp)},
+                                          {"$set": {'watts': watts, 'house_id': device.house_id,
+                                                    'owner_user_id': device.owner_user_id}},
+                                          upsert=True))
+        batch_size = get_optional_attribute(self.repositories.config, 'POLL_WRITE_BATCH_SIZE', 500)
+        for start in range(0, len(requests), batch_size):
+            self.collection.bulk_write(requests[start:start + batch_size], ordered=False)
+        if len(requests) > 0:
+            self.repositories.device_repository.overall_consumption_cache = None
+        return len(requests)
+
+    def get_samples(self, query, start, end):
+        query = dict(query, timestamp={'$gte': rollups.to_datetime(start), '$lt': rollups.to_datetime(end)})
+        return self.collection.find(query, {'timestamp': 1, 'watts': 1}).sort('timestamp', ASCENDING)
+
+    @staticmethod
+    def sum_per_day(samples):
+        totals = collections.Counter()
+        for sample in samples:
+            totals[datetime.datetime.fromtimestamp(rollups.to_timestamp(sample['timestamp'])).date()] += \
+                sample['watts']
+        return [[day, totals[day]] for day in sorted(totals)]
+
+    def get_device_consumption(self, device_id, start, end):
+        return self.sum_per_day(self.get_samples({'device_id': device_id}, start, end))
+
+    def get_overall_consumption(self, start, end):
+        return self.sum_per_day(self.get_samples({}, start, end))
+
+    def remove_device_samples(self, device_id):
+        self.collection.delete_many({'device_id': device_id})
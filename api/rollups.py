@@ -0,0 +1,75 @@
+import calendar
+import datetime
+
+# Rollup tiers from finest to coarsest. The first tier is built from the raw readings, every other tier
+# from the one before it.
+ROLLUP_TIERS = (('5m', 300), ('1h', 3600), ('1d', 86400))
+# Seconds each tier is kept for, None keeps it forever.
+DEFAULT_ROLLUP_RETENTION = {'raw': 7 * 86400, '5m': 90 * 86400, '1h': None, '1d': None}
+
+
+def to_datetime(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+
+def to_timestamp(date):
+    return calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6
+
+
+def get_period_start(timestamp, step):
+    return timestamp - timestamp % step
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def get_reading_fields(value):
+    return value if isinstance(value, dict) else {'value': value}
+
+
+def add_reading(fields, timestamp, value):
+    # Numeric fields keep min/max/sum/count, every field (including on/off or open/closed states) keeps its
+    # last value.
+    for name, field_value in get_reading_fields(value).items():
+        summary = {'count': 1, 'last': field_value, 'last_timestamp': timestamp}
+        if is_number(field_value):
+            summary.update({'min': field_value, 'max': field_value, 'sum': field_value})
+        merge_summary(fields, name, summary)
+
+
+def merge_summary(fields, name, summary):
+    current = fields.get(name)
+    if current is None:
+        fields[name] = dict(summary)
+        return
+    current['count'] += summary['count']
+    for key, combine in (('min', min), ('max', max), ('sum', lambda a, b: a + b)):
+        if key in current and key in summary:
+            current[key] = combine(current[key], summary[key])
+        elif key in summary:
+            current[key] = summary[key]
+    if summary['last_timestamp'] >= current['last_timestamp']:
+        current['last'] = summary['last']
+        current['last_timestamp'] = summary['last_timestamp']
+
+
+def merge_fields(fields, other_fields):
+    for name, summary in other_fields.items():
+        merge_summary(fields, name, summary)
+
+
+def get_mean(summary):
+    if summary is None or 'sum' not in summary or summary['count'] == 0:
+        return None
+    return summary['sum'] / summary['count']
+
+
+def choose_tier(start, end, max_points, retention, now):
+    # The finest tier that still has data for the start of the range and answers it in at most max_points
+    # periods; ranges too long for every tier get the coarsest one.
+    for tier, step in ROLLUP_TIERS:
+        kept_for = retention.get(tier)
+        if (kept_for is None or start >= now - kept_for) and (end - start) / step <= max_points:
+            return tier
+    return ROLLUP_TIERS[-1][0]
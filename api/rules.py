@@ -0,0 +1,305 @@
+import itertools
+import re
+import time
+
+from bson import ObjectId
+
+# Rules combine conditions on the latest readings of one or more sensors, for example
+#
+#     motion AND 5a1f0c2e9d3b4a0012345678.temperature < 18 AND after 22:00
+#
+# A bare field refers to the sensor of the trigger, <device id>.<field> to any other sensor. Conditions are
+# comparisons (<, <=, >, >=, ==, !=) of fields, numbers, quoted strings, true and false, a field on its own
+# (true when it is set), and "after HH:MM" / "before HH:MM" on the local time of day, combined with AND, OR,
+# NOT and parentheses.
+#
+# A rule is parsed once into an AST of tuples and compiled into closures. Equal subexpressions, also across
+# rules, share one closure whose result is remembered for the rest of an evaluation batch.
+TOKEN_PATTERN = re.compile(r"""\s*(?:
+    (?P<reference>[0-9a-fA-F]{24}\.[A-Za-z_]\w*)|
+    (?P<time>\d{1,2}:\d{2})|
+    (?P<number>-?\d+(?:\.\d+)?)|
+    (?P<operator><=|>=|==|!=|<|>)|
+    (?P<paren>[()])|
+    (?P<string>"[^"]*"|'[^']*')|
+    (?P<word>[A-Za-z_]\w*))""", re.VERBOSE)
+COMPARISONS = {
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+}
+KEYWORDS = ('and', 'or', 'not', 'after', 'before', 'true', 'false')
+
+
+class RuleSyntaxError(ValueError):
+    pass
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if match is None:
+            raise RuleSyntaxError("Unexpected input at position {}: {}".format(position, text[position:]))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'word' and value.lower() in KEYWORDS:
+            kind, value = 'keyword', value.lower()
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class RuleParser(object):
+    def __init__(self, text, sensor_id):
+        self.tokens = tokenize(text)
+        self.position = 0
+        self.sensor_id = sensor_id
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if token[0] is None or (kind is not None and token[0] != kind) or (value is not None and token[1] != value):
+            raise RuleSyntaxError("Expected {} but found {}".format(value or kind or "a condition", token[1]))
+        self.position += 1
+        return token
+
+    def parse(self):
+        if len(self.tokens) == 0:
+            raise RuleSyntaxError("Empty rule")
+        node = self.parse_junction('or')
+        if self.position < len(self.tokens):
+            raise RuleSyntaxError("Unexpected {}".format(self.peek()[1]))
+        return node
+
+    def parse_junction(self, keyword):
+        parse_operand = (lambda: self.parse_junction('and')) if keyword == 'or' else self.parse_negation
+        operands = [parse_operand()]
+        while self.peek() == ('keyword', keyword):
+            self.take()
+            operands.append(parse_operand())
+        if len(operands) == 1:
+            return operands[0]
+        # Nested junctions of the same kind are flattened and ordered, so that "a AND b" and "b AND a" are the
+        # same subexpression.
+        flattened = set()
+        for operand in operands:
+            flattened.update(operand[1] if operand[0] == keyword else (operand,))
+        return (keyword, tuple(sorted(flattened, key=repr)))
+
+    def parse_negation(self):
+        if self.peek() == ('keyword', 'not'):
+            self.take()
+            return ('not', self.parse_negation())
+        return self.parse_condition()
+
+    def parse_condition(self):
+        kind, value = self.peek()
+        if kind == 'paren' and value == '(':
+            self.take()
+            node = self.parse_junction('or')
+            self.take('paren', ')')
+            return node
+        if kind == 'keyword' and value in ('after', 'before'):
+            self.take()
+            hours, minutes = self.take('time')[1].split(':')
+            if int(hours) > 23 or int(minutes) > 59:
+                raise RuleSyntaxError("Invalid time of day {}:{}".format(hours, minutes))
+            return ('time', value, int(hours) * 60 + int(minutes))
+        left = self.parse_value()
+        if self.peek()[0] != 'operator':
+            if left[0] != 'field':
+                raise RuleSyntaxError("Expected a comparison after {}".format(left[1]))
+            return ('set', left)
+        operator = self.take()[1]
+        return ('compare', operator, left, self.parse_value())
+
+    def parse_value(self):
+        kind, value = self.take()
+        if kind == 'reference':
+            device_id, field = value.split('.')
+            return ('field', ObjectId(device_id), field)
+        if kind == 'word':
+            if self.sensor_id is None:
+                raise RuleSyntaxError("Field {} needs a device id".format(value))
+            return ('field', self.sensor_id, value)
+        if kind == 'number':
+            return ('constant', float(value))
+        if kind == 'string':
+            return ('constant', value[1:-1])
+        if kind == 'keyword' and value in ('true', 'false'):
+            return ('constant', value == 'true')
+        raise RuleSyntaxError("Expected a value but found {}".format(value))
+
+
+def parse_rule(text, sensor_id=None):
+    if not isinstance(text, str):
+        raise RuleSyntaxError("A rule must be a string")
+    return RuleParser(text, sensor_id).parse()
+
+
+def get_nodes(node):
+    yield node
+    if node[0] in ('and', 'or'):
+        for operand in node[1]:
+            for child in get_nodes(operand):
+                yield child
+    elif node[0] in ('not', 'set'):
+        for child in get_nodes(node[1]):
+            yield child
+    elif node[0] == 'compare':
+        for child in itertools.chain(get_nodes(node[2]), get_nodes(node[3])):
+            yield child
+
+
+def get_rule_sensor_ids(text, sensor_id=None):
+    # Raises RuleSyntaxError if the rule cannot be parsed.
+    return set(node[1] for node in get_nodes(parse_rule(text, sensor_id)) if node[0] == 'field')
+
+
+def to_number(value):
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def compare(operator, left, right):
+    # Unknown fields fail every comparison; numbers (and true/false) compare as numbers, anything else only
+    # for (in)equality.
+    if left is None or right is None:
+        return False
+    left_number, right_number = to_number(left), to_number(right)
+    if left_number is not None and right_number is not None:
+        return COMPARISONS[operator](left_number, right_number)
+    if operator in ('==', '!='):
+        return COMPARISONS[operator](str(left).lower(), str(right).lower())
+    return False
+
+
+def is_set(value):
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'on', 'open')
+    return bool(value)
+
+
+class RuleContext(object):
+    # One evaluation batch: the latest field values per sensor and the results of the subexpressions so far.
+    def __init__(self, values, now=None):
+        self.values = values
+        self.now = time.time() if now is None else now
+        self.results = {}
+        self.minute_of_day = None
+
+    def get_value(self, sensor_id, field):
+        values = self.values.get(sensor_id)
+        return values.get(field) if isinstance(values, dict) else None
+
+    def get_minute_of_day(self):
+        if self.minute_of_day is None:
+            local_time = time.localtime(self.now)
+            self.minute_of_day = local_time.tm_hour * 60 + local_time.tm_min
+        return self.minute_of_day
+
+
+class CompiledRule(object):
+    def __init__(self, node, evaluate):
+        self.node = node
+        self.evaluate = evaluate
+        self.sensor_ids = frozenset(child[1] for child in get_nodes(node) if child[0] == 'field')
+        self.uses_time = any(child[0] == 'time' for child in get_nodes(node))
+
+
+class RuleCompiler(object):
+    # Compiled rules and subexpressions are reference counted. Released ones stay cached until prune() is
+    # called, so that a rule released and acquired again in one edit is not compiled again.
+    def __init__(self):
+        self.rules = {}
+        self.nodes = {}
+        self.node_ids = itertools.count()
+
+    def acquire(self, text, sensor_id=None):
+        key = (text, sensor_id)
+        if key not in self.rules:
+            node = parse_rule(text, sensor_id)
+            self.rules[key] = [CompiledRule(node, self.compile_node(node)), 0]
+        self.rules[key][1] += 1
+        return self.rules[key][0]
+
+    def release(self, text, sensor_id=None):
+        entry = self.rules.get((text, sensor_id))
+        if entry is not None:
+            entry[1] -= 1
+
+    def prune(self):
+        for key, (rule, references) in list(self.rules.items()):
+            if references <= 0:
+                del self.rules[key]
+                self.release_node(rule.node)
+
+    def release_node(self, node):
+        entry = self.nodes[node]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.nodes[node]
+            for child in self.get_children(node):
+                self.release_node(child)
+
+    def get_children(self, node):
+        if node[0] in ('and', 'or'):
+            return node[1]
+        if node[0] in ('not', 'set'):
+            return (node[1],)
+        if node[0] == 'compare':
+            return node[2:]
+        return ()
+
+    def compile_node(self, node):
+        if node in self.nodes:
+            self.nodes[node][1] += 1
+            return self.nodes[node][0]
+        children = [self.compile_node(child) for child in self.get_children(node)]
+        kind = node[0]
+        if kind == 'and':
+            compute = lambda context: all(child(context) for child in children)
+        elif kind == 'or':
+            compute = lambda context: any(child(context) for child in children)
+        elif kind == 'not':
+            compute = lambda context: not children[0](context)
+        elif kind == 'set':
+            compute = lambda context: is_set(children[0](context))
+        elif kind == 'compare':
+            operator = node[1]
+            compute = lambda context: compare(operator, children[0](context), children[1](context))
+        elif kind == 'time':
+            after, minute = node[1] == 'after', node[2]
+            compute = lambda context: (context.get_minute_of_day() >= minute) == after
+        elif kind == 'field':
+            sensor_id, field = node[1], node[2]
+            compute = lambda context: context.get_value(sensor_id, field)
+        else:
+            value = node[1]
+            compute = lambda context: value
+        if kind in ('field', 'constant'):
+            evaluate = compute
+        else:
+            node_id = next(self.node_ids)
+
+            def evaluate(context):
+                results = context.results
+                if node_id not in results:
+                    results[node_id] = compute(context)
+                return results[node_id]
+        self.nodes[node] = [evaluate, 1]
+        return evaluate
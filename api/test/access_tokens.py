@@ -0,0 +1,39 @@
+import unittest
+
+from bson import ObjectId
+
+from access_tokens import RevocationFilter, get_token_hash, sign_access_token, verify_access_token
+
+
+class AccessTokenTests(unittest.TestCase):
+    def setUp(self):
+        self.user_id = ObjectId()
+        self.token = sign_access_token(self.user_id, True, 1000, "secret")
+
+    def test_TokenVerifiedCorrectly(self):
+        payload = verify_access_token(self.token, "secret", now=500)
+        self.assertEqual(payload['user_id'], str(self.user_id), "Token user not verified correctly.")
+        self.assertTrue(payload['is_admin'], "Token admin flag not verified correctly.")
+
+    def test_ExpiredTokenRejected(self):
+        self.assertIsNone(verify_access_token(self.token, "secret", now=1000), "Expired token was accepted.")
+
+    def test_TamperedTokenRejected(self):
+        self.assertIsNone(verify_access_token(self.token, "other secret", now=500), "Wrong secret was accepted.")
+        forged = sign_access_token(ObjectId(), True, 1000, "other secret")
+        body = forged.split('.')[1]
+        tampered = "v1.{}.{}".format(body, self.token.split('.')[2])
+        self.assertIsNone(verify_access_token(tampered, "secret", now=500), "Tampered token was accepted.")
+        self.assertIsNone(verify_access_token("v1.garbage", "secret", now=500), "Malformed token was accepted.")
+
+    def test_NonAsciiTokenRejected(self):
+        self.assertIsNone(verify_access_token("v1.\u00e9.x", "secret", now=500), "Non-ASCII body was accepted.")
+        self.assertIsNone(verify_access_token("v1.abc.\u00e9", "secret", now=500), "Non-ASCII signature was accepted.")
+
+    def test_RevocationFilter(self):
+        revocation_filter = RevocationFilter(size=1024)
+        revocation_filter.add(get_token_hash(self.token))
+        self.assertTrue(revocation_filter.contains(get_token_hash(self.token)), "Revoked token not found.")
+        self.assertFalse(revocation_filter.contains(get_token_hash("another token")), "Token wrongly revoked.")
+        revocation_filter.replace([])
+        self.assertFalse(revocation_filter.contains(get_token_hash(self.token)), "Filter was not replaced.")
@@ -0,0 +1,37 @@
+import concurrent.futures
+import threading
+import unittest
+
+from action_dispatcher import ActionDispatcher
+
+
+class ActionDispatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = ActionDispatcher(max_workers=2, window=1)
+        self.calls = []
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+
+    def record(self, actor_id, value):
+        return lambda: self.calls.append((actor_id, value))
+
+    def test_CoalescesToLastValue(self):
+        for value in (20, 21, 22):
+            self.dispatcher.submit("thermostat", "set_target_temperature", self.record("thermostat", value), now=0)
+        self.dispatcher.submit("switch", "set_light_switch", self.record("switch", 1), now=0)
+        self.assertEqual(self.dispatcher.dispatch(now=0.5), [], "Action dispatched within its window.")
+        concurrent.futures.wait(self.dispatcher.dispatch(now=1))
+        self.assertEqual(sorted(self.calls), [("switch", 1), ("thermostat", 22)], "Actions not coalesced.")
+        self.assertEqual(self.dispatcher.coalesced, 2)
+
+    def test_OneCommandPerActorAtATime(self):
+        release = threading.Event()
+        self.dispatcher.submit("thermostat", "set_target_temperature", release.wait, now=0)
+        futures = self.dispatcher.dispatch(now=1)
+        self.dispatcher.submit("thermostat", "set_target_temperature", self.record("thermostat", 25), now=1)
+        self.assertEqual(self.dispatcher.dispatch(now=5), [], "Second command sent to a busy actor.")
+        release.set()
+        concurrent.futures.wait(futures)
+        concurrent.futures.wait(self.dispatcher.dispatch(now=5))
+        self.assertEqual(self.calls, [("thermostat", 25)], "Queued command not sent once the actor was free.")
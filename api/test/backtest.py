@@ -0,0 +1,65 @@
+import math
+import random
+import unittest
+
+from bson import ObjectId
+
+from backtest import BacktestError, backtest_trigger
+from model import Trigger
+from trigger_engine import TriggerEngine
+
+
+def make_trigger(event, event_params, hysteresis=None, debounce=None):
+    return Trigger({'_id': ObjectId(), 'sensor_id': ObjectId(), 'event': event, 'event_params': event_params,
+                    'actor_id': ObjectId(), 'action': "set_light_switch", 'action_params': True,
+                    'user_id': ObjectId(), 'reading': None, 'hysteresis': hysteresis, 'debounce': debounce})
+
+
+def replay(trigger, readings):
+    # Fire times of the trigger engine evaluating the readings one by one.
+    engine = TriggerEngine()
+    engine.load([trigger])
+    fire_times = []
+    previous = None
+    for timestamp, values in readings:
+        reading = {"data": values, "timestamp": str(timestamp)}
+        if engine.evaluate(trigger.sensor_id, previous, reading, now=timestamp):
+            fire_times.append(timestamp)
+        previous = reading
+    return fire_times
+
+
+class BacktestTests(unittest.TestCase):
+    def setUp(self):
+        random.seed(7)
+
+    def test_MatchesEngineOnThresholds(self):
+        temperatures = [round(20 + 2 * math.sin(index / 50.0) + random.uniform(-0.5, 0.5), 1) for index in range(2000)]
+        readings = [(float(index * 60), {'temperature': value}) for index, value in enumerate(temperatures)]
+        for event, threshold in (("temperature_gets_higher_than", 21), ("temperature_gets_lower_than", "19.5")):
+            for hysteresis, debounce in ((None, None), (0.5, None), (0.3, 600)):
+                trigger = make_trigger(event, threshold, hysteresis, debounce)
+                fire_times = backtest_trigger(trigger, readings, 2000 * 60)
+                self.assertGreater(len(fire_times), 0)
+                self.assertEqual(fire_times, replay(trigger, readings),
+                                 "Backtest differs from the engine for {} {}.".format(event, hysteresis))
+
+    def test_MatchesEngineOnTransitions(self):
+        readings = [(float(index * 5), {'motion': random.random() < 0.3}) for index in range(2000)]
+        for event in ("motion_detected_start", "motion_detected_stop"):
+            trigger = make_trigger(event, None, debounce=30)
+            fire_times = backtest_trigger(trigger, readings, 10000)
+            self.assertGreater(len(fire_times), 0)
+            self.assertEqual(fire_times, replay(trigger, readings), "Backtest differs from the engine for " + event)
+
+    def test_Durations(self):
+        states = [(0, 1), (100, 1), (200, 0), (300, 1), (800, 1), (900, 0), (1000, 1)]
+        readings = [(float(timestamp), {'power_state': state}) for timestamp, state in states]
+        trigger = make_trigger("light_on_for", 400)
+        self.assertEqual(backtest_trigger(trigger, readings, 1300), [700.0])
+        self.assertEqual(backtest_trigger(trigger, readings, 1400), [700.0, 1400.0], "Running timer not fired.")
+
+    def test_Unsupported(self):
+        self.assertRaises(BacktestError, backtest_trigger, make_trigger("rule", "motion"), [], 0)
+        self.assertRaises(BacktestError, backtest_trigger, make_trigger("temperature_gets_higher_than", "warm"), [], 0)
+        self.assertEqual(backtest_trigger(make_trigger("temperature_gets_higher_than", 20), [], 0), [])
@@ -1,8 +1,20 @@
+import datetime
+import time
 import unittest
 
 from bson import ObjectId
 
 
+class FakeEnergyPoller(object):
+    def __init__(self, readings):
+        self.readings = readings
+        self.start_times = None
+
+    def get_energy_readings(self, devices, start_times=None):
+        self.start_times = start_times
+        return {device.get_device_id(): self.readings[device.get_device_id()] for device in devices}
+
+
 class AdminTests(unittest.TestCase):
     repository_collection = None
 
@@ -24,3 +36,42 @@ class AdminTests(unittest.TestCase):
         self.assertIsInstance(consumption, list, "Not returning correct format for energy consumption")
         # We can probably only assume that the length is 7 for devices that are actually being used.
         # self.assertEqual(len(consumption), 7, "Size of consumption array is not correct")
+
+    def test_EnergySyncAndConsumption(self):
+        repositories = AdminTests.repository_collection
+        adapter2id = self.devices.add_device(house_id=self.house1id, room_id=None, name="Second Adapter",
+                                             device_type="light_switch", target={}, status={},
+                                             configuration={"username": 'user', "password": 'pass', "device_id": '1'},
+                                             vendor='energenie')
+        self.devices.add_device(house_id=self.house1id, room_id=None, name="Own Thermostat",
+                                device_type="thermostat", target={}, status={}, configuration={"url": "http://own"},
+                                vendor='OWN')
+        now = time.time()
+        day = now - now % 86400 - 86400
+        fake_poller = FakeEnergyPoller({
+            self.adapter1id: {"data": {"data": [[day + 86400, 5], [day, 3]]}},
+            adapter2id: {"data": {"data": [[day + 86400, 2]]}}})
+        poller = repositories.device_poller
+        repositories.device_poller = fake_poller
+        self.devices.overall_consumption_cache = None
+        try:
+            self.assertEqual(repositories.energy_repository.sync(now), 3, "Energy samples not stored.")
+            self.assertEqual(len(fake_poller.start_times), 2, "Devices without energy readings synchronised.")
+            consumption = self.devices.get_overall_consumption(now + 1)
+            self.assertEqual(consumption, [[datetime.datetime.fromtimestamp(day).date(), 3],
+                                           [datetime.datetime.fromtimestamp(day + 86400).date(), 7]],
+                             "Consumption not summed per day.")
+            self.assertEqual(len(self.devices.get_energy_consumption(adapter2id, now + 1)), 1,
+                             "Device consumption not read locally.")
+
+            fake_poller.readings[adapter2id] = {"error": "Offline"}
+            fake_poller.readings[self.adapter1id] = {"data": {"data": [[day + 86400, 6]]}}
+            repositories.energy_repository.sync(now + 3600)
+            self.assertEqual(fake_poller.start_times[self.adapter1id], datetime.datetime.fromtimestamp(day + 86400),
+                             "Sync did not resume from the last stored sample.")
+            self.assertEqual(self.devices.get_overall_consumption(now + 3600)[-1][1], 8,
+                             "Last day not updated or failing device not skipped.")
+        finally:
+            repositories.device_poller = poller
+            self.devices.overall_consumption_cache = None
+            repositories.energy_repository.clear_db()
@@ -1,8 +1,36 @@
 import logging
+import time
 import unittest
 
 from bson import ObjectId
 
+from poller import DevicePoller
+from vendors import VendorAdapter, VendorException, register_vendor_adapter
+
+
+class ShadowTestAdapter(VendorAdapter):
+    name = "shadow_test"
+    operations = ('read', 'power_state')
+
+    def __init__(self):
+        VendorAdapter.__init__(self, retries=0)
+        self.reachable = True
+        self.power_state = 1
+        self.delay = 0
+
+    def get_endpoint_key(self, device):
+        return self.name
+
+    def fetch_state(self, device, include_usage_data, timeout):
+        time.sleep(self.delay)
+        return {'power_state': self.power_state}
+
+    def push_power_state(self, device, power_state, timeout):
+        if not self.reachable:
+            raise VendorException("Switch offline")
+        self.power_state = power_state
+        return {'power_state': power_state}
+
 
 class DeviceTests(unittest.TestCase):
     repository_collection = None
@@ -122,3 +150,138 @@ class DeviceTests(unittest.TestCase):
         self.assertIn(current_state_data["power_state"], [0, 1])
         self.assertIn("voltage", current_state_data)
         # self.assertEquals(current_state['data']['device_id'], 46865, 'state not read correctly')
+
+    def test_FaultyDeviceCounters(self):
+        repositories = DeviceTests.repository_collection
+        user_id = repositories.user_repository.add_user("Fault Owner", "hash", "faults@example.com", False)
+        house_id = repositories.house_repository.add_house(user_id, "Fault House", None)
+        device_id = self.devices.add_device(house_id, None, "Broken Sensor", "motion_sensor", {},
+                                            {'power_state': 1}, None, "example")
+        device = self.devices.get_device_by_id(device_id)
+        self.assertTrue(device.faulty, "Device with a failing reading not marked as faulty.")
+        self.assertIsNotNone(device.fault_since, "Fault start not recorded.")
+        self.assertEqual(repositories.house_repository.collection.find_one({'_id': house_id})['faulty_device_count'],
+                         1, "House fault counter not incremented.")
+        self.assertTrue(repositories.user_repository.get_user_by_id(user_id).faulty, "User not marked as faulty.")
+        faulty_devices = repositories.user_repository.get_faulty_devices_for_user(user_id)
+        self.assertEqual([d.device_id for d in faulty_devices], [device_id], "Faulty devices of user not found.")
+        self.assertEqual(len(self.devices.get_faulty_devices(page=1, page_size=4)), 1, "Faulty devices not paged.")
+
+        self.devices.write_device_readings([device], {device_id: {"data": {"motion": 0}, "timestamp": "0"}})
+        device = self.devices.get_device_by_id(device_id)
+        self.assertFalse(device.faulty, "Recovered device still marked as faulty.")
+        self.assertIsNone(device.fault_since, "Fault start not cleared.")
+        self.assertEqual(repositories.user_repository.collection.find_one({'_id': user_id})['faulty_device_count'],
+                         0, "User fault counter not decremented.")
+        self.assertFalse(repositories.user_repository.get_user_by_id(user_id).faulty, "User still marked as faulty.")
+        repositories.user_repository.remove_user(user_id)
+        repositories.house_repository.remove_house(house_id)
+
+    def test_UpdateAllDeviceReadings(self):
+        self.devices.collection.update_many({}, {"$set": {'status.last_read': 0}})
+        self.devices.update_all_device_readings()
+        for device in self.devices.get_all_devices():
+            self.assertIn("timestamp", device.status['last_read'], "Device reading was not written.")
+
+    def test_DesiredStateReconciled(self):
+        adapter = register_vendor_adapter(ShadowTestAdapter())
+        device_id = self.devices.add_device(self.house1id, None, "Hall Switch", "light_switch", {},
+                                            {'power_state': 1}, {}, "shadow_test")
+        adapter.reachable = False
+        self.devices.set_power_state(device_id, 0)
+        device = self.devices.get_device_by_id(device_id)
+        self.assertEqual(device.target['power_state'], 0, "Desired state not recorded.")
+        self.assertEqual(device.status['power_state'], 1, "Desired state reported before the device took it.")
+        self.assertTrue(device.shadow['pending'], "Desired state not queued.")
+
+        now = device.shadow['next_attempt']
+        self.assertEqual(self.devices.reconcile_devices(now=now), 1, "Pending device not reconciled.")
+        device = self.devices.get_device_by_id(device_id)
+        self.assertTrue(device.shadow['pending'], "Failed push cleared the desired state.")
+        self.assertEqual(device.shadow['attempts'], 1, "Failed attempt not counted.")
+        self.assertEqual(device.shadow['last_error'], "Switch offline", "Push error not recorded.")
+        self.assertEqual(device.shadow['next_attempt'], now + 30, "Retry not backed off.")
+        self.assertEqual(self.devices.reconcile_devices(now=now + 10), 0, "Retried before the backoff passed.")
+
+        adapter.reachable = True
+        self.assertEqual(self.devices.reconcile_devices(now=now + 30), 1, "Due device not reconciled.")
+        device = self.devices.get_device_by_id(device_id)
+        self.assertEqual(adapter.power_state, 0, "Desired state not pushed.")
+        self.assertEqual(device.status['power_state'], 0, "Pushed state not reported.")
+        self.assertFalse(device.shadow['pending'], "Desired state still queued after the push.")
+        self.assertEqual(device.get_unreported_state(), {}, "Device still differs from its desired state.")
+
+    def test_DesiredStateUnsupported(self):
+        device_id = self.devices.add_device(self.house1id, None, "Hall Sensor", "motion_sensor", {}, {}, {},
+                                            "shadow_test")
+        device = self.devices.get_device_by_id(device_id)
+        self.assertEqual(device.push_desired_state('power_state', 0), "Device type does not support desired state",
+                         "Unsupported push not reported as an error.")
+        self.devices.set_desired_state(device, 'power_state', 0)
+        device = self.devices.get_device_by_id(device_id)
+        self.assertEqual(device.status['power_state'], 0, "Unsupported desired state not reported right away.")
+        self.assertFalse(device.shadow.get('pending', False), "Unsupported desired state queued.")
+
+    def test_ReadingReportsState(self):
+        register_vendor_adapter(ShadowTestAdapter())
+        device_id = self.devices.add_device(self.house1id, None, "Hall Switch", "light_switch", {},
+                                            {'power_state': 1}, {}, "shadow_test")
+        device = self.devices.get_device_by_id(device_id)
+        self.devices.write_device_readings([device], {device_id: {"data": {"power_state": 0}, "timestamp": "0"}})
+        self.assertEqual(self.devices.get_device_by_id(device_id).status['power_state'], 0,
+                         "Reported state not taken from the reading.")
+
+    def test_FailedPollCycleReschedules(self):
+        repositories = DeviceTests.repository_collection
+        scheduler = repositories.poll_scheduler
+
+        def fail(devices):
+            raise IOError("Poller down")
+
+        scheduler.sync([(self.device1id, "thermostat")], now=0)
+        repositories.device_poller.poll = fail
+        try:
+            self.assertRaises(IOError, self.devices.update_due_device_readings)
+        finally:
+            del repositories.device_poller.poll
+        self.assertIn(self.device1id, scheduler.pop_due(now=time.time() + 3600),
+                      "Device dropped from the schedule after a failed poll cycle.")
+
+    def test_DevicesOverPollBudgetRescheduled(self):
+        repositories = DeviceTests.repository_collection
+        adapter = register_vendor_adapter(ShadowTestAdapter())
+        device_ids = [self.devices.add_device(self.house1id, None, "Switch {}".format(index), "light_switch", {},
+                                              {'power_state': 1}, {}, "shadow_test") for index in range(3)]
+        adapter.delay = 0.2
+        poller = repositories.device_poller
+        repositories.device_poller = DevicePoller(max_workers=1, call_timeout=1, cycle_budget=0.1)
+        try:
+            repositories.poll_scheduler.sync([(device_id, "light_switch") for device_id in device_ids], now=0)
+            self.devices.update_due_device_readings()
+        finally:
+            repositories.device_poller.shutdown()
+            repositories.device_poller = poller
+        errors = [self.devices.get_device_by_id(device_id).status['last_read'].get('error') for device_id in device_ids]
+        self.assertEqual(len([error for error in errors if error is not None and "budget" in error]), 3,
+                         "Devices left over when the budget ran out got no reading.")
+        self.assertEqual(sorted(repositories.poll_scheduler.pop_due(now=time.time() + 3600)), sorted(device_ids),
+                         "Devices left over when the budget ran out were not rescheduled.")
+
+    def test_StaleDevicesCountFaultOnce(self):
+        repositories = DeviceTests.repository_collection
+        user_id = repositories.user_repository.add_user("Stale Owner", "hash", "stale@example.com", False)
+        house_id = repositories.house_repository.add_house(user_id, "Stale House", None)
+        device_id = self.devices.add_device(house_id, None, "Stale Sensor", "motion_sensor", {},
+                                            {'power_state': 1}, None, "example")
+        self.devices.write_device_readings([self.devices.get_device_by_id(device_id)],
+                                           {device_id: {"data": {"motion": 0}, "timestamp": "0"}})
+        # Two writers that both read the device while it was working.
+        stale_devices = [self.devices.get_device_by_id(device_id) for _ in range(2)]
+        for device in stale_devices:
+            self.devices.write_device_readings([device], {device_id: {"error": "Offline", "timestamp": "1"}})
+        self.assertEqual(repositories.house_repository.collection.find_one({'_id': house_id})['faulty_device_count'],
+                         1, "Fault counted twice by stale writers.")
+        self.assertEqual(repositories.user_repository.collection.find_one({'_id': user_id})['faulty_device_count'],
+                         1, "Fault counted twice by stale writers.")
+        repositories.user_repository.remove_user(user_id)
+        repositories.house_repository.remove_house(house_id)
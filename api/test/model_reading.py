@@ -0,0 +1,98 @@
+import datetime
+import unittest
+
+from bson import ObjectId
+
+from model import Device
+
+HOUR = 1514764800
+
+
+class ReadingTests(unittest.TestCase):
+    repository_collection = None
+
+    def setUp(self):
+        self.readings = ReadingTests.repository_collection.reading_repository
+        self.devices = ReadingTests.repository_collection.device_repository
+        self.house_id = ObjectId()
+        self.room_id = ObjectId()
+        self.sensor = Device({'_id': ObjectId(), 'house_id': self.house_id, 'room_id': self.room_id,
+                              'name': "Hall Sensor", 'device_type': "motion_sensor"})
+        self.thermostat = Device({'_id': ObjectId(), 'house_id': self.house_id, 'room_id': None,
+                                  'name': "Hall Thermostat", 'device_type': "thermostat"})
+
+    def tearDown(self):
+        self.readings.clear_db()
+        ReadingTests.repository_collection.rollup_repository.clear_db()
+
+    def write(self, device, timestamp, data):
+        self.devices.write_device_readings([device], {device.device_id: {"data": data, "timestamp": str(timestamp)}})
+
+    def test_ReadingsShareHourlyBucket(self):
+        self.write(self.sensor, HOUR + 10, {'motion': 1, 'timestamp': 'sensor time'})
+        self.write(self.sensor, HOUR + 20, {'motion': 0})
+        self.write(self.sensor, HOUR + 3610, {'motion': 1})
+        buckets = self.readings.get_buckets({'device_id': self.sensor.device_id}, HOUR, HOUR + 7200)
+        self.assertEqual([bucket.timestamps for bucket in buckets], [[HOUR + 10, HOUR + 20], [HOUR + 3610]],
+                         "Readings not bucketed per hour.")
+        self.assertEqual(buckets[0].values[0], {'motion': 1}, "Reading values not stored.")
+
+    def test_ErrorReadingsNotStored(self):
+        self.devices.write_device_readings([self.sensor], {self.sensor.device_id: {"error": "Offline",
+                                                                                   "timestamp": str(HOUR)}})
+        self.assertEqual(self.readings.get_device_readings(self.sensor.device_id, HOUR, HOUR + 3600), [],
+                         "Error reading stored as history.")
+
+    def test_RangeQueries(self):
+        self.write(self.sensor, HOUR + 10, {'motion': 1})
+        self.write(self.sensor, HOUR + 50, {'motion': 0})
+        self.write(self.thermostat, HOUR + 30, {'temperature': 20})
+        self.assertEqual(self.readings.get_device_readings(self.sensor.device_id, HOUR + 20, HOUR + 3600),
+                         [(HOUR + 50, {'motion': 0})], "Device readings not limited to the range.")
+        self.assertEqual(len(self.readings.get_room_readings(self.room_id, HOUR, HOUR + 3600)), 2,
+                         "Room readings not found.")
+        self.assertEqual(len(self.readings.get_house_readings(self.house_id, HOUR, HOUR + 3600)), 3,
+                         "House readings not found.")
+
+    def test_Compaction(self):
+        rollup_repository = ReadingTests.repository_collection.rollup_repository
+        for minute in range(0, 120, 1):
+            self.write(self.thermostat, HOUR + minute * 60, {'temperature': minute % 10})
+        rollup_repository.compact(now=HOUR + 86400 + 3600)
+        five_minutes = rollup_repository.get_rollups({'device_id': self.thermostat.device_id}, HOUR, HOUR + 600,
+                                                     tier='5m')
+        self.assertEqual([rollup.count for rollup in five_minutes], [5, 5], "Readings not rolled up per 5 minutes.")
+        self.assertEqual(five_minutes[1].fields['temperature']['min'], 5, "Minimum not rolled up.")
+        hours = rollup_repository.get_rollups({'house_id': self.house_id}, HOUR, HOUR + 7200, tier='1h')
+        self.assertEqual([rollup.count for rollup in hours], [60, 60], "5 minute rollups not merged per hour.")
+        days = rollup_repository.get_rollups({'device_id': self.thermostat.device_id}, HOUR, HOUR + 86400,
+                                             tier='1d')
+        self.assertEqual(days[0].fields['temperature']['sum'], 540, "Hourly rollups not merged per day.")
+
+        self.write(self.thermostat, HOUR + 86400 + 60, {'temperature': 30})
+        rollup_repository.compact(now=HOUR + 86400 + 3600)
+        self.assertEqual(rollup_repository.get_rollups({'device_id': self.thermostat.device_id}, HOUR, HOUR + 86400,
+                                                       tier='1d')[0].count, 120, "Compacted period rolled up again.")
+
+        rollup_repository.compact(now=HOUR + 8 * 86400)
+        self.assertEqual(self.readings.get_device_readings(self.thermostat.device_id, HOUR, HOUR + 7200), [],
+                         "Raw readings kept past their retention.")
+        self.assertEqual(len(rollup_repository.get_rollups({}, HOUR, HOUR + 7200, tier='5m')), 24,
+                         "Rollups removed before their retention.")
+
+    def test_UserDailyGraph(self):
+        aggregates = ReadingTests.repository_collection.daily_aggregate_repository
+        user_id = ObjectId()
+        self.thermostat.owner_user_id = user_id
+        self.write(self.thermostat, HOUR + 60, {'temperature': 18, 'scale': "C"})
+        self.write(self.thermostat, HOUR + 120, {'temperature': 22})
+        self.write(self.thermostat, HOUR + 86400, {'temperature': 26})
+        day = datetime.datetime.utcfromtimestamp(HOUR).date()
+        graph = aggregates.get_user_graph(user_id, day, day + datetime.timedelta(days=2))
+        self.assertEqual(graph[day.isoformat()]['thermostat.temperature'],
+                         {'min': 18, 'max': 22, 'mean': 20, 'count': 2}, "Daily aggregate not maintained.")
+        self.assertEqual(len(graph), 2, "Days not graphed separately.")
+        weeks = aggregates.get_user_graph(user_id, day, day + datetime.timedelta(days=2), 'week')
+        self.assertEqual(sum(series['thermostat.temperature']['count'] for series in weeks.values()), 3,
+                         "Days not merged per week.")
+        aggregates.clear_db()
@@ -2,6 +2,8 @@ import unittest
 
 from bson import ObjectId
 
+from repositories import RepositoryCollection
+
 
 class TokenTests(unittest.TestCase):
     repository_collection = None
@@ -30,3 +32,49 @@ class TokenTests(unittest.TestCase):
     def test_TokensAreUnique(self):
         unique = self.tokens.check_token_is_new(self.token1)
         self.assertFalse(unique, "The existing token was not recognised.")
+
+    def test_CheckAccess(self):
+        repositories = TokenTests.repository_collection
+        owner_id = repositories.user_repository.add_user("Owner", "xxxxxxxx", "owner@example.com", False)
+        other_id = repositories.user_repository.add_user("Other", "xxxxxxxx", "other@example.com", False)
+        admin_id = repositories.user_repository.add_user("Admin", "xxxxxxxx", "admin@example.com", True)
+        house_id = repositories.house_repository.add_house(owner_id, "Owner's house", None)
+        device_id = repositories.device_repository.add_device(house_id, None, "Owner's switch", "light_switch", {},
+                                                              {}, None, "example")
+        device = repositories.device_repository.get_device_by_id(device_id)
+        self.assertEqual(device.owner_user_id, owner_id, "Device owner was not stored.")
+        entities = {repositories.house_repository: [house_id], repositories.device_repository: [device_id]}
+        self.assertTrue(repositories.check_access(self.tokens.generate_token(owner_id), entities),
+                        "Owner should have access.")
+        self.assertFalse(repositories.check_access(self.tokens.generate_token(other_id), entities),
+                         "Other user should not have access.")
+        self.assertTrue(repositories.check_access(self.tokens.generate_token(admin_id), entities),
+                        "Admin should have access.")
+        self.assertFalse(repositories.check_access(self.tokens.generate_token(admin_id),
+                                                   {repositories.device_repository: [ObjectId()]}),
+                         "Admin should not have access to a device that does not exist.")
+        self.assertFalse(repositories.check_access("invalid", entities), "Invalid token should not have access.")
+        self.assertFalse(repositories.check_access("v1.\u00e9.x", entities), "Non-ASCII token should not have access.")
+        repositories.device_repository.remove_device(device_id)
+        repositories.house_repository.remove_house(house_id)
+        for user_id in [owner_id, other_id, admin_id]:
+            repositories.user_repository.remove_user(user_id)
+
+    def test_SignedTokens(self):
+        repositories = RepositoryCollection(TokenTests.repository_collection.db,
+                                            {'SIGNED_TOKENS_ENABLED': True, 'TOKEN_SECRET': "secret"})
+        tokens = repositories.token_repository
+        user_id = repositories.user_repository.add_user("Signed", "xxxxxxxx", "signed@example.com", False)
+        token = tokens.generate_token(user_id)
+        self.assertIsNone(tokens.find_by_token(token), "Signed token should not be stored.")
+        self.assertTrue(tokens.authenticate_user(user_id, token), "Signed token was not accepted.")
+        self.assertFalse(tokens.authenticate_admin(token), "Signed token should not be admin.")
+        tokens.invalidate_token(token)
+        self.assertFalse(tokens.check_token_validity(token), "Revoked token was still accepted.")
+        other_process = RepositoryCollection(TokenTests.repository_collection.db,
+                                             {'SIGNED_TOKENS_ENABLED': True, 'TOKEN_SECRET': "secret"})
+        other_process.revoked_token_repository.sync_revocations()
+        self.assertFalse(other_process.token_repository.check_token_validity(token),
+                         "Revocation was not synchronised.")
+        repositories.user_repository.remove_user(user_id)
+        repositories.revoked_token_repository.clear_db()
@@ -1,3 +1,5 @@
+import concurrent.futures
+import time
 import unittest
 
 from bson import ObjectId
@@ -61,3 +63,112 @@ class TriggerTests(unittest.TestCase):
         self.triggers.remove_trigger(self.trigger3id)
         all_remaining_triggers = self.triggers.get_all_triggers()
         self.assertEqual(len(all_remaining_triggers), 2, "A trigger was not removed correctly.")
+
+    def test_TriggerFiresOnReading(self):
+        devices = TriggerTests.repository_collection.device_repository
+        house_id = ObjectId()
+        sensor_id = devices.add_device(house_id, None, "Hall Motion Sensor", "motion_sensor", {}, {}, None, "example")
+        thermostat_id = devices.add_device(house_id, None, "Hall Thermostat", "thermostat", {}, {}, None, "example")
+        trigger_id = self.triggers.add_trigger(sensor_id, "motion_detected_start", None, thermostat_id,
+                                               "set_target_temperature", "21", self.user1id)
+        sensor = devices.get_device_by_id(sensor_id)
+        sensor.status['last_read'] = {"data": {"motion": 0}, "timestamp": "0"}
+        reading = {"data": {"motion": 1}, "timestamp": "1"}
+        try:
+            devices.write_device_readings([sensor], {sensor_id: sensor.status['last_read']})
+            devices.write_device_readings([sensor], {sensor_id: reading})
+            concurrent.futures.wait(TriggerTests.repository_collection.action_dispatcher.dispatch(time.time() + 60))
+            self.assertEqual(devices.get_device_by_id(thermostat_id).target['target_temperature'], 21,
+                             "Trigger action not executed.")
+            trigger = self.triggers.get_trigger_by_id(trigger_id)
+            self.assertEqual(trigger.reading, reading, "Firing reading not stored.")
+            self.assertTrue(trigger.state['active'], "Trigger state not stored.")
+        finally:
+            devices.clear_db()
+
+    def test_TriggerLoops(self):
+        devices = TriggerTests.repository_collection.device_repository
+        house_id = ObjectId()
+        thermostat_id = devices.add_device(house_id, None, "Hall Thermostat", "thermostat", {}, {}, None, "example")
+        switch_id = devices.add_device(house_id, None, "Hall Light", "light_switch", {}, {}, None, "example")
+        try:
+            trigger_id = self.triggers.add_trigger(thermostat_id, "temperature_gets_higher_than", 22, switch_id,
+                                                   "set_light_switch", "0", self.user1id)
+            self.assertEqual(self.triggers.find_trigger_loop([switch_id], thermostat_id), [thermostat_id, switch_id])
+            self.assertEqual(self.triggers.find_trigger_loop([switch_id], switch_id), [switch_id])
+            self.assertIsNone(self.triggers.find_trigger_loop([thermostat_id], switch_id),
+                              "Existing edge reported as a new loop.")
+            self.triggers.graphs = {}
+            self.assertEqual(self.triggers.get_device_graph(thermostat_id).get_reachable(thermostat_id), {switch_id},
+                             "Graph not rebuilt from the stored triggers.")
+            self.triggers.remove_trigger(trigger_id)
+            self.assertIsNone(self.triggers.find_trigger_loop([switch_id], thermostat_id))
+        finally:
+            devices.clear_db()
+
+    def test_TriggerLoopsAcrossHouses(self):
+        devices = TriggerTests.repository_collection.device_repository
+        house_ids = [ObjectId(), ObjectId(), ObjectId()]
+        switch_ids = [devices.add_device(house_id, None, "Light {}".format(index), "light_switch", {}, {}, None,
+                                         "example") for index, house_id in enumerate(house_ids)]
+        try:
+            for sensor_id, actor_id in zip(switch_ids, switch_ids[1:]):
+                self.triggers.add_trigger(sensor_id, "motion_detected_start", None, actor_id, "set_light_switch", "1",
+                                          self.user1id)
+            self.assertEqual(self.triggers.find_trigger_loop([switch_ids[2]], switch_ids[0]), switch_ids,
+                             "Loop through three houses not found.")
+            devices.add_device_to_house(house_ids[0], switch_ids[1])
+            self.assertEqual(self.triggers.get_device_graph(switch_ids[0]).get_reachable(switch_ids[0]),
+                             {switch_ids[1]}, "Graphs not rebuilt after a device moved house.")
+            devices.remove_device(switch_ids[1])
+            self.assertIsNone(self.triggers.find_trigger_loop([switch_ids[2]], switch_ids[0]),
+                              "Removed device still closes a loop.")
+        finally:
+            devices.clear_db()
+
+    def test_BacktestStoredReadings(self):
+        devices = TriggerTests.repository_collection.device_repository
+        reading_repository = TriggerTests.repository_collection.reading_repository
+        house_id = ObjectId()
+        sensor_id = devices.add_device(house_id, None, "Hall Thermostat", "thermostat", {}, {}, None, "example")
+        sensor = devices.get_device_by_id(sensor_id)
+        now = time.time()
+        temperatures = [19, 21, 23, 21, 23, 19, 23]
+        reading_repository.collection.bulk_write([reading_repository.get_append_update(
+            sensor, {"data": {"temperature": value}, "timestamp": str(now - 3600 + index * 60)})
+            for index, value in enumerate(temperatures)])
+        try:
+            result = self.triggers.backtest_trigger(sensor_id, "temperature_gets_higher_than", 22, sensor_id,
+                                                    "set_target_temperature", "18", hysteresis=1.5, days=1, now=now)
+            self.assertEqual(result['reading_count'], len(temperatures))
+            self.assertEqual([action['timestamp'] for action in result['actions']],
+                             [now - 3600 + 120, now - 3600 + 360], "Wrong backtested firings.")
+            self.assertEqual(result['actions'][0]['action_params'], "18")
+            result = self.triggers.backtest_trigger(sensor_id, "temperature_gets_higher_than", 22, sensor_id,
+                                                    "set_target_temperature", "18", days=30, now=now)
+            self.assertEqual(result['start'], now - 7 * 86400, "Backtest not limited to the kept raw readings.")
+            self.assertEqual(result['days'], 7)
+        finally:
+            devices.clear_db()
+            reading_repository.clear_db()
+
+    def test_DurationTriggerSurvivesRestart(self):
+        devices = TriggerTests.repository_collection.device_repository
+        house_id = ObjectId()
+        sensor_id = devices.add_device(house_id, None, "Hall Motion Sensor", "motion_sensor", {}, {}, None, "example")
+        thermostat_id = devices.add_device(house_id, None, "Hall Thermostat", "thermostat", {}, {}, None, "example")
+        trigger_id = self.triggers.add_trigger(sensor_id, "no_motion_for", 600, thermostat_id,
+                                               "set_target_temperature", "16", self.user1id)
+        sensor = devices.get_device_by_id(sensor_id)
+        try:
+            devices.write_device_readings([sensor], {sensor_id: {"data": {"motion": 0}, "timestamp": "0"}})
+            due_at = self.triggers.get_trigger_by_id(trigger_id).state['due_at']
+            self.assertIsNotNone(due_at, "Armed timer not stored.")
+            self.triggers.engine = None
+            self.triggers.process_timers(due_at + 1)
+            concurrent.futures.wait(TriggerTests.repository_collection.action_dispatcher.dispatch(time.time() + 60))
+            self.assertEqual(devices.get_device_by_id(thermostat_id).target['target_temperature'], 16,
+                             "Restored timer did not fire.")
+            self.assertIsNone(self.triggers.get_trigger_by_id(trigger_id).state['due_at'], "Fired timer still stored.")
+        finally:
+            devices.clear_db()
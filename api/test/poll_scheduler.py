@@ -0,0 +1,51 @@
+import unittest
+
+from poll_scheduler import PollScheduler, has_reading_changed
+
+
+class PollSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = PollScheduler(intervals={'motion_sensor': (5, 60), 'thermostat': (100, 400)},
+                                       backoff_factor=2)
+        self.scheduler.schedule("motion", 'motion_sensor', now=0)
+        self.scheduler.schedule("thermostat", 'thermostat', now=0)
+
+    def test_NewDevicesDueImmediately(self):
+        self.assertEqual(sorted(self.scheduler.pop_due(now=0)), ["motion", "thermostat"], "New devices not due.")
+        self.assertEqual(self.scheduler.pop_due(now=1000), [], "Devices should wait for their reading.")
+
+    def test_IntervalPerDeviceType(self):
+        self.scheduler.pop_due(now=0)
+        self.scheduler.record_reading("motion", True, now=0)
+        self.scheduler.record_reading("thermostat", True, now=0)
+        self.assertEqual(self.scheduler.pop_due(now=5), ["motion"], "Motion sensor should be polled fast.")
+        self.assertEqual(self.scheduler.pop_due(now=100), ["thermostat"], "Thermostat should be polled slowly.")
+
+    def test_IntervalBacksOffWhenStable(self):
+        self.scheduler.pop_due(now=0)
+        intervals = []
+        for i in range(5):
+            intervals.append(self.scheduler.record_reading("motion", False, now=0))
+        self.assertEqual(intervals, [10, 20, 40, 60, 60], "Interval did not back off up to the maximum.")
+        self.assertEqual(self.scheduler.record_reading("motion", True, now=0), 5, "Change did not reset interval.")
+
+    def test_CommandShortensInterval(self):
+        self.scheduler.pop_due(now=0)
+        self.scheduler.record_reading("thermostat", False, now=0)
+        self.scheduler.record_command("thermostat", now=10)
+        self.assertEqual(self.scheduler.pop_due(now=110), ["thermostat"], "Command did not shorten the interval.")
+
+    def test_RemovedDeviceNotPolled(self):
+        self.scheduler.remove("motion")
+        self.assertEqual(self.scheduler.pop_due(now=0), ["thermostat"], "Removed device was still polled.")
+
+    def test_ReadingChange(self):
+        previous = {"data": {"motion": False, "timestamp": "1"}, "timestamp": "1"}
+        self.assertFalse(has_reading_changed(previous, {"data": {"motion": False, "timestamp": "2"}}),
+                         "Sensor timestamp should not count as a change.")
+        self.assertTrue(has_reading_changed(previous, {"data": {"motion": True, "timestamp": "2"}}),
+                        "Motion change not detected.")
+
+    def test_SyncReplacesDevices(self):
+        self.scheduler.sync([("motion", 'motion_sensor'), ("switch", 'light_switch')], now=0)
+        self.assertEqual(sorted(self.scheduler.pop_due(now=0)), ["motion", "switch"], "Schedule not synchronised.")
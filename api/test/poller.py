@@ -0,0 +1,119 @@
+import time
+import unittest
+
+import vendor_http
+from model import Device
+from poller import DevicePoller
+from vendors import get_vendor_adapter
+
+
+class SlowDevice(object):
+    def __init__(self, device_id, delay):
+        self.device_id = device_id
+        self.delay = delay
+        self.vendor = "OWN"
+        self.configuration = {"url": "http://dummy-sensor:5000/thermostat/{}".format(device_id)}
+
+    def get_device_id(self):
+        return self.device_id
+
+    def read_current_state(self, include_usage_data=0, timeout=None):
+        time.sleep(self.delay)
+        return {"data": {"delay": self.delay}, "timestamp": str(time.time())}
+
+
+class BrokenDevice(SlowDevice):
+    def read_current_state(self, include_usage_data=0, timeout=None):
+        raise ValueError("broken")
+
+
+class FakeResponse(object):
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeEnergenieClients(object):
+    def __init__(self):
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append(url)
+        return FakeResponse({"status": "success",
+                             "data": [{"id": 1, "power_state": 1, "voltage": 240.0},
+                                      {"id": 2, "power_state": 0, "voltage": 239.5}]})
+
+
+def energenie_device(device_id, username, subdevice_id):
+    return Device({'_id': device_id, 'house_id': None, 'room_id': None, 'name': str(device_id),
+                   'device_type': "light_switch", 'vendor': "energenie",
+                   'configuration': {'username': username, 'password': "secret", 'device_id': str(subdevice_id)}})
+
+
+class PollerTests(unittest.TestCase):
+    def setUp(self):
+        self.poller = DevicePoller(max_workers=8, call_timeout=1, cycle_budget=0.5)
+
+    def tearDown(self):
+        self.poller.shutdown()
+
+    def test_DevicesPolledConcurrently(self):
+        devices = [SlowDevice(i, 0.2) for i in range(5)]
+        start = time.time()
+        readings = self.poller.poll(devices)
+        self.assertLess(time.time() - start, 0.45, "Devices were not polled concurrently.")
+        self.assertEqual(len(readings), 5, "Not every device got a reading.")
+        for reading in readings.values():
+            self.assertEqual(reading['data']['delay'], 0.2, "Reading not returned correctly.")
+
+    def test_CycleBudgetExceeded(self):
+        readings = self.poller.poll([SlowDevice(1, 0.05), SlowDevice(2, 1)])
+        self.assertIn("data", readings[1], "Fast device should have a reading.")
+        self.assertIn("error", readings[2], "Slow device should be reported as timed out.")
+
+    def test_DeviceExceptionBecomesError(self):
+        readings = self.poller.poll([BrokenDevice(1, 0)])
+        self.assertIn("error", readings[1], "Exception was not turned into an error reading.")
+
+    def test_EnergenieDevicesGroupedByAccount(self):
+        devices = [energenie_device(1, "a@example.com", 1), SlowDevice(2, 0), energenie_device(3, "a@example.com", 2),
+                   energenie_device(4, "b@example.com", 1)]
+        groups = DevicePoller.group_devices(devices)
+        self.assertEqual([[device.get_device_id() for device in group] for group in groups], [[1, 3], [2], [4]],
+                         "Devices not grouped by Energenie account.")
+
+    def test_EnergenieAccountReadOnce(self):
+        fake_clients = FakeEnergenieClients()
+        original_clients = vendor_http.clients
+        vendor_http.clients = fake_clients
+        try:
+            readings = self.poller.poll([energenie_device(1, "a@example.com", 1),
+                                         energenie_device(2, "a@example.com", 2),
+                                         energenie_device(3, "a@example.com", 3)])
+        finally:
+            vendor_http.clients = original_clients
+        self.assertEqual(len(fake_clients.calls), 1, "Energenie account should be read with a single call.")
+        self.assertEqual(readings[1]['data']['power_state'], 1, "Reading not handed back to device 1.")
+        self.assertEqual(readings[2]['data']['voltage'], 239.5, "Reading not handed back to device 2.")
+        self.assertIn("error", readings[3], "Unknown subdevice should get an error reading.")
+
+    def test_EnergenieBatchIgnoresDeviceCircuits(self):
+        adapter = get_vendor_adapter("energenie")
+        devices = [energenie_device(11, "c@example.com", 1), energenie_device(12, "c@example.com", 2),
+                   energenie_device(13, "c@example.com", "not a number")]
+        for i in range(adapter.breaker.failure_threshold):
+            adapter.breaker.record_failure(adapter.get_device_key(devices[0]), "Device failed")
+        original_clients = vendor_http.clients
+        vendor_http.clients = FakeEnergenieClients()
+        try:
+            readings = self.poller.poll(devices)
+        finally:
+            vendor_http.clients = original_clients
+        self.assertEqual(readings[12]['data']['voltage'], 239.5, "Open circuit of the first device blocked the batch.")
+        self.assertEqual(readings[11]['data']['power_state'], 1, "Device with an open circuit not read in the batch.")
+        self.assertIsNone(adapter.breaker.get_circuit(adapter.get_device_key(devices[0])),
+                          "Device circuit not closed by its entry in the batch.")
+        self.assertIn("Invalid device id", readings[13]['error'], "Invalid device id not reported for its device.")
+        adapter.breaker.record_success(adapter.get_device_key(devices[2]))
@@ -0,0 +1,32 @@
+import unittest
+
+from rollups import add_reading, choose_tier, get_mean, merge_fields, DEFAULT_ROLLUP_RETENTION
+
+
+class RollupTests(unittest.TestCase):
+    def test_AddReading(self):
+        fields = {}
+        add_reading(fields, 10, {'temperature': 20, 'state': "open"})
+        add_reading(fields, 20, {'temperature': 24, 'state': "closed"})
+        self.assertEqual(fields['temperature']['min'], 20, "Minimum not kept.")
+        self.assertEqual(fields['temperature']['max'], 24, "Maximum not kept.")
+        self.assertEqual(get_mean(fields['temperature']), 22, "Mean not computed.")
+        self.assertEqual(fields['state']['last'], "closed", "Last state not kept.")
+        self.assertNotIn('sum', fields['state'], "State summed.")
+
+    def test_MergeFieldsKeepsLatestValue(self):
+        newer = {}
+        add_reading(newer, 50, 1)
+        older = {}
+        add_reading(older, 10, 0)
+        merge_fields(newer, older)
+        self.assertEqual(newer['value']['count'], 2, "Counts not added.")
+        self.assertEqual(newer['value']['last'], 1, "Older value replaced the latest one.")
+
+    def test_ChooseTier(self):
+        now = 100 * 86400
+        self.assertEqual(choose_tier(now - 3600, now, 500, DEFAULT_ROLLUP_RETENTION, now), '5m')
+        self.assertEqual(choose_tier(now - 20 * 86400, now, 500, DEFAULT_ROLLUP_RETENTION, now), '1h')
+        self.assertEqual(choose_tier(now - 95 * 86400, now, 5000, DEFAULT_ROLLUP_RETENTION, now), '1h',
+                         "Tier chosen for a range it no longer keeps.")
+        self.assertEqual(choose_tier(0, now, 500, DEFAULT_ROLLUP_RETENTION, now), '1d')
@@ -0,0 +1,74 @@
+import time
+import unittest
+
+from bson import ObjectId
+
+from rules import RuleCompiler, RuleContext, RuleSyntaxError, get_rule_sensor_ids, parse_rule
+
+
+class RuleTests(unittest.TestCase):
+    def setUp(self):
+        self.hall_id = ObjectId()
+        self.thermostat_id = ObjectId()
+        self.compiler = RuleCompiler()
+
+    def get_context(self, motion, temperature, now=None):
+        return RuleContext({self.hall_id: {'motion': motion}, self.thermostat_id: {'temperature': temperature}},
+                           now)
+
+    def test_Parse(self):
+        rule = "motion AND {}.temperature < 18".format(self.thermostat_id)
+        self.assertEqual(parse_rule(rule, self.hall_id),
+                         ('and', (('compare', '<', ('field', self.thermostat_id, 'temperature'), ('constant', 18.0)),
+                                  ('set', ('field', self.hall_id, 'motion')))))
+        self.assertEqual(parse_rule("a and (b or c)", self.hall_id), parse_rule("(c OR b) AND a", self.hall_id),
+                         "Equal subexpressions not parsed to the same AST.")
+        self.assertEqual(get_rule_sensor_ids(rule, self.hall_id), {self.hall_id, self.thermostat_id})
+        for invalid in ("", "motion AND", "temperature < ", "after 25:00", "(motion", "18", "motion ; 1"):
+            self.assertRaises(RuleSyntaxError, parse_rule, invalid, self.hall_id)
+
+    def test_Evaluate(self):
+        rule = self.compiler.acquire("motion AND {}.temperature < 18 AND NOT temperature == 'off'".format(
+            self.thermostat_id), self.hall_id)
+        self.assertTrue(rule.evaluate(self.get_context(1, 17.5)))
+        self.assertFalse(rule.evaluate(self.get_context(0, 17.5)))
+        self.assertFalse(rule.evaluate(self.get_context(1, 18)))
+        self.assertFalse(rule.evaluate(RuleContext({}, 0)), "Rule on unknown readings held.")
+
+    def test_TimeOfDay(self):
+        rule = self.compiler.acquire("after 22:00 OR before 06:00", self.hall_id)
+        today = time.localtime()
+        night = time.mktime((today.tm_year, today.tm_mon, today.tm_mday, 23, 30, 0, 0, 0, -1))
+        noon = time.mktime((today.tm_year, today.tm_mon, today.tm_mday, 12, 0, 0, 0, 0, -1))
+        self.assertTrue(rule.evaluate(RuleContext({}, night)))
+        self.assertFalse(rule.evaluate(RuleContext({}, noon)))
+        self.assertTrue(rule.uses_time)
+
+    def test_SharedSubexpressions(self):
+        first = self.compiler.acquire("motion AND temperature > 20", self.hall_id)
+        second = self.compiler.acquire("NOT (temperature > 20) OR door", self.hall_id)
+        self.assertEqual(self.compiler.nodes[parse_rule("temperature > 20", self.hall_id)][1], 2,
+                         "Shared subexpression compiled twice.")
+        context = CountingContext({self.hall_id: {'motion': 1, 'temperature': 21, 'door': 0}})
+        self.assertTrue(first.evaluate(context))
+        self.assertFalse(second.evaluate(context))
+        self.assertEqual(context.fields.count('temperature'), 1, "Shared subexpression evaluated twice.")
+
+    def test_CacheFollowsReferences(self):
+        rule = self.compiler.acquire("motion", self.hall_id)
+        self.compiler.release("motion", self.hall_id)
+        self.assertIs(self.compiler.acquire("motion", self.hall_id), rule, "Rule compiled again without a change.")
+        self.compiler.release("motion", self.hall_id)
+        self.compiler.prune()
+        self.assertEqual(self.compiler.rules, {})
+        self.assertEqual(self.compiler.nodes, {}, "Subexpressions of released rules kept.")
+
+
+class CountingContext(RuleContext):
+    def __init__(self, values):
+        RuleContext.__init__(self, values)
+        self.fields = []
+
+    def get_value(self, sensor_id, field):
+        self.fields.append(field)
+        return RuleContext.get_value(self, sensor_id, field)
@@ -0,0 +1,34 @@
+import random
+import unittest
+
+from timing_wheel import TimingWheel
+
+
+class TimingWheelTests(unittest.TestCase):
+    def test_FiresAtDueTick(self):
+        wheel = TimingWheel(slots=(4, 4, 4), now=0)
+        random.seed(3)
+        due_times = {timer_id: random.randint(1, 200) for timer_id in range(100)}
+        for timer_id, due in due_times.items():
+            wheel.schedule(timer_id, due)
+        fired = {}
+        for now in range(1, 201):
+            for timer_id, due in wheel.advance(now):
+                fired[timer_id] = now
+        self.assertEqual(fired, due_times, "Timers not fired exactly at their due tick.")
+        self.assertEqual(len(wheel), 0)
+
+    def test_CancelAndReschedule(self):
+        wheel = TimingWheel(now=0)
+        wheel.schedule("light", 14400)
+        wheel.schedule("motion", 300)
+        wheel.cancel("motion")
+        self.assertNotIn("motion", wheel)
+        wheel.schedule("light", 600)
+        self.assertEqual(wheel.advance(599), [])
+        self.assertEqual(wheel.advance(20000), [("light", 600)], "Rescheduled timer fired at its old time.")
+
+    def test_OverdueTimersFireOnNextAdvance(self):
+        wheel = TimingWheel(now=1000)
+        wheel.schedule("restored", 10)
+        self.assertEqual(wheel.advance(1000), [("restored", 10)])
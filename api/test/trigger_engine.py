@@ -0,0 +1,139 @@
+import unittest
+
+from bson import ObjectId
+
+from model import Trigger
+from trigger_engine import TriggerEngine
+
+
+def make_trigger(sensor_id, event, event_params):
+    return Trigger({'_id': ObjectId(), 'sensor_id': sensor_id, 'event': event, 'event_params': event_params,
+                    'actor_id': ObjectId(), 'action': "set_light_switch", 'action_params': True,
+                    'user_id': ObjectId(), 'reading': None})
+
+
+def make_reading(**data):
+    return {"data": data, "timestamp": "0"}
+
+
+class TriggerEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = TriggerEngine()
+        self.sensor_id = ObjectId()
+
+    def test_MotionEdges(self):
+        start = make_trigger(self.sensor_id, "motion_detected_start", None)
+        stop = make_trigger(self.sensor_id, "motion_detected_stop", None)
+        self.engine.load([start, stop])
+        self.assertEqual(self.engine.evaluate(self.sensor_id, None, make_reading(motion=0)), [],
+                         "Trigger fired without a known previous state.")
+        self.assertEqual(self.engine.evaluate(self.sensor_id, make_reading(motion=0), make_reading(motion=1)), [start])
+        self.assertEqual(self.engine.evaluate(self.sensor_id, make_reading(motion=1), make_reading(motion=1)), [],
+                         "Trigger fired without an edge.")
+        self.assertEqual(self.engine.evaluate(self.sensor_id, make_reading(motion=1), make_reading(motion=0)), [stop])
+
+    def test_TemperatureThresholds(self):
+        higher = make_trigger(self.sensor_id, "temperature_gets_higher_than", "22")
+        lower = make_trigger(self.sensor_id, "temperature_gets_lower_than", 15)
+        self.engine.load([higher, lower])
+        self.assertEqual(self.engine.evaluate(self.sensor_id, make_reading(temperature=21),
+                                              make_reading(temperature=23)), [higher])
+        self.assertEqual(self.engine.evaluate(self.sensor_id, make_reading(temperature=16),
+                                              make_reading(temperature=14)), [lower])
+        self.assertEqual(self.engine.evaluate(self.sensor_id, {"error": "Offline"}, make_reading(temperature=30)), [],
+                         "Trigger fired without a previous reading.")
+
+    def test_IndexFollowsEdits(self):
+        trigger = make_trigger(self.sensor_id, "motion_detected_start", None)
+        self.engine.add(trigger)
+        other_sensor_id = ObjectId()
+        moved = make_trigger(other_sensor_id, "motion_detected_start", None)
+        moved.trigger_id = trigger.trigger_id
+        self.engine.add(moved)
+        self.assertEqual(self.engine.get_triggers(self.sensor_id), [], "Edited trigger left in the old sensor index.")
+        self.assertEqual(self.engine.get_triggers(other_sensor_id), [moved])
+        self.engine.remove(trigger.trigger_id)
+        self.assertEqual(self.engine.get_triggers(other_sensor_id), [], "Removed trigger still indexed.")
+
+    def test_ThresholdIndexCrossings(self):
+        thresholds = [15, 20, 20, 25]
+        triggers = [make_trigger(self.sensor_id, "temperature_gets_higher_than", threshold) for threshold in thresholds]
+        self.engine.load(triggers[:2])
+        for trigger in triggers[2:]:
+            self.engine.add(trigger)
+        self.assertEqual(set(trigger.trigger_id for trigger in self.engine.evaluate(
+            self.sensor_id, make_reading(temperature=15), make_reading(temperature=20.5))),
+            set(trigger.trigger_id for trigger in triggers[:3]), "Crossed thresholds not found.")
+        self.assertEqual(self.engine.evaluate(self.sensor_id, make_reading(temperature=20.5),
+                                              make_reading(temperature=19)), [], "Downward crossing fired.")
+        self.engine.remove(triggers[1].trigger_id)
+        self.assertEqual(self.engine.evaluate(self.sensor_id, make_reading(temperature=19),
+                                              make_reading(temperature=21)), [triggers[2]],
+                         "Removed threshold still indexed.")
+
+    def test_Hysteresis(self):
+        trigger = make_trigger(self.sensor_id, "temperature_gets_higher_than", 22)
+        trigger.hysteresis = 1
+        self.engine.load([trigger])
+        temperatures = [21.5, 22.5, 21.8, 22.4, 20.9, 22.1]
+        fired = [len(self.engine.evaluate(self.sensor_id, make_reading(temperature=previous),
+                                          make_reading(temperature=current)))
+                 for previous, current in zip(temperatures, temperatures[1:])]
+        self.assertEqual(fired, [1, 0, 0, 0, 1], "Trigger fired within the hysteresis band.")
+
+    def test_DebounceAndChangedStates(self):
+        trigger = make_trigger(self.sensor_id, "motion_detected_start", None)
+        trigger.debounce = 60
+        self.engine.load([trigger])
+        self.engine.evaluate(self.sensor_id, None, make_reading(motion=0), now=0)
+        self.assertEqual(len(self.engine.evaluate(self.sensor_id, None, make_reading(motion=1), now=10)), 1)
+        self.engine.evaluate(self.sensor_id, None, make_reading(motion=0), now=20)
+        self.assertEqual(self.engine.evaluate(self.sensor_id, None, make_reading(motion=1), now=30), [],
+                         "Trigger fired within the debounce window.")
+        self.assertEqual(self.engine.pop_changed_states(), {trigger.trigger_id: {'active': True, 'last_fired': 10,
+                                                                            'due_at': None}})
+        self.engine.evaluate(self.sensor_id, None, make_reading(motion=1), now=40)
+        self.assertEqual(self.engine.pop_changed_states(), {}, "Unchanged state reported for persisting.")
+
+    def test_DurationTimers(self):
+        self.engine = TriggerEngine(now=0)
+        light_on = make_trigger(self.sensor_id, "light_on_for", 14400)
+        no_motion = make_trigger(self.sensor_id, "no_motion_for", "300")
+        self.engine.load([light_on, no_motion])
+        self.engine.evaluate(self.sensor_id, None, make_reading(power_state=1, motion=0), now=0)
+        self.assertEqual(light_on.state['due_at'], 14400, "Timer not armed.")
+        self.assertEqual(self.engine.expire(now=200), [])
+        self.engine.evaluate(self.sensor_id, None, make_reading(power_state=1, motion=1), now=250)
+        self.assertIsNone(no_motion.state['due_at'], "Timer not cancelled.")
+        self.engine.evaluate(self.sensor_id, None, make_reading(power_state=1, motion=0), now=400)
+        self.assertEqual(self.engine.expire(now=699), [])
+        self.assertEqual(self.engine.expire(now=700), [no_motion], "Re-armed timer did not fire.")
+        self.assertEqual(self.engine.expire(now=14400), [light_on])
+        self.assertEqual(self.engine.expire(now=30000), [], "Timer fired twice.")
+
+    def test_DurationTimersRestored(self):
+        trigger = make_trigger(self.sensor_id, "light_on_for", 3600)
+        trigger.state = {'active': True, 'last_fired': None, 'due_at': 100}
+        self.engine = TriggerEngine(now=200)
+        self.engine.load([trigger])
+        self.assertEqual(self.engine.expire(now=201), [trigger], "Persisted timer not restored.")
+        self.assertEqual(self.engine.pop_changed_states(),
+                         {trigger.trigger_id: {'active': True, 'last_fired': 201, 'due_at': None}})
+
+    def test_RulesAcrossSensors(self):
+        thermostat_id = ObjectId()
+        rule = make_trigger(self.sensor_id, "rule", "motion AND {}.temperature < 18".format(thermostat_id))
+        self.engine.load([rule])
+        self.engine.evaluate(self.sensor_id, None, make_reading(motion=0), now=0)
+        self.assertEqual(self.engine.evaluate(thermostat_id, None, make_reading(temperature=17), now=1), [])
+        self.assertEqual(self.engine.evaluate_batch([(self.sensor_id, None, make_reading(motion=1)),
+                                                     (thermostat_id, None, make_reading(temperature=16))], now=2),
+                         [rule], "Rule did not fire when it started to hold.")
+        self.assertEqual(self.engine.evaluate(thermostat_id, None, make_reading(temperature=19), now=3), [])
+        self.assertFalse(rule.state['active'], "Rule not re-evaluated on the reading of another sensor.")
+        compiled = self.engine.compiled_rules[rule.trigger_id]
+        self.engine.add(rule)
+        self.assertIs(self.engine.compiled_rules[rule.trigger_id], compiled, "Unchanged rule compiled again.")
+        self.engine.remove(rule.trigger_id)
+        self.assertEqual(self.engine.rule_index, {})
+        self.assertEqual(self.engine.rules.rules, {}, "Removed rule still cached.")
@@ -0,0 +1,41 @@
+import unittest
+
+from trigger_graph import TriggerGraph
+
+
+class TriggerGraphTests(unittest.TestCase):
+    def setUp(self):
+        self.graph = TriggerGraph()
+        self.graph.add("t1", ["motion"], "light")
+        self.graph.add("t2", ["light"], "thermostat")
+
+    def test_Reachable(self):
+        self.assertEqual(self.graph.get_reachable("motion"), {"light", "thermostat"})
+        self.assertEqual(self.graph.get_reachable("thermostat", upstream=True), {"light", "motion"})
+        self.graph.remove("t2")
+        self.assertEqual(self.graph.get_reachable("motion"), {"light"}, "Cached reachability not invalidated.")
+
+    def test_Edges(self):
+        self.assertTrue(self.graph.has_edge("motion", "light"))
+        self.assertFalse(self.graph.has_edge("light", "motion"), "Edge reported against its direction.")
+        self.assertEqual(self.graph.get_sources("thermostat"), ["light"])
+        self.graph.add("t3", ["motion"], "thermostat")
+        self.assertEqual(sorted(self.graph.get_sources("thermostat")), ["light", "motion"])
+        self.graph.remove("t3")
+        self.assertFalse(self.graph.has_edge("motion", "thermostat"), "Edge of a removed trigger kept.")
+
+    def test_EditReplacesEdges(self):
+        self.graph.add("t2", ["motion"], "thermostat")
+        self.assertEqual(self.graph.get_reachable("light"), set())
+        self.graph.add("t3", ["motion"], "light")
+        self.graph.remove("t1")
+        self.assertEqual(self.graph.get_reachable("motion"), {"light", "thermostat"},
+                         "Edge removed while another trigger still uses it.")
+
+    def test_GetLoops(self):
+        self.assertEqual(self.graph.get_loops(), [])
+        self.graph.add("t3", ["thermostat"], "motion")
+        self.graph.add("t4", ["door"], "door")
+        self.graph.add("t5", ["door"], "light")
+        self.assertEqual(sorted(sorted(loop) for loop in self.graph.get_loops()),
+                         [["door"], ["light", "motion", "thermostat"]])
@@ -0,0 +1,81 @@
+import unittest
+
+from bson import ObjectId
+
+from test.trigger_engine import make_reading, make_trigger
+from trigger_workers import TriggerWorkerPool
+
+
+class TriggerWorkerPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.houses = {}
+        self.pool = TriggerWorkerPool(2, lambda sensor_ids: {sensor_id: self.houses.get(sensor_id)
+                                                             for sensor_id in sensor_ids}, timeout=10)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def add_sensor(self, house_id):
+        sensor_id = ObjectId()
+        self.houses[sensor_id] = house_id
+        return sensor_id
+
+    def test_EvaluatesShardsInWorkers(self):
+        house_ids = [ObjectId() for _ in range(4)]
+        sensor_ids = [self.add_sensor(house_id) for house_id in house_ids]
+        triggers = [make_trigger(sensor_id, "temperature_gets_higher_than", 22) for sensor_id in sensor_ids]
+        self.pool.load(triggers[:3])
+        self.pool.add(triggers[3])
+        self.assertEqual(set(len(self.pool.sensor_workers[sensor_id]) for sensor_id in sensor_ids), {1})
+        fired = self.pool.evaluate_batch([(sensor_id, make_reading(temperature=21), make_reading(temperature=23))
+                                          for sensor_id in sensor_ids[1:]], now=10)
+        self.assertEqual(set(trigger.trigger_id for trigger in fired),
+                         set(trigger.trigger_id for trigger in triggers[1:]), "Workers did not return the firings.")
+        self.assertEqual(set(self.pool.pop_changed_states()), set(trigger.trigger_id for trigger in triggers[1:]))
+        self.assertTrue(triggers[1].state['active'], "Worker state not mirrored.")
+        self.assertEqual(self.pool.get_queue_depths(), [0, 0])
+        self.pool.remove(triggers[1].trigger_id)
+        self.assertEqual(self.pool.evaluate(sensor_ids[1], make_reading(temperature=21), make_reading(temperature=23),
+                                            now=20), [], "Removed trigger evaluated.")
+
+    def test_RuleReadingsReachTheirShard(self):
+        sensor_id = self.add_sensor(ObjectId())
+        other_sensor_id = self.add_sensor(ObjectId())
+        rule = make_trigger(sensor_id, "rule", "motion AND {}.temperature < 18".format(other_sensor_id))
+        self.pool.load([rule])
+        self.assertEqual(self.pool.get_rule_sensor_ids(), {sensor_id, other_sensor_id})
+        self.pool.evaluate_batch([(sensor_id, None, make_reading(motion=0)),
+                                  (other_sensor_id, None, make_reading(temperature=20))], now=0)
+        self.pool.evaluate(sensor_id, None, make_reading(motion=1), now=1)
+        self.assertEqual(self.pool.evaluate(other_sensor_id, None, make_reading(temperature=16), now=2), [rule],
+                         "Reading of another house's sensor not sent to the rule's worker.")
+
+    def test_DeadWorkerTakenOver(self):
+        sensor_id = self.add_sensor(ObjectId())
+        trigger = make_trigger(sensor_id, "temperature_gets_higher_than", 22)
+        self.pool.load([trigger])
+        self.pool.evaluate(sensor_id, make_reading(temperature=23), make_reading(temperature=21), now=0)
+        worker = self.pool.triggers[trigger.trigger_id][1]
+        self.pool.workers[worker].terminate()
+        self.pool.workers[worker].join()
+        self.assertEqual(self.pool.evaluate(sensor_id, make_reading(temperature=21), make_reading(temperature=23),
+                                            now=10), [trigger], "Triggers of a dead worker not evaluated.")
+        self.assertIsNone(self.pool.get_queue_depths()[worker], "Dead worker not taken over.")
+        self.assertTrue(trigger.state['active'], "Taken over state not mirrored.")
+
+    def test_TakeOverKeepsRuleValues(self):
+        sensor_id = self.add_sensor(ObjectId())
+        other_sensor_id = self.add_sensor(ObjectId())
+        rule = make_trigger(sensor_id, "rule", "motion AND {}.temperature < 18".format(other_sensor_id))
+        self.pool.load([rule])
+        self.pool.set_latest_readings({other_sensor_id: make_reading(temperature=16)})
+        self.pool.evaluate(sensor_id, None, make_reading(motion=0), now=0)
+        self.assertEqual(self.pool.evaluate(sensor_id, None, make_reading(motion=1), now=1), [rule])
+        worker = self.pool.triggers[rule.trigger_id][1]
+        self.pool.workers[worker].terminate()
+        self.pool.workers[worker].join()
+        self.assertEqual(self.pool.evaluate(sensor_id, None, make_reading(motion=1), now=10), [],
+                         "Active rule fired again after the take over.")
+        self.pool.evaluate(sensor_id, None, make_reading(motion=0), now=20)
+        self.assertEqual(self.pool.evaluate(sensor_id, None, make_reading(motion=1), now=30), [rule],
+                         "Latest readings of the rule not restored after the take over.")
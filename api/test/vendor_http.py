@@ -0,0 +1,36 @@
+import unittest
+
+import vendor_http
+from vendor_http import VendorHttpClients
+
+
+class VendorHttpTests(unittest.TestCase):
+    def setUp(self):
+        self.clients = VendorHttpClients(pool_size=4, timeout=5)
+
+    def tearDown(self):
+        self.clients.close()
+
+    def test_SessionSharedPerHost(self):
+        session1 = self.clients.get_session("https://mihome4u.co.uk/api/v1/subdevices/show")
+        session2 = self.clients.get_session("https://mihome4u.co.uk/api/v1/subdevices/power_on")
+        self.assertIs(session1, session2, "Calls to the same host should share a session.")
+
+    def test_SessionPerHost(self):
+        session1 = self.clients.get_session("https://mihome4u.co.uk/api/v1/subdevices/show")
+        session2 = self.clients.get_session("http://dummy-sensor:5000/thermostat/3")
+        self.assertIsNot(session1, session2, "Different hosts should not share a session.")
+
+    def test_KeepAliveDisabled(self):
+        clients = VendorHttpClients(keep_alive=False)
+        session = clients.get_session("http://dummy-sensor:5000/thermostat/3")
+        self.assertEqual(session.headers['Connection'], 'close', "Keep-alive was not disabled.")
+        clients.close()
+
+    def test_ConfigureKeepsSessions(self):
+        clients = vendor_http.configure(pool_size=4, timeout=5)
+        session = clients.get_session("http://dummy-sensor:5000/thermostat/3")
+        clients_again = vendor_http.configure(pool_size=4, timeout=5)
+        self.assertIs(clients_again.get_session("http://dummy-sensor:5000/thermostat/3"), session,
+                      "Configuring the same settings again replaced the sessions.")
+        self.assertIsNot(vendor_http.configure(), clients, "New settings were not applied.")
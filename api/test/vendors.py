@@ -0,0 +1,36 @@
+import unittest
+
+from vendors import CircuitBreaker, get_vendor_adapter
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=3, base_backoff=10, max_backoff=60)
+
+    def test_CircuitOpensAfterThreshold(self):
+        for i in range(2):
+            self.breaker.record_failure("host", now=100)
+            self.assertTrue(self.breaker.allow("host", now=100), "Circuit opened too early.")
+        self.breaker.record_failure("host", now=100)
+        self.assertFalse(self.breaker.allow("host", now=105), "Circuit did not open after repeated failures.")
+        self.assertTrue(self.breaker.allow("host", now=110), "Circuit did not allow a probe after the backoff.")
+        self.assertFalse(self.breaker.allow("host", now=111), "Only one probe should be let through.")
+
+    def test_BackoffGrowsExponentially(self):
+        for i in range(5):
+            self.breaker.record_failure("host", now=0)
+        self.assertEqual(self.breaker.get_circuit("host")['retry_at'], 40, "Backoff did not double per failure.")
+        for i in range(5):
+            self.breaker.record_failure("host", now=0)
+        self.assertEqual(self.breaker.get_circuit("host")['retry_at'], 60, "Backoff not capped.")
+
+    def test_SuccessClosesCircuit(self):
+        for i in range(3):
+            self.breaker.record_failure("host", now=0)
+        self.breaker.record_success("host")
+        self.assertTrue(self.breaker.allow("host", now=1), "Success did not close the circuit.")
+
+    def test_AdapterRegistry(self):
+        self.assertIsNotNone(get_vendor_adapter("energenie", 'power_state'), "Energenie adapter not registered.")
+        self.assertIsNone(get_vendor_adapter("OWN", 'power_state'), "OWN adapter does not support power state.")
+        self.assertIsNone(get_vendor_adapter("example"), "Unknown vendor should have no adapter.")
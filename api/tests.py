@@ -5,6 +5,9 @@ import unittest
 from pymongo import MongoClient
 
 import repositories
+from test.access_tokens import AccessTokenTests
+from test.action_dispatcher import ActionDispatcherTests
+from test.backtest import BacktestTests
 from test.model_admin import AdminTests
 from test.model_device import DeviceTests
 from test.model_house import HouseTests
@@ -13,8 +16,19 @@ from test.model_device import DeviceTests
 from test.model_trigger import TriggerTests
 from test.model_theme import ThemeTests
 from test.model_usr_mgmt import MgmtTests
+from test.model_reading import ReadingTests
 from test.model_token import TokenTests
 from test.model_user import UserTests
+from test.poll_scheduler import PollSchedulerTests
+from test.poller import PollerTests
+from test.rollups import RollupTests
+from test.rules import RuleTests
+from test.timing_wheel import TimingWheelTests
+from test.trigger_engine import TriggerEngineTests
+from test.trigger_graph import TriggerGraphTests
+from test.trigger_workers import TriggerWorkerPoolTests
+from test.vendor_http import VendorHttpTests
+from test.vendors import CircuitBreakerTests
 
 mongo = MongoClient(os.environ['MONGO_HOST'], int(os.environ['MONGO_PORT']))
 
@@ -25,6 +39,7 @@ def main():
     mongo.drop_database('testdb')
     db = mongo.testdb
     repository_collection = repositories.RepositoryCollection(db)
+    repository_collection.ensure_indexes()
     UserTests.repository_collection = repository_collection
     HouseTests.repository_collection = repository_collection
     RoomTests.repository_collection = repository_collection
@@ -34,6 +49,7 @@ def main():
     TokenTests.repository_collection = repository_collection
     AdminTests.repository_collection = repository_collection
     MgmtTests.repository_collection = repository_collection
+    ReadingTests.repository_collection = repository_collection
     unittest.main()
 
 
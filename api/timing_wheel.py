@@ -0,0 +1,80 @@
+import time
+
+# Slots per level. With one second ticks the levels span about 4 minutes, 4.5 hours, 12 days and 2 years.
+DEFAULT_WHEEL_SLOTS = (256, 64, 64, 64)
+
+
+class TimingWheel(object):
+    # Hierarchical timing wheel: a timer is put in the slot of the coarsest level it needs, and moved down a
+    # level ("cascaded") whenever the finer level wraps around. Scheduling and cancelling are O(1), advancing
+    # costs one slot per tick plus the timers that are due or cascaded.
+    def __init__(self, tick=1.0, slots=DEFAULT_WHEEL_SLOTS, now=None):
+        self.tick = tick
+        self.slots = slots
+        self.spans = []
+        span = 1
+        for slot_count in slots:
+            self.spans.append(span)
+            span *= slot_count
+        self.wheels = [[{} for _ in range(slot_count)] for slot_count in slots]
+        self.current_tick = self.get_tick(time.time() if now is None else now)
+        self.locations = {}
+        self.expired = {}
+
+    def get_tick(self, timestamp):
+        return int(timestamp // self.tick)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, timer_id):
+        return timer_id in self.locations
+
+    def place(self, timer_id, due_tick, due):
+        delta = due_tick - self.current_tick
+        if delta <= 0:
+            self.expired[timer_id] = due
+            self.locations[timer_id] = None
+            return
+        for level, span in enumerate(self.spans):
+            if level + 1 == len(self.spans) or delta < span * self.slots[level]:
+                # Timers beyond the top level are parked in it and placed again when their slot comes round.
+                slot = (due_tick // span) % self.slots[level]
+                self.wheels[level][slot][timer_id] = (due_tick, due)
+                self.locations[timer_id] = (level, slot)
+                return
+
+    def schedule(self, timer_id, due):
+        self.cancel(timer_id)
+        self.place(timer_id, self.get_tick(due), due)
+
+    def cancel(self, timer_id):
+        location = self.locations.pop(timer_id, None)
+        if location is None:
+            self.expired.pop(timer_id, None)
+            return
+        level, slot = location
+        self.wheels[level][slot].pop(timer_id, None)
+
+    def advance(self, now=None):
+        # Returns (timer id, due) of every timer that became due since the last call.
+        target_tick = self.get_tick(time.time() if now is None else now)
+        due_timers = list(self.expired.items())
+        self.expired = {}
+        while self.current_tick < target_tick:
+            self.current_tick += 1
+            for level in range(len(self.slots) - 1, 0, -1):
+                if self.current_tick % self.spans[level] == 0:
+                    slot = self.wheels[level][(self.current_tick // self.spans[level]) % self.slots[level]]
+                    timers = list(slot.items())
+                    slot.clear()
+                    for timer_id, (due_tick, due) in timers:
+                        self.place(timer_id, due_tick, due)
+            slot = self.wheels[0][self.current_tick % self.slots[0]]
+            due_timers.extend((timer_id, due) for timer_id, (_, due) in slot.items())
+            slot.clear()
+            due_timers.extend(self.expired.items())
+            self.expired = {}
+        for timer_id, _ in due_timers:
+            self.locations.pop(timer_id, None)
+        return due_timers
@@ -0,0 +1,425 @@
+import bisect
+import logging
+import threading
+import time
+
+from poll_scheduler import get_reading_values
+from rules import RuleCompiler, RuleContext, RuleSyntaxError, get_rule_sensor_ids
+from timing_wheel import TimingWheel
+
+
+def get_reading_field(reading, field):
+    values = get_reading_values(reading)
+    if not isinstance(values, dict) or 'error' in values:
+        return None
+    return values.get(field)
+
+
+def to_power_state(value):
+    if isinstance(value, str):
+        return 1 if value.lower() in ('1', 'true', 'on') else 0
+    return 1 if value else 0
+
+
+# Every trigger remembers whether its condition held on the last reading ('active') and when it last fired.
+# It only fires when it becomes active, never while it stays active.
+#
+# Level events derive the condition from one field of the new reading.
+trigger_events = {}
+
+
+def register_trigger_event(name, field, level):
+    trigger_events[name] = (field, level)
+
+
+register_trigger_event('motion_detected_start', 'motion', lambda params, value: bool(value))
+register_trigger_event('motion_detected_stop', 'motion', lambda params, value: not bool(value))
+
+# Threshold events become active when a field crosses the threshold in their event params between the previous
+# and the new reading, upwards (previous <= threshold < current) or downwards (previous >= threshold > current),
+# and inactive again once it crosses back over the threshold moved by the hysteresis band. Both are kept in
+# sorted threshold arrays per sensor instead of being tested one by one.
+threshold_events = {}
+
+
+def register_threshold_event(name, field, upwards):
+    threshold_events[name] = (field, upwards)
+
+
+register_threshold_event('temperature_gets_higher_than', 'temperature', True)
+register_threshold_event('temperature_gets_lower_than', 'temperature', False)
+
+# Duration events fire once their level condition has held for the number of seconds in their event params.
+# Becoming active arms a timer on the engine's timing wheel and becoming inactive cancels it; the due time is
+# kept in the trigger state ('due_at') so that armed timers are restored after a restart.
+duration_events = {}
+
+
+def register_duration_event(name, field, level):
+    duration_events[name] = (field, level)
+
+
+register_duration_event('light_on_for', 'power_state', lambda params, value: to_power_state(value) == 1)
+register_duration_event('no_motion_for', 'motion', lambda params, value: not bool(value))
+
+# Rule triggers hold a rule (see rules.py) in their event params. They are level triggers over the latest
+# readings of every sensor the rule refers to, evaluated whenever one of those sensors is read and, if the rule
+# depends on the time of day, whenever the minute changes.
+RULE_EVENT = 'rule'
+
+
+def get_trigger_sensor_ids(trigger):
+    # Every sensor whose readings the trigger depends on.
+    if trigger.event == RULE_EVENT:
+        try:
+            return get_rule_sensor_ids(trigger.event_params, trigger.sensor_id)
+        except RuleSyntaxError:
+            pass
+    return {trigger.sensor_id}
+
+# Actions run against the device repository with the actor id and the action parameters of the trigger.
+trigger_actions = {}
+
+
+def register_trigger_action(name, action):
+    trigger_actions[name] = action
+
+
+register_trigger_action('set_target_temperature',
+                        lambda devices, actor_id, params: devices.set_target_temperature(actor_id, float(params)))
+register_trigger_action('set_light_switch',
+                        lambda devices, actor_id, params: devices.set_power_state(actor_id, to_power_state(params)))
+
+
+class ThresholdIndex(object):
+    def __init__(self, upwards, items=()):
+        # items: (threshold, trigger_id) pairs
+        self.upwards = upwards
+        items = sorted(items, key=lambda item: item[0])
+        self.thresholds = [threshold for threshold, _ in items]
+        self.trigger_ids = [trigger_id for _, trigger_id in items]
+
+    def __len__(self):
+        return len(self.thresholds)
+
+    def add(self, threshold, trigger_id):
+        position = bisect.bisect_right(self.thresholds, threshold)
+        self.thresholds.insert(position, threshold)
+        self.trigger_ids.insert(position, trigger_id)
+
+    def remove(self, threshold, trigger_id):
+        position = bisect.bisect_left(self.thresholds, threshold)
+        while position < len(self.thresholds) and self.thresholds[position] == threshold:
+            if self.trigger_ids[position] == trigger_id:
+                del self.thresholds[position]
+                del self.trigger_ids[position]
+                return
+            position += 1
+
+    def get_crossed(self, previous, current):
+        if self.upwards and current > previous:
+            start = bisect.bisect_left(self.thresholds, previous)
+            end = bisect.bisect_left(self.thresholds, current)
+        elif not self.upwards and current < previous:
+            start = bisect.bisect_right(self.thresholds, current)
+            end = bisect.bisect_right(self.thresholds, previous)
+        else:
+            return []
+        return self.trigger_ids[start:end]
+
+
+def get_threshold(trigger):
+    try:
+        return float(trigger.event_params)
+    except (TypeError, ValueError):
+        logging.warning("Trigger {} has no numeric threshold: {}".format(trigger.trigger_id, trigger.event_params))
+        return None
+
+
+def get_duration(trigger):
+    try:
+        return float(trigger.event_params)
+    except (TypeError, ValueError):
+        logging.warning("Trigger {} has no numeric duration: {}".format(trigger.trigger_id, trigger.event_params))
+        return None
+
+
+class TriggerEngine(object):
+    def __init__(self, default_hysteresis=0.0, default_debounce=0, timer_tick=1.0, now=None):
+        self.default_hysteresis = default_hysteresis
+        self.default_debounce = default_debounce
+        self.timer_tick = timer_tick
+        self.timers = TimingWheel(tick=timer_tick, now=now)
+        self.triggers = {}
+        # sensor id -> {trigger id: trigger} of every trigger, and of those with a level event
+        self.sensor_index = {}
+        self.condition_index = {}
+        # (sensor id, event) -> (activating ThresholdIndex, deactivating ThresholdIndex)
+        self.threshold_index = {}
+        self.thresholds = {}
+        self.rules = RuleCompiler()
+        # trigger id -> CompiledRule, sensor id -> {trigger id: trigger} of the rules referring to the sensor
+        self.compiled_rules = {}
+        self.rule_index = {}
+        self.time_rule_ids = set()
+        self.rule_minute = None
+        # sensor id -> field values of its latest reading, as seen by the rules
+        self.latest_values = {}
+        self.changed_trigger_ids = set()
+        self.lock = threading.Lock()
+
+    def get_thresholds(self, trigger):
+        # (activating, deactivating) threshold of a threshold trigger, or None
+        threshold = get_threshold(trigger)
+        if threshold is None:
+            return None
+        hysteresis = trigger.hysteresis if trigger.hysteresis is not None else self.default_hysteresis
+        upwards = threshold_events[trigger.event][1]
+        return threshold, threshold - hysteresis if upwards else threshold + hysteresis
+
+    def load(self, triggers):
+        # Threshold arrays are sorted once instead of inserting every trigger into them.
+        items = {}
+        with self.lock:
+            self.triggers = {}
+            self.sensor_index = {}
+            self.condition_index = {}
+            self.threshold_index = {}
+            self.thresholds = {}
+            self.rules = RuleCompiler()
+            self.compiled_rules = {}
+            self.rule_index = {}
+            self.time_rule_ids = set()
+            self.changed_trigger_ids = set()
+            self.timers = TimingWheel(tick=self.timer_tick, now=self.timers.current_tick * self.timer_tick)
+            for trigger in triggers:
+                self.index_trigger(trigger)
+                if trigger.trigger_id in self.thresholds:
+                    activate, deactivate = self.thresholds[trigger.trigger_id]
+                    key_items = items.setdefault((trigger.sensor_id, trigger.event), ([], []))
+                    key_items[0].append((activate, trigger.trigger_id))
+                    key_items[1].append((deactivate, trigger.trigger_id))
+            for key, (activate_items, deactivate_items) in items.items():
+                upwards = threshold_events[key[1]][1]
+                self.threshold_index[key] = (ThresholdIndex(upwards, activate_items),
+                                             ThresholdIndex(not upwards, deactivate_items))
+
+    def index_trigger(self, trigger):
+        self.triggers[trigger.trigger_id] = trigger
+        self.sensor_index.setdefault(trigger.sensor_id, {})[trigger.trigger_id] = trigger
+        if trigger.event in threshold_events:
+            thresholds = self.get_thresholds(trigger)
+            if thresholds is not None:
+                self.thresholds[trigger.trigger_id] = thresholds
+        elif trigger.event == RULE_EVENT:
+            try:
+                rule = self.rules.acquire(trigger.event_params, trigger.sensor_id)
+            except RuleSyntaxError as ex:
+                logging.warning("Trigger {} has an invalid rule: {}".format(trigger.trigger_id, ex))
+                return
+            self.compiled_rules[trigger.trigger_id] = rule
+            for sensor_id in rule.sensor_ids:
+                self.rule_index.setdefault(sensor_id, {})[trigger.trigger_id] = trigger
+            if rule.uses_time:
+                self.time_rule_ids.add(trigger.trigger_id)
+        else:
+            self.condition_index.setdefault(trigger.sensor_id, {})[trigger.trigger_id] = trigger
+        if trigger.event in duration_events and trigger.state.get('due_at') is not None:
+            self.timers.schedule(trigger.trigger_id, trigger.state['due_at'])
+
+    def add(self, trigger):
+        # Also used when a trigger is edited: the old version is replaced. Its rule is only compiled again if
+        # the edit changed it.
+        with self.lock:
+            self.unindex_trigger(trigger.trigger_id)
+            self.index_trigger(trigger)
+            if trigger.trigger_id in self.thresholds:
+                key = (trigger.sensor_id, trigger.event)
+                if key not in self.threshold_index:
+                    upwards = threshold_events[trigger.event][1]
+                    self.threshold_index[key] = (ThresholdIndex(upwards), ThresholdIndex(not upwards))
+                for index, threshold in zip(self.threshold_index[key], self.thresholds[trigger.trigger_id]):
+                    index.add(threshold, trigger.trigger_id)
+            self.rules.prune()
+
+    def remove(self, trigger_id):
+        with self.lock:
+            self.unindex_trigger(trigger_id)
+            self.rules.prune()
+
+    def unindex_trigger(self, trigger_id):
+        trigger = self.triggers.pop(trigger_id, None)
+        if trigger is None:
+            return
+        for index in (self.sensor_index, self.condition_index):
+            sensor_triggers = index.get(trigger.sensor_id, {})
+            sensor_triggers.pop(trigger_id, None)
+            if len(sensor_triggers) == 0:
+                index.pop(trigger.sensor_id, None)
+        thresholds = self.thresholds.pop(trigger_id, None)
+        if thresholds is not None:
+            key = (trigger.sensor_id, trigger.event)
+            for index, threshold in zip(self.threshold_index[key], thresholds):
+                index.remove(threshold, trigger_id)
+            if len(self.threshold_index[key][0]) == 0:
+                del self.threshold_index[key]
+        rule = self.compiled_rules.pop(trigger_id, None)
+        if rule is not None:
+            self.rules.release(trigger.event_params, trigger.sensor_id)
+            for sensor_id in rule.sensor_ids:
+                rule_triggers = self.rule_index.get(sensor_id, {})
+                rule_triggers.pop(trigger_id, None)
+                if len(rule_triggers) == 0:
+                    self.rule_index.pop(sensor_id, None)
+            self.time_rule_ids.discard(trigger_id)
+        self.timers.cancel(trigger_id)
+        self.changed_trigger_ids.discard(trigger_id)
+
+    def get_rule_sensor_ids(self):
+        with self.lock:
+            return set(self.rule_index)
+
+    def set_latest_readings(self, readings):
+        # Seeds the values the rules see, e.g. with the last stored reading of every sensor after a restart.
+        with self.lock:
+            for sensor_id, reading in readings.items():
+                self.update_latest_values(sensor_id, reading)
+
+    def update_latest_values(self, sensor_id, reading):
+        values = get_reading_values(reading)
+        if isinstance(values, dict) and 'error' not in values:
+            self.latest_values[sensor_id] = values
+
+    def get_triggers(self, sensor_id):
+        with self.lock:
+            return list(self.sensor_index.get(sensor_id, {}).values())
+
+    def set_active(self, trigger, active, now, fire_from_unknown):
+        # Records the new condition of the trigger and returns whether it fires. A trigger whose previous
+        # condition is unknown only fires if a crossing proved the transition. Within the debounce window
+        # after firing, transitions are recorded but do not fire again.
+        state = trigger.state
+        if state['active'] == active:
+            return False
+        was_active = state['active']
+        state['active'] = active
+        self.changed_trigger_ids.add(trigger.trigger_id)
+        if not active or (was_active is None and not fire_from_unknown):
+            return False
+        debounce = trigger.debounce if trigger.debounce is not None else self.default_debounce
+        if state['last_fired'] is not None and now - state['last_fired'] < debounce:
+            return False
+        state['last_fired'] = now
+        return True
+
+    def set_armed(self, trigger, active, now):
+        # Arms the timer of a duration trigger when its condition starts to hold and cancels it when it stops.
+        # A condition that holds on the first known reading arms the timer from then.
+        state = trigger.state
+        if state['active'] == active:
+            return
+        state['active'] = active
+        self.changed_trigger_ids.add(trigger.trigger_id)
+        duration = get_duration(trigger) if active else None
+        if duration is None:
+            state['due_at'] = None
+            self.timers.cancel(trigger.trigger_id)
+        else:
+            state['due_at'] = now + duration
+            self.timers.schedule(trigger.trigger_id, state['due_at'])
+
+    def expire(self, now=None):
+        # Returns the duration triggers whose timers are due.
+        now = time.time() if now is None else now
+        fired = []
+        with self.lock:
+            for trigger_id, _ in self.timers.advance(now):
+                trigger = self.triggers.get(trigger_id)
+                if trigger is None:
+                    continue
+                state = trigger.state
+                state['due_at'] = None
+                self.changed_trigger_ids.add(trigger_id)
+                debounce = trigger.debounce if trigger.debounce is not None else self.default_debounce
+                if state['last_fired'] is not None and now - state['last_fired'] < debounce:
+                    continue
+                state['last_fired'] = now
+                fired.append(trigger)
+        return fired
+
+    def evaluate(self, sensor_id, previous_reading, reading, now=None):
+        # Returns the triggers of the sensor that fire on this reading.
+        return self.evaluate_batch([(sensor_id, previous_reading, reading)], now)
+
+    def evaluate_batch(self, items, now=None):
+        # items: (sensor id, previous reading, reading) of every sensor read in one go. Returns the triggers
+        # that fire. The rules of all those sensors are evaluated together after the readings are applied, so
+        # that subexpressions they share are evaluated once.
+        now = time.time() if now is None else now
+        fired = []
+        rule_trigger_ids = set()
+        with self.lock:
+            for sensor_id, previous_reading, reading in items:
+                self.update_latest_values(sensor_id, reading)
+                rule_trigger_ids.update(self.rule_index.get(sensor_id, {}))
+                fired.extend(self.evaluate_sensor(sensor_id, previous_reading, reading, now))
+            fired.extend(self.evaluate_rules(rule_trigger_ids, now))
+        return fired
+
+    def evaluate_time_rules(self, now=None):
+        # Rules on the time of day can change without a reading, so they are evaluated once a minute.
+        now = time.time() if now is None else now
+        minute = int(now // 60)
+        with self.lock:
+            if minute == self.rule_minute:
+                return []
+            self.rule_minute = minute
+            return self.evaluate_rules(self.time_rule_ids, now)
+
+    def evaluate_rules(self, trigger_ids, now):
+        fired = []
+        context = RuleContext(self.latest_values, now)
+        for trigger_id in trigger_ids:
+            trigger = self.triggers[trigger_id]
+            if self.set_active(trigger, bool(self.compiled_rules[trigger_id].evaluate(context)), now, False):
+                fired.append(trigger)
+        return fired
+
+    def evaluate_sensor(self, sensor_id, previous_reading, reading, now):
+        fired = []
+        for event, (field, _) in threshold_events.items():
+            indexes = self.threshold_index.get((sensor_id, event))
+            if indexes is None:
+                continue
+            try:
+                previous = float(get_reading_field(previous_reading, field))
+                current = float(get_reading_field(reading, field))
+            except (TypeError, ValueError):
+                continue
+            for trigger_id in indexes[0].get_crossed(previous, current):
+                if self.set_active(self.triggers[trigger_id], True, now, True):
+                    fired.append(self.triggers[trigger_id])
+            for trigger_id in indexes[1].get_crossed(previous, current):
+                self.set_active(self.triggers[trigger_id], False, now, True)
+        for trigger in self.condition_index.get(sensor_id, {}).values():
+            field, level = trigger_events.get(trigger.event) or duration_events.get(trigger.event, (None, None))
+            value = get_reading_field(reading, field) if field is not None else None
+            if value is None:
+                continue
+            try:
+                active = level(trigger.event_params, value)
+            except (TypeError, ValueError) as ex:
+                logging.warning("Cannot evaluate trigger {}: {}".format(trigger.trigger_id, ex))
+                continue
+            if trigger.event in duration_events:
+                self.set_armed(trigger, active, now)
+            elif self.set_active(trigger, active, now, False):
+                fired.append(trigger)
+        return fired
+
+    def pop_changed_states(self):
+        # States changed since the last call, to be persisted in one batch.
+        with self.lock:
+            states = {trigger_id: dict(self.triggers[trigger_id].state) for trigger_id in self.changed_trigger_ids}
+            self.changed_trigger_ids = set()
+        return states
@@ -0,0 +1,120 @@
+import collections
+import threading
+
+
+class TriggerGraph(object):
+    # Directed graph of the devices of a house with an edge from every sensor a trigger reads to the actor it
+    # controls. A trigger closing a loop could make devices command each other forever. Reachability is
+    # cached per device until the graph changes.
+    def __init__(self):
+        # sensor id -> {actor id: set of trigger ids}, and the same from actor to sensor
+        self.edges = {}
+        self.reverse_edges = {}
+        self.trigger_edges = {}
+        self.reachable = {}
+        self.lock = threading.Lock()
+
+    def add(self, trigger_id, sensor_ids, actor_id):
+        # Also used when a trigger is edited: its old edges are replaced.
+        with self.lock:
+            self.remove_edges(trigger_id)
+            self.trigger_edges[trigger_id] = [(sensor_id, actor_id) for sensor_id in set(sensor_ids)]
+            for sensor_id, actor_id in self.trigger_edges[trigger_id]:
+                self.edges.setdefault(sensor_id, {}).setdefault(actor_id, set()).add(trigger_id)
+                self.reverse_edges.setdefault(actor_id, {}).setdefault(sensor_id, set()).add(trigger_id)
+            self.reachable = {}
+
+    def remove(self, trigger_id):
+        with self.lock:
+            self.remove_edges(trigger_id)
+            self.reachable = {}
+
+    def remove_edges(self, trigger_id):
+        for sensor_id, actor_id in self.trigger_edges.pop(trigger_id, []):
+            for edges, source, target in ((self.edges, sensor_id, actor_id), (self.reverse_edges, actor_id, sensor_id)):
+                edges[source][target].discard(trigger_id)
+                if len(edges[source][target]) == 0:
+                    del edges[source][target]
+                if len(edges[source]) == 0:
+                    del edges[source]
+
+    def has_edge(self, sensor_id, actor_id):
+        with self.lock:
+            return actor_id in self.edges.get(sensor_id, {})
+
+    def get_sources(self, device_id):
+        # Devices with a trigger acting on the device.
+        with self.lock:
+            return list(self.reverse_edges.get(device_id, {}))
+
+    def search(self, edges, device_id):
+        # Devices reachable from device_id over at least one edge, with the device each was reached from.
+        parents = {}
+        queue = collections.deque([device_id])
+        while len(queue) > 0:
+            current = queue.popleft()
+            for neighbour in edges.get(current, {}):
+                if neighbour not in parents:
+                    parents[neighbour] = current
+                    queue.append(neighbour)
+        return parents
+
+    def get_reachable(self, device_id, upstream=False):
+        # Devices the device acts on through chains of triggers, or with upstream those acting on it.
+        with self.lock:
+            key = (device_id, upstream)
+            if key not in self.reachable:
+                edges = self.reverse_edges if upstream else self.edges
+                self.reachable[key] = frozenset(self.search(edges, device_id))
+            return self.reachable[key]
+
+    def get_loops(self):
+        # Sets of devices that already command each other in a loop (strongly connected components with more
+        # than one device, or a device acting on itself), found with Tarjan's algorithm.
+        with self.lock:
+            devices = set(self.edges) | set(self.reverse_edges)
+            index = {}
+            low_link = {}
+            stack = []
+            on_stack = set()
+            loops = []
+            counter = 0
+            for root in devices:
+                if root in index:
+                    continue
+                work = [(root, iter(self.edges.get(root, {})))]
+                index[root] = low_link[root] = counter
+                counter += 1
+                stack.append(root)
+                on_stack.add(root)
+                while len(work) > 0:
+                    device_id, neighbours = work[-1]
+                    descended = False
+                    for neighbour in neighbours:
+                        if neighbour not in index:
+                            index[neighbour] = low_link[neighbour] = counter
+                            counter += 1
+                            stack.append(neighbour)
+                            on_stack.add(neighbour)
+                            work.append((neighbour, iter(self.edges.get(neighbour, {}))))
+                            descended = True
+                            break
+                        elif neighbour in on_stack:
+                            low_link[device_id] = min(low_link[device_id], index[neighbour])
+                    if descended:
+                        continue
+                    work.pop()
+                    if len(work) > 0:
+                        parent = work[-1][0]
+                        low_link[parent] = min(low_link[parent], low_link[device_id])
+                    if low_link[device_id] == index[device_id]:
+                        component = set()
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.add(member)
+                            if member == device_id:
+                                break
+                        if len(component) > 1 or device_id in self.edges.get(device_id, {}):
+                            loops.append(component)
+            return loops
@@ -0,0 +1,269 @@
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+
+from poll_scheduler import get_reading_values
+from trigger_engine import RULE_EVENT, TriggerEngine, get_trigger_sensor_ids
+
+
+def run_worker(engine_options, requests, results):
+    # Runs in a worker process: every request is an engine method applied to the shard's own TriggerEngine,
+    # answered with the ids of the triggers that fired and the trigger states that changed.
+    engine = TriggerEngine(**engine_options)
+    while True:
+        message = requests.get()
+        if message is None:
+            return
+        request_id, method, arguments = message
+        try:
+            fired = getattr(engine, method)(*arguments)
+            fired_ids = [trigger.trigger_id for trigger in fired] if isinstance(fired, list) else []
+            results.put((request_id, fired_ids, engine.pop_changed_states(), None))
+        except Exception as ex:
+            results.put((request_id, [], {}, "{}: {}".format(type(ex).__name__, ex)))
+
+
+class TriggerWorkerPool(object):
+    # Same interface as TriggerEngine, but the triggers are evaluated in worker processes so that evaluating
+    # them does not compete with request handling for the interpreter lock. The triggers of a house all live
+    # on one worker; a reading is sent to every worker with a trigger on its sensor, rules included.
+    #
+    # The workers are forked, so the pool has to be created before the process starts any threads whose locks
+    # a child could inherit while held. For the same reason a worker that died or stopped answering is not
+    # forked again: its shard is evaluated in this process from then on.
+    def __init__(self, worker_count, get_house_ids=None, timeout=30, **engine_options):
+        # get_house_ids maps a set of sensor ids to {sensor id: house id}; it may be set after the pool was created.
+        self.get_house_ids = get_house_ids
+        self.timeout = timeout
+        self.engine_options = engine_options
+        context = multiprocessing.get_context('fork')
+        # Every worker answers on its own queue: a worker killed while writing to a queue leaves it locked.
+        self.requests = [context.Queue() for _ in range(worker_count)]
+        self.results = [context.Queue() for _ in range(worker_count)]
+        self.workers = [context.Process(target=run_worker, args=(engine_options, requests, results))
+                        for requests, results in zip(self.requests, self.results)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        # trigger id -> (trigger, worker), sensor id -> {worker: number of triggers on the sensor}
+        self.triggers = {}
+        self.sensor_workers = {}
+        self.changed_states = {}
+        # sensor id -> latest reading the workers took, mirrored like the trigger states so that an engine taking
+        # over a shard gives the rules the values they saw
+        self.latest_readings = {}
+        # worker -> TriggerEngine that took over the shard of a failed worker
+        self.local_engines = {}
+        self.queue_depths = [0] * worker_count
+        self.pending = {}
+        self.request_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.collectors = [threading.Thread(target=self.collect_results, args=(results,)) for results in self.results]
+        for collector in self.collectors:
+            collector.daemon = True
+            collector.start()
+
+    def get_worker(self, house_id):
+        return hash(house_id) % len(self.workers)
+
+    def collect_results(self, results):
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            with self.lock:
+                request = self.pending.pop(result[0], None)
+                if request is None:
+                    continue
+                self.queue_depths[request['worker']] -= 1
+            request['result'] = result
+            request['done'].set()
+
+    def take_over(self, worker):
+        # Evaluates the shard of a dead or unresponsive worker in this process, starting from the trigger states
+        # and latest readings mirrored here, so that hysteresis, debounce and rules carry on where the worker was.
+        with self.lock:
+            if worker in self.local_engines:
+                return
+            logging.error("Trigger worker {} failed, evaluating its triggers in process".format(worker))
+            if self.workers[worker].is_alive():
+                self.workers[worker].terminate()
+            # Nothing reads or writes the worker's queues any more; exiting must not wait for them.
+            self.requests[worker].cancel_join_thread()
+            self.results[worker].cancel_join_thread()
+            engine = TriggerEngine(**self.engine_options)
+            engine.load([trigger for trigger, trigger_worker in self.triggers.values() if trigger_worker == worker])
+            engine.set_latest_readings({sensor_id: reading for sensor_id, reading in self.latest_readings.items()
+                                        if worker in self.sensor_workers.get(sensor_id, {})})
+            self.local_engines[worker] = engine
+
+    def run_locally(self, worker, method, arguments):
+        engine = self.local_engines[worker]
+        try:
+            fired = getattr(engine, method)(*arguments)
+            fired_ids = [trigger.trigger_id for trigger in fired] if isinstance(fired, list) else []
+            return fired_ids, engine.pop_changed_states(), None
+        except Exception as ex:
+            return [], engine.pop_changed_states(), "{}: {}".format(type(ex).__name__, ex)
+
+    def call(self, calls):
+        # calls: (worker, method, arguments) triples. Sends them all, then waits for the answers and returns
+        # the triggers that fired. A request to a worker that is dead or does not answer in time is run by the
+        # engine taking over its shard.
+        for worker in set(worker for worker, _, _ in calls):
+            if worker not in self.local_engines and not self.workers[worker].is_alive():
+                self.take_over(worker)
+        requests = []
+        with self.lock:
+            for worker, method, arguments in calls:
+                request = {'worker': worker, 'method': method, 'arguments': arguments, 'done': threading.Event(),
+                           'result': None}
+                request_id = None
+                if worker not in self.local_engines:
+                    request_id = next(self.request_ids)
+                    self.pending[request_id] = request
+                    self.queue_depths[worker] += 1
+                    self.requests[worker].put((request_id, method, arguments))
+                requests.append((request_id, request))
+        fired = []
+        deadline = time.time() + self.timeout
+        for request_id, request in requests:
+            worker = request['worker']
+            if request_id is not None and worker not in self.local_engines and \
+                    request['done'].wait(max(0, deadline - time.time())):
+                _, fired_ids, states, error = request['result']
+            else:
+                if request_id is not None:
+                    with self.lock:
+                        if self.pending.pop(request_id, None) is not None:
+                            self.queue_depths[worker] -= 1
+                    if worker not in self.local_engines:
+                        logging.error("Trigger worker {} did not answer within {} seconds".format(worker,
+                                                                                                 self.timeout))
+                        # The worker may still apply the request, so its state can no longer be trusted.
+                        self.take_over(worker)
+                fired_ids, states, error = self.run_locally(worker, request['method'], request['arguments'])
+            if error is not None:
+                logging.error("Trigger worker {} failed: {}".format(worker, error))
+            with self.lock:
+                for trigger_id, state in states.items():
+                    if trigger_id in self.triggers:
+                        self.triggers[trigger_id][0].state = dict(state)
+                    self.changed_states[trigger_id] = state
+                fired.extend(self.triggers[trigger_id][0] for trigger_id in fired_ids if trigger_id in self.triggers)
+        return fired
+
+    def index_trigger(self, trigger, worker):
+        self.triggers[trigger.trigger_id] = (trigger, worker)
+        for sensor_id in get_trigger_sensor_ids(trigger):
+            workers = self.sensor_workers.setdefault(sensor_id, {})
+            workers[worker] = workers.get(worker, 0) + 1
+
+    def unindex_trigger(self, trigger_id):
+        trigger, worker = self.triggers.pop(trigger_id, (None, None))
+        if trigger is None:
+            return None
+        for sensor_id in get_trigger_sensor_ids(trigger):
+            workers = self.sensor_workers[sensor_id]
+            workers[worker] -= 1
+            if workers[worker] == 0:
+                del workers[worker]
+            if len(workers) == 0:
+                del self.sensor_workers[sensor_id]
+                self.latest_readings.pop(sensor_id, None)
+        return worker
+
+    def load(self, triggers):
+        house_ids = self.get_house_ids(set(trigger.sensor_id for trigger in triggers))
+        shards = [[] for _ in self.workers]
+        with self.lock:
+            self.triggers = {}
+            self.sensor_workers = {}
+            self.changed_states = {}
+            for trigger in triggers:
+                worker = self.get_worker(house_ids.get(trigger.sensor_id))
+                shards[worker].append(trigger)
+                self.index_trigger(trigger, worker)
+        self.call([(worker, 'load', (shard,)) for worker, shard in enumerate(shards)])
+
+    def add(self, trigger):
+        house_ids = self.get_house_ids({trigger.sensor_id})
+        worker = self.get_worker(house_ids.get(trigger.sensor_id))
+        with self.lock:
+            old_worker = self.unindex_trigger(trigger.trigger_id)
+            self.index_trigger(trigger, worker)
+        calls = [(worker, 'add', (trigger,))]
+        if old_worker is not None and old_worker != worker:
+            calls.append((old_worker, 'remove', (trigger.trigger_id,)))
+        self.call(calls)
+
+    def remove(self, trigger_id):
+        with self.lock:
+            worker = self.unindex_trigger(trigger_id)
+            self.changed_states.pop(trigger_id, None)
+        if worker is not None:
+            self.call([(worker, 'remove', (trigger_id,))])
+
+    def get_rule_sensor_ids(self):
+        with self.lock:
+            return set(sensor_id for trigger, _ in self.triggers.values() if trigger.event == RULE_EVENT
+                       for sensor_id in get_trigger_sensor_ids(trigger))
+
+    def split(self, items, get_sensor_id):
+        # Items per worker that has a trigger on their sensor.
+        shards = {}
+        with self.lock:
+            for item in items:
+                for worker in self.sensor_workers.get(get_sensor_id(item), {}):
+                    shards.setdefault(worker, []).append(item)
+        return shards
+
+    def mirror_readings(self, readings):
+        # Keeps the readings the workers' engines keep as their latest values.
+        with self.lock:
+            for sensor_id, reading in readings:
+                values = get_reading_values(reading)
+                if sensor_id in self.sensor_workers and isinstance(values, dict) and 'error' not in values:
+                    self.latest_readings[sensor_id] = reading
+
+    def set_latest_readings(self, readings):
+        shards = self.split(readings.items(), lambda item: item[0])
+        self.call([(worker, 'set_latest_readings', (dict(shard),)) for worker, shard in shards.items()])
+        self.mirror_readings(readings.items())
+
+    def evaluate(self, sensor_id, previous_reading, reading, now=None):
+        return self.evaluate_batch([(sensor_id, previous_reading, reading)], now)
+
+    def evaluate_batch(self, items, now=None):
+        now = time.time() if now is None else now
+        shards = self.split(items, lambda item: item[0])
+        fired = self.call([(worker, 'evaluate_batch', (shard, now)) for worker, shard in shards.items()])
+        self.mirror_readings((sensor_id, reading) for sensor_id, _, reading in items)
+        return fired
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        return self.call([(worker, 'expire', (now,)) for worker in range(len(self.workers))])
+
+    def evaluate_time_rules(self, now=None):
+        now = time.time() if now is None else now
+        return self.call([(worker, 'evaluate_time_rules', (now,)) for worker in range(len(self.workers))])
+
+    def pop_changed_states(self):
+        with self.lock:
+            states = self.changed_states
+            self.changed_states = {}
+        return states
+
+    def get_queue_depths(self):
+        # Requests sent to every worker that it has not answered yet; None for workers taken over in process.
+        with self.lock:
+            return [None if worker in self.local_engines else depth for worker, depth in enumerate(self.queue_depths)]
+
+    def shutdown(self):
+        for worker in range(len(self.workers)):
+            if worker not in self.local_engines:
+                self.requests[worker].put(None)
+                self.results[worker].put(None)
@@ -0,0 +1,71 @@
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class VendorHttpClients(object):
+    def __init__(self, pool_size=16, timeout=10, keep_alive=True):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_host_key(url):
+        parsed = urlparse(url)
+        return "{}://{}".format(parsed.scheme, parsed.netloc)
+
+    def create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def get_session(self, url):
+        host_key = self.get_host_key(url)
+        session = self.sessions.get(host_key)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(host_key)
+                if session is None:
+                    session = self.create_session()
+                    self.sessions[host_key] = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return self.get_session(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+clients = VendorHttpClients()
+
+
+def configure(pool_size=16, timeout=10, keep_alive=True):
+    # Every RepositoryCollection configures the clients; the pooled sessions that poller threads may be using are
+    # only replaced when the settings change.
+    global clients
+    old_clients = clients
+    if (old_clients.pool_size, old_clients.timeout, old_clients.keep_alive) == (pool_size, timeout, keep_alive):
+        return old_clients
+    clients = VendorHttpClients(pool_size=pool_size, timeout=timeout, keep_alive=keep_alive)
+    old_clients.close()
+    return clients
@@ -0,0 +1,308 @@
+import datetime
+import logging
+import threading
+import time
+from datetime import timedelta
+
+import vendor_http
+
+ENERGENIE_API_URL = "https://mihome4u.co.uk/api/v1"
+
+
+class VendorException(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    def __init__(self, failure_threshold=3, base_backoff=30, max_backoff=3600):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def get_backoff(self, failures):
+        return min(self.max_backoff, self.base_backoff * 2 ** min(failures - self.failure_threshold, 16))
+
+    def allow(self, key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            circuit = self.circuits.get(key)
+            if circuit is None or circuit['failures'] < self.failure_threshold:
+                return True
+            if now < circuit['retry_at']:
+                return False
+            # Half open: this call goes through as a probe, everyone else keeps failing fast until it reports back.
+            circuit['retry_at'] = now + self.get_backoff(circuit['failures'])
+            return True
+
+    def get_circuit(self, key):
+        with self.lock:
+            circuit = self.circuits.get(key)
+            return dict(circuit) if circuit is not None else None
+
+    def record_success(self, key):
+        with self.lock:
+            self.circuits.pop(key, None)
+
+    def record_failure(self, key, error=None, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            circuit = self.circuits.setdefault(key, {'failures': 0, 'retry_at': 0, 'last_error': None})
+            circuit['failures'] += 1
+            circuit['last_error'] = error
+            if circuit['failures'] >= self.failure_threshold:
+                circuit['retry_at'] = now + self.get_backoff(circuit['failures'])
+
+
+class VendorAdapter(object):
+    name = None
+    operations = ()
+    required_configuration = ()
+
+    def __init__(self, timeout=10, retries=1, retry_delay=0.5, breaker=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+    def supports(self, operation):
+        return operation in self.operations
+
+    def has_required_configuration(self, configuration):
+        if configuration is None:
+            return False
+        return all(key in configuration for key in self.required_configuration)
+
+    def get_endpoint_key(self, device):
+        raise NotImplementedError()
+
+    def get_batch_key(self, device):
+        return None
+
+    def get_device_key(self, device):
+        return self.name, 'device', device.get_device_id()
+
+    def execute(self, device, operation, description, timeout=None, device_circuit=True):
+        # Returns (data, error). Transport failures are retried and count against the endpoint (host or
+        # account), errors reported by the device itself count against the device. Either circuit being
+        # open makes the call fail fast without touching the network. Calls for a whole account pass
+        # device_circuit=False: they only use the endpoint circuit and every error counts against it.
+        if not self.has_required_configuration(device.configuration):
+            return None, "Not all required information is set in the configuration"
+        endpoint_key = (self.name, self.get_endpoint_key(device))
+        device_key = self.get_device_key(device) if device_circuit else None
+        for key in (endpoint_key, device_key):
+            if key is None:
+                continue
+            if not self.breaker.allow(key):
+                circuit = self.breaker.get_circuit(key) or {}
+                return None, "{} (not retried for another {:.0f} seconds)".format(
+                    circuit.get('last_error') or "Too many failures",
+                    max(0, circuit.get('retry_at', 0) - time.time()))
+        timeout = self.timeout if timeout is None else min(self.timeout, timeout)
+        attempts = 1 + self.retries
+        for attempt in range(attempts):
+            try:
+                data = operation(device, timeout)
+            except VendorException as ex:
+                if device_key is None:
+                    self.breaker.record_failure(endpoint_key, str(ex))
+                else:
+                    self.breaker.record_success(endpoint_key)
+                    self.breaker.record_failure(device_key, str(ex))
+                return None, str(ex)
+            except Exception as ex:
+                error = "{}: {}".format(description, ex)
+                if attempt + 1 < attempts:
+                    logging.debug("Retrying {} for device {}: {}".format(self.name, device.get_device_id(), ex))
+                    time.sleep(self.retry_delay * 2 ** attempt)
+                    continue
+                self.breaker.record_failure(endpoint_key, error)
+                return None, error
+            self.breaker.record_success(endpoint_key)
+            if device_key is not None:
+                self.breaker.record_success(device_key)
+            return data, None
+
+    def read_state(self, device, include_usage_data=0, timeout=None):
+        return self.execute(device, lambda d, t: self.fetch_state(d, include_usage_data, t),
+                            "Cannot read device data from URL", timeout)
+
+    def read_states(self, devices, timeout=None):
+        readings = {}
+        for device in devices:
+            timestamp = str(time.time())
+            data, error = self.read_state(device, timeout=timeout)
+            readings[device.get_device_id()] = {"error": error, "timestamp": timestamp} if error is not None else {
+                "data": data, "timestamp": timestamp}
+        return readings
+
+    def set_target_temperature(self, device, temperature, timeout=None):
+        return self.execute(device, lambda d, t: self.push_target_temperature(d, temperature, t),
+                            "Cannot configure target temperature", timeout)
+
+    def set_power_state(self, device, power_state, timeout=None):
+        return self.execute(device, lambda d, t: self.push_power_state(d, power_state, t),
+                            "Cannot configure power state", timeout)
+
+    def get_energy_readings(self, device, timeout=None, start=None, end=None):
+        return self.execute(device, lambda d, t: self.fetch_energy_readings(d, t, start, end),
+                            "Cannot get energy reading", timeout)
+
+    def fetch_state(self, device, include_usage_data, timeout):
+        raise NotImplementedError()
+
+    def push_target_temperature(self, device, temperature, timeout):
+        raise NotImplementedError()
+
+    def push_power_state(self, device, power_state, timeout):
+        raise NotImplementedError()
+
+    def fetch_energy_readings(self, device, timeout, start=None, end=None):
+        raise NotImplementedError()
+
+
+class OwnAdapter(VendorAdapter):
+    name = "OWN"
+    operations = ('read', 'target_temperature')
+    required_configuration = ('url',)
+
+    def get_endpoint_key(self, device):
+        return vendor_http.VendorHttpClients.get_host_key(device.configuration['url'])
+
+    @staticmethod
+    def check_response(r_data):
+        if "error" in r_data and r_data["error"] is not None:
+            raise VendorException(r_data["error"])
+        return r_data
+
+    def fetch_state(self, device, include_usage_data, timeout):
+        r = vendor_http.clients.get(device.configuration['url'], timeout=timeout)
+        return self.check_response(r.json())['data']
+
+    def push_target_temperature(self, device, temperature, timeout):
+        r = vendor_http.clients.post(device.configuration['url'] + "/write", json={"target_temperature": temperature},
+                                     timeout=timeout)
+        self.check_response(r.json())
+        return None
+
+
+class EnergenieAdapter(VendorAdapter):
+    name = "energenie"
+    operations = ('read', 'target_temperature', 'power_state', 'energy')
+    required_configuration = ('username', 'password', 'device_id')
+
+    def get_endpoint_key(self, device):
+        return device.configuration['username']
+
+    def get_batch_key(self, device):
+        if not self.has_required_configuration(device.configuration):
+            return None
+        return self.name, device.configuration['username'], device.configuration['password']
+
+    @staticmethod
+    def call(device, endpoint, timeout, json=None):
+        r = vendor_http.clients.get("{}/{}".format(ENERGENIE_API_URL, endpoint),
+                                    auth=(device.configuration['username'], device.configuration['password']),
+                                    json=json, timeout=timeout)
+        r_data = r.json()
+        if r_data["status"] != "success":
+            raise VendorException("External error: {}".format(r_data['status']))
+        return r_data
+
+    def fetch_state(self, device, include_usage_data, timeout):
+        r_data = self.call(device, "subdevices/show", timeout,
+                           json={"id": int(device.configuration['device_id']),
+                                 "include_usage_data": include_usage_data})
+        return {'power_state': r_data['data']['power_state'], 'voltage': r_data['data']['voltage']}
+
+    def read_states(self, devices, timeout=None):
+        # All devices share one account: a single subdevices/list call returns the state of every subdevice,
+        # which is then handed back out per device. The call only goes through the account's circuit; every
+        # device's own circuit is settled by its entry in the list.
+        if len(devices) == 1:
+            return VendorAdapter.read_states(self, devices, timeout)
+        timestamp = str(time.time())
+        subdevices, error = self.execute(devices[0], lambda d, t: self.call(d, "subdevices/list", t)['data'],
+                                         "Cannot read device data from URL", timeout, device_circuit=False)
+        if error is not None:
+            return {device.get_device_id(): {"error": error, "timestamp": timestamp} for device in devices}
+        readings = {}
+        by_id = {int(subdevice['id']): subdevice for subdevice in subdevices or []}
+        for device in devices:
+            try:
+                subdevice = by_id.get(int(device.configuration['device_id']))
+            except (KeyError, TypeError, ValueError):
+                device_error = "Invalid device id {}".format(device.configuration.get('device_id'))
+            else:
+                device_error = None if subdevice is not None else "Device {} not found for this account".format(
+                    device.configuration['device_id'])
+            if device_error is not None:
+                self.breaker.record_failure(self.get_device_key(device), device_error)
+                readings[device.get_device_id()] = {"error": device_error, "timestamp": timestamp}
+            else:
+                self.breaker.record_success(self.get_device_key(device))
+                readings[device.get_device_id()] = {
+                    "data": {'power_state': subdevice['power_state'], 'voltage': subdevice['voltage']},
+                    "timestamp": timestamp}
+        return readings
+
+    def push_target_temperature(self, device, temperature, timeout):
+        r_data = self.call(device, "subdevices/set_target_temperature", timeout,
+                           json={"id": int(device.configuration['device_id']), "temperature": temperature})
+        return {'target_temperature': r_data['data']['target_temperature'], 'voltage': r_data['data']['voltage']}
+
+    def push_power_state(self, device, power_state, timeout):
+        self.call(device, "subdevices/power_{}".format("on" if power_state == 1 else "off"), timeout,
+                  json={"id": int(device.configuration['device_id'])})
+        return None
+
+    def fetch_energy_readings(self, device, timeout, start=None, end=None):
+        # Daily watts between start and end (local datetimes), the last 7 days by default.
+        date_format = "%Y-%m-%dT%H:%M:%S.%f%Z"
+        end = datetime.datetime.now() if end is None else end
+        start = end - timedelta(days=7) if start is None else start
+        return self.call(device, "subdevices/get_data", timeout,
+                         json={"id": int(device.configuration['device_id']),
+                               "data_type": "watts",
+                               "resolution": "daily",
+                               "start_time": start.strftime(date_format),
+                               "end_time": end.strftime(date_format),
+                               "limit": max(1, (end - start).days + 1)})
+
+
+vendor_adapters = {}
+
+
+def register_vendor_adapter(adapter):
+    vendor_adapters[adapter.name] = adapter
+    return adapter
+
+
+def get_vendor_adapter(vendor, operation=None):
+    adapter = vendor_adapters.get(vendor)
+    if adapter is None or (operation is not None and not adapter.supports(operation)):
+        return None
+    return adapter
+
+
+def get_vendor_names(operation):
+    return [name for name, adapter in vendor_adapters.items() if adapter.supports(operation)]
+
+
+def configure_vendor_adapters(config):
+    # VENDOR_ADAPTERS maps a vendor name to its timeout/retries/retry_delay overrides.
+    overrides = config.get('VENDOR_ADAPTERS', {})
+    for name, adapter in vendor_adapters.items():
+        settings = overrides.get(name, {})
+        adapter.timeout = settings.get('timeout', adapter.timeout)
+        adapter.retries = settings.get('retries', adapter.retries)
+        adapter.retry_delay = settings.get('retry_delay', adapter.retry_delay)
+        adapter.breaker = CircuitBreaker(failure_threshold=config.get('CIRCUIT_BREAKER_THRESHOLD', 3),
+                                         base_backoff=config.get('CIRCUIT_BREAKER_BASE_BACKOFF', 30),
+                                         max_backoff=config.get('CIRCUIT_BREAKER_MAX_BACKOFF', 3600))
+
+
+register_vendor_adapter(OwnAdapter())
+register_vendor_adapter(EnergenieAdapter())
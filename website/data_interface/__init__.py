@@ -1,3 +1,4 @@
+import collections
 import logging
 
 import requests
@@ -210,12 +211,20 @@ def get_trigger_info(trigger_id):
     return data['trigger']
 
 
+def get_reachable_actors(device_id):
+    r = requests.post(get_api_url('/device/{}/reachable'.format(device_id)),
+                      json=get_authentication_token())
+    data = r.json()
+    if data['error'] is not None:
+        raise Exception("Error!")
+    return data['reachable']
+
+
 def get_possible_affected_devices(device_id):
     device_info = get_device_info(device_id)
     all_devices = get_house_devices(device_info["house_id"])
-    all_affected_devices = get_affected_triggers(device_id)
-    logging.info("All affected devices: {}".format(all_affected_devices))
-    invalid_devices = {device["actor_id"] for device in all_affected_devices} | {device_id} | {
+    reachable = get_reachable_actors(device_id)
+    invalid_devices = set(reachable["reachable_actors"]) | set(reachable["loop_actors"]) | {
         device["device_id"] for device in all_devices if device["device_type"] in ["motion_sensor"]
     }
     return [device for device in all_devices if (device["device_id"] not in invalid_devices)]
@@ -318,13 +327,42 @@ def get_all_users():
     return data['users']
 
 
+# (user id, start, end, resolution) -> (ETag, data) of the graphs fetched last, so that the API can answer an
+# unchanged graph with a 304.
+graph_cache = collections.OrderedDict()
+GRAPH_CACHE_SIZE = 256
+
+
+def get_user_graph_data(user_id, start=None, end=None, resolution='day'):
+    params = {key: value for key, value in (('start', start), ('end', end), ('resolution', resolution))
+              if value is not None}
+    key = (user_id, start, end, resolution)
+    cached = graph_cache.get(key)
+    # GET requests have no body, so the token goes in a header.
+    headers = {'Authorization': "Bearer {}".format(get_authentication_token()['token'])}
+    if cached is not None:
+        headers['If-None-Match'] = cached[0]
+    r = requests.get(get_api_url('/graph/{}'.format(user_id)), params=params, headers=headers)
+    if r.status_code == 304 and cached is not None:
+        return cached[1]
+    data = r.json()
+    if data['error'] is not None:
+        raise Exception('Error!')
+    if r.headers.get('ETag') is not None:
+        graph_cache.pop(key, None)
+        graph_cache[key] = (r.headers['ETag'], data['data'])
+        while len(graph_cache) > GRAPH_CACHE_SIZE:
+            graph_cache.popitem(last=False)
+    return data['data']
+
+
 def get_overall_power_consumption():
     r = requests.get(get_api_url('/admin/graph'),
                      json=get_authentication_token())
     data = r.json()
     if data['error'] is not None:
         raise Exception('Error!')
-    return data['devices']
+    return data['consumption']
 
 
 def logout():